@@ -7,11 +7,9 @@ LastEditTime: 2024-07-24 13:51:25
 from logger import ThreadLogger
 from tool import *
 from broadcast import *
-from tcp import *
 from config import *
-from task import *
-from thread import *
 from reg_win import *
+from session import RECV_DEFAULTS, recv_task
 
 import os
 from socket import *
@@ -27,15 +25,13 @@ if __name__ == '__main__':
         registered = True
 
     # use lang_file in config
-    start_config = JsonFileConfig({
-        "save_logs": False,
-        "lang_file": r'.\Locales\zh_CN.json',
-        "block_cache": r'.\Cache'
-    })
+    start_config = JsonFileConfig(dict(RECV_DEFAULTS))
     start_config.load_from_file(r'.\Configs\cfg_recv.json')
 
     # setup logger
-    thread_logger = ThreadLogger(start_config['save_logs'], r'.\Logs\Recv')
+    thread_logger = ThreadLogger(
+        start_config['save_logs'], r'.\Logs\Recv', start_config['log_level']
+    )
     thread_logger.startLogThread()
     main_logger = thread_logger.getWrapperInstance('main')
 
@@ -89,7 +85,6 @@ if __name__ == '__main__':
             break
 
     # open main
-    main_packer = Packer(Coder(), 'loose', main_logger)
     tcp_accept_socket = socket(AF_INET, SOCK_STREAM)
     tcp_accept_socket.bind((local_ip, main_port))
     tcp_accept_socket.settimeout(10.0)
@@ -114,69 +109,10 @@ if __name__ == '__main__':
 
     # recv task with info_exchange
     main_logger.info(lang_text('recv.launch.recv_task'), connect_addr)
-    task_config = main_packer.recvPacket(info_exchange)
-    ## show task info
-    main_logger.info(lang_text('show_task.type'), task_config['type'])
-    main_logger.info(lang_text('show_task.file_name'), task_config['file_name'])
-    main_logger.info(lang_text('show_task.file_count'), task_config['file_count'])
-    main_logger.info(lang_text('show_task.total_size'), task_config['total_size'])
-    main_logger.info(lang_text('show_task.thread_cnt'), task_config['thread_cnt'])
-    
-    # recv dir info
-    main_logger.info(lang_text('recv.prepare.folder'))
-    dir_path_cnt = main_packer.recvPacket(info_exchange)
-    dir_name: str = task_config['file_name']
-    dir_paths: list[str] = []
-    for index in range(dir_path_cnt):
-        rel_path: str = main_packer.recvPacket(info_exchange)
-        dir_paths.append(f'{save_folder}\\{dir_name}{rel_path}')
-    main_logger.info(lang_text('recv.prepare.folder_cnt'), dir_path_cnt)
-
-    # make apex_path
-    if task_config['type'] == 'file':
-        apex_path = save_folder
-    elif task_config['type'] == 'dir':
-        apex_path = f'{save_folder}\\{dir_name}'
-
-    # create dirs
-    main_logger.info(lang_text('recv.prepare.create_folder'))
-    skip_create: int = 0
-    for dir_path in dir_paths:
-        try: os.mkdir(dir_path)
-        except FileExistsError: skip_create += 1
-    if skip_create > 0:
-        main_logger.warn(lang_text('recv.prepare.warn_skip'), skip_create)
-    del dir_paths, skip_create
-
-    # create MergeFile
-    merge_file = MergeFile(lang_text, thread_logger.getWrapperInstance('MergeFile'))
-    merge_msg = merge_file.get_queue()
-
-    # create cache folder
-    if not os.path.exists(start_config['block_cache']):
-        os.makedirs(start_config['block_cache'])
-    main_logger.info(lang_text('recv.prepare.cache'), start_config['block_cache'])
-
-    # create RecvThread
-    main_logger.info(lang_text('recv.prepare.recv_connect'))
-    recv_threads: list[RecvThread] = []
-    for i in range(task_config['thread_cnt']):
-        connection, addr = tcp_accept_socket.accept()
-        recv_threads.append(RecvThread(
-            merge_msg, connection, i,
-            thread_logger.getWrapperInstance(f'RecvThread{i}'),
-            start_config['lang_file'], apex_path, start_config['block_cache']
-        ))
-    ## launch threads
-    for t in recv_threads: t.run()
-
-    # give control to merge_file
-    merge_file.loop(info_exchange)
-    info_exchange.close()
-
-    # wait join
-    main_logger.info(lang_text('recv.work.wait_quit'))
-    for t in recv_threads: t.join()
+    recv_task(
+        start_config, info_exchange, tcp_accept_socket, save_folder,
+        thread_logger, lang_text
+    )
 
     # save config
     start_config.save_to_file(r'.\Configs\cfg_recv.json')
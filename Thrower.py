@@ -5,16 +5,14 @@ LastEditTime: 2024-07-24 13:35:28
 '''
 
 from tool import *
-from tcp import *
 from broadcast import *
 from config import *
 from reg_win import *
 from logger import ThreadLogger
-from task import *
-from thread import *
+from tuner import PeerMemory
+from session import SEND_DEFAULTS, scan_task, send_task
 
 from os import chdir
-from socket import *
 from random import randint
 from sys import argv
 
@@ -27,16 +25,13 @@ if __name__ == '__main__':
         registered = True
 
     # start config
-    start_config: JsonFileConfig = JsonFileConfig({
-        "save_logs": False,
-        "thread_count": 20,
-        "split_limit": '16MB',
-        "lang_file": r'.\Locales\zh_CN.json',
-    })
+    start_config: JsonFileConfig = JsonFileConfig(dict(SEND_DEFAULTS))
     start_config.load_from_file(r'.\Configs\cfg_send.json')
 
     # run logger
-    thread_logger = ThreadLogger(start_config['save_logs'], r'.\Logs\Send')
+    thread_logger = ThreadLogger(
+        start_config['save_logs'], r'.\Logs\Send', start_config['log_level']
+    )
     thread_logger.startLogThread()
     main_logger = thread_logger.getWrapperInstance('main')
 
@@ -69,12 +64,7 @@ if __name__ == '__main__':
         target_path = input()
 
     # get task info
-    task_config = get_task_config(target_path)
-    ## show task info
-    main_logger.info(lang_text('show_task.type'), task_config['task_type'])
-    main_logger.info(lang_text('show_task.choose_path'), task_config['apex_path'])
-    main_logger.info(lang_text('show_task.file_count'), task_config['file_count'])
-    main_logger.info(lang_text('show_task.total_size'), task_config['total_size'])
+    task_config = scan_task(start_config, target_path, main_logger, lang_text)
 
     # get client address
     key, bc_port = generate_connect_key(5)
@@ -89,61 +79,11 @@ if __name__ == '__main__':
 
     main_logger.info(lang_text('send.launch.client_found'), client_addr)
 
-    # connect to client
-    main_packer = Packer(Coder(), 'loose', main_logger)
-    info_exchange = socket(AF_INET, SOCK_STREAM)
-    info_exchange.connect(client_addr)
-    
-    # send task info
-    main_logger.info(lang_text('send.launch.connected'))
-    apex_path: str = task_config['apex_path']
-    main_packer.sendPacket(info_exchange, {
-        "type": task_config['task_type'],
-        "file_name": apex_path.split('\\')[-1],
-        "file_count": task_config['file_count'],
-        "total_size": task_config['total_size'],
-        "thread_cnt": start_config['thread_count']
-    })
-
-    # send dir info
-    main_logger.info(lang_text('send.prepare.folder'))
-    dir_paths: list[str] = task_config['dir_path']
-    dir_count = len(dir_paths)
-    main_packer.sendPacket(info_exchange, dir_count)
-    for dir_path in dir_paths:
-        main_packer.sendPacket(info_exchange, dir_path.removeprefix(apex_path))
-
-    # task releaser
-    task_releaser = TaskReleaser(
-        task_config, start_config,
-        lang_text, thread_logger.getWrapperInstance('TaskReleaser')
+    # transfer
+    send_task(
+        start_config, task_config, client_addr, thread_logger, lang_text,
+        PeerMemory(r'.\Configs\peers.json')
     )
-    task_queue = task_releaser.get_reference()
-
-    # make threads
-    send_thread_list: list[SendThread] = []
-    for i in range(start_config['thread_count']):
-        send_thread_list.append(SendThread(
-            task_queue, client_addr, i,
-            thread_logger.getWrapperInstance(f'SendThread{i}'),
-            start_config['lang_file']
-        ))
-    ## launch threads
-    for t in send_thread_list: t.run()
-
-    # give control to TaskReleaser
-    task_releaser.loop()
-
-    # wait join
-    main_logger.info(lang_text('send.work.wait_quit'))
-    for t in send_thread_list: t.join()
-
-    # send stop fm
-    main_packer.sendPacket(info_exchange, Msg.make_dict(
-        Msg('stop_fm', {
-            "reason": lang_text('msg.task_end')
-        })
-    ))
 
     # save config
     start_config.save_to_file(r'.\Configs\cfg_send.json')
@@ -0,0 +1,549 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from config import LangFile
+from time import monotonic
+from queue import Queue
+from threading import Thread
+from hashlib import new as new_hash
+from logger import LoggerWrapper
+from task import Msg, BlockWriter, DigestBook
+from journal import Journal
+from scheduler import Scheduler
+from metrics import ConnStats, Metrics
+from thread import RETRY_LIMIT, ACK_INTERVAL, task_files, task_paths
+from tcp import *
+from tool import make_short_log, open_target
+from socket import socket, AF_INET, SOCK_STREAM, MSG_PEEK
+from typing import Any, BinaryIO, Literal
+
+__all__ = ['ENGINE', 'aio_send_supported', 'aio_recv_supported',
+           'AioSender', 'AioReceiver']
+
+ENGINE = Literal['thread', 'asyncio']
+
+READ_SIZE = 1048576
+
+def aio_send_supported(start_config: Any) -> bool:
+    r'''异步引擎只实现了普通的数据任务: 需要`FRAME_V2`与窗口确认, 不支持压缩、增量与去重.'''
+    return start_config['framing'] == FRAME_V2 and start_config['ack_window'] > 0 \
+        and start_config['compression'] == 'none' \
+        and not start_config['delta'] and not start_config['dedup']
+
+def aio_recv_supported(task_config: dict[str, Any]) -> bool:
+    return task_config.get('framing', FRAME_V1) == FRAME_V2 \
+        and task_config.get('ack_window', 0) > 0 \
+        and not task_config.get('delta', False) \
+        and not task_config.get('dedup', False) \
+        and not task_config.get('auto_tune', False)
+
+def _read(file: BinaryIO, size: int, hasher: Any) -> bytes:
+    data = file.read(size)
+    if hasher is not None: hasher.update(data)
+    return data
+
+def _write(file: BinaryIO, data: bytes, hasher: Any) -> None:
+    if hasher is not None: hasher.update(data)
+    file.write(data)
+
+async def _send_frame(connection: socket, frame: list[bytes]) -> None:
+    loop = asyncio.get_running_loop()
+    header, coded = frame
+    if len(coded) <= 65536:
+        await loop.sock_sendall(connection, header + coded)
+    else:
+        await loop.sock_sendall(connection, header)
+        await loop.sock_sendall(connection, coded)
+
+def _open_at(file_path: str, front: int) -> BinaryIO:
+    file = open(file_path, 'rb')
+    file.seek(front)
+    return file
+
+class _SendConn:
+    r'''`AioSender`中的一条数据连接, 协议与`SendThread`相同.'''
+    def __init__(self, engine, uid: int) -> None:
+        self._engine: AioSender = engine
+        self._uid = uid
+        self._seq = 0
+        self._acked = 0
+        self._in_flight: dict[int, Msg] = {}
+        self._retry: list[Msg] = []
+        self._sent_at: dict[int, float] = {}
+        # coroutines interleave, so only bytes, tasks and rtt are counted
+        self._stats = engine._conn_stats(f'AioSender{uid}')
+        self._packer = Packer(Coder(), 'loose', engine._logger, FRAME_V2, engine._use_codec)
+        self._connection = socket(AF_INET, SOCK_STREAM)
+        self._connection.setblocking(False)
+
+    async def connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.sock_connect(self._connection, self._engine._client_addr)
+
+    def _new_hash(self) -> Any:
+        checksum = self._engine._checksum
+        return None if checksum == 'none' else new_hash(checksum)
+
+    async def _send(self, obj: Any, serialization_method: int = SM_JSON) -> None:
+        await _send_frame(self._connection, self._packer.packFrame(obj, None, serialization_method))
+
+    async def _send_header(self, msg: Msg, task: Msg = None) -> None:
+        self._seq += 1
+        msg.args['seq'] = self._seq
+        if task is not None: self._in_flight[self._seq] = task
+        self._sent_at[self._seq] = monotonic()
+        await self._send(Msg.make_dict(msg))
+
+    async def _send_data(self, file_path: str, front: int, size: int, hasher: Any) -> None:
+        loop = asyncio.get_running_loop()
+        executor = self._engine._executor
+        file = await loop.run_in_executor(executor, _open_at, file_path, front)
+        try:
+            if self._engine._data_mode == 'stream' and hasher is None:
+                if size > 0: await loop.sock_sendfile(self._connection, file, front, size)
+                return
+            while size > 0:
+                data = await loop.run_in_executor(
+                    executor, _read, file, min(READ_SIZE, size), hasher
+                )
+                if not data: raise EOFError('file shrank while sending.')
+                size -= len(data)
+                if self._engine._data_mode == 'stream':
+                    await loop.sock_sendall(self._connection, data)
+                else: await self._send(data, SM_RAW)
+        finally: await loop.run_in_executor(executor, file.close)
+
+    async def _send_digest(self, hashers: list[Any], rel_paths: list[str], index: int) -> None:
+        if self._engine._checksum == 'none': return
+        digests = [hasher.hexdigest() for hasher in hashers]
+        await self._send({"digest": digests})
+        if self._engine._digest_book is not None:
+            for rel_path, digest in zip(rel_paths, digests):
+                self._engine._digest_book.record(rel_path, index, digest)
+
+    def _on_ack(self, ack: dict[str, Any]) -> None:
+        for seq in ack.get('nack', []):
+            task: Msg = self._in_flight.pop(seq, None)
+            if task is None: continue
+            retry = task['retry'] or 0
+            if retry >= RETRY_LIMIT:
+                self._engine._logger.error(
+                    self._engine._locale('send.thread.retry_limit'),
+                    make_short_log(task['path'] or task['entries'][0][1])
+                )
+                self._engine.failed.extend(task_paths(task))
+                continue
+            task.args['retry'] = retry + 1
+            self._retry.append(task)
+            self._engine._logger.warn(
+                self._engine._locale('send.thread.retransmit').format(seq)
+            )
+        self._acked = max(self._acked, ack.get('ack', 0))
+        sent_at = None
+        while self._sent_at:
+            seq = next(iter(self._sent_at))
+            if seq > self._acked: break
+            sent_at = self._sent_at.pop(seq)
+        if sent_at is not None: self._stats.sample_rtt(monotonic() - sent_at)
+        while self._in_flight:
+            seq = next(iter(self._in_flight))
+            if seq > self._acked: break
+            self._in_flight.pop(seq)
+
+    async def _wait_ack(self, in_flight: int) -> None:
+        while self._seq - self._acked > in_flight:
+            ack = await self._packer.recvPacketAsync(self._connection)
+            if not isinstance(ack, dict): break
+            self._on_ack(ack)
+
+    async def work(self) -> None:
+        engine = self._engine
+        while True:
+            if self._retry: msg: Msg = self._retry.pop(0)
+            else: msg: Msg = await engine._tasks.get()
+            if msg('end'):
+                if engine._checksum != 'none':
+                    await self._send_header(Msg('sync', {}))
+                    await self._wait_ack(0)
+                    if self._retry:
+                        self._retry.append(msg)
+                        continue
+                await self._send_header(Msg('end', dict(msg.args)))
+                await self._wait_ack(0)
+                engine._logger.info(
+                    engine._locale('send.thread.exit').format(self._uid),
+                    msg['reason']
+                )
+                break
+            elif msg('split'):
+                await self._send_header(Msg('split', dict(msg.args)))
+            elif msg('single'):
+                await self._send_header(Msg('single', {
+                    "path": msg['path'],
+                    "size": msg['size'],
+                    "mode": engine._data_mode
+                }), msg)
+                hasher = self._new_hash()
+                await self._send_data(msg['file_path'], 0, msg['size'], hasher)
+                await self._send_digest([hasher], [msg['path']], 0)
+            elif msg('bundle'):
+                await self._send_header(Msg('bundle', {
+                    "entries": [entry[1:] for entry in msg['entries']],
+                    "size": msg['size'],
+                    "mode": engine._data_mode
+                }), msg)
+                hashers = []
+                for file_path, _, size in msg['entries']:
+                    hashers.append(self._new_hash())
+                    await self._send_data(file_path, 0, size, hashers[-1])
+                await self._send_digest(
+                    hashers, [entry[1] for entry in msg['entries']], 0
+                )
+            elif msg('block'):
+                await self._send_header(Msg('block', {
+                    "size": msg['size'],
+                    "index": msg['index'],
+                    "sid": msg['sid'],
+                    "front": msg['front'],
+                    "path": msg['path'],
+                    "total": msg['total'],
+                    "cnt": msg['cnt'],
+                    "mode": engine._data_mode
+                }), msg)
+                hasher = self._new_hash()
+                await self._send_data(msg['file_path'], msg['front'], msg['size'], hasher)
+                await self._send_digest([hasher], [msg['path']], msg['index'])
+            if not msg('split'): self._stats.done(msg['size'], task_files(msg))
+            await self._wait_ack(engine._ack_window - 1)
+        self._connection.close()
+
+class AioSender:
+    r'''
+    基于asyncio的发送引擎, 在一个事件循环中运行全部`count`条数据连接,
+    用法与一组`SendThread`相同(`run`/`join`). 文件的打开与读取交给`io_workers`个线程,
+    不需要摘要的流式数据通过`loop.sock_sendfile`发送.
+
+    只支持`aio_send_supported`为真的配置.
+    '''
+    _locale: LangFile
+    _logger: LoggerWrapper
+    _msg_queue: Scheduler
+    _client_addr: tuple[str, int]
+    _count: int
+    _data_mode: str
+    _use_codec: bool
+    _ack_window: int
+    _checksum: str
+    _digest_book: DigestBook
+    _io_workers: int
+    _metrics: Metrics
+    _executor: ThreadPoolExecutor
+    _tasks: asyncio.Queue
+    _thread: Thread
+    failed: list[str]
+    def __init__(self, msg_queue: Scheduler, client_addr: tuple[str, int], count: int,
+                 logger: LoggerWrapper, lang: str, data_mode: str = 'stream',
+                 use_codec: bool = True, ack_window: int = 32,
+                 checksum: str = 'none', digest_book: DigestBook = None,
+                 io_workers: int = 4, metrics: Metrics = None) -> None:
+        self._locale = LangFile({})
+        self._locale.load_from_file(lang)
+        self._logger = logger
+        self._msg_queue = msg_queue
+        self._client_addr = client_addr
+        self._count = count
+        self._data_mode = data_mode
+        self._use_codec = use_codec
+        self._ack_window = ack_window
+        self._checksum = checksum
+        self._digest_book = digest_book
+        self._io_workers = io_workers
+        self._metrics = metrics
+        self.failed = []
+        self._thread = Thread(target=self._run)
+
+    def _conn_stats(self, name: str) -> ConnStats:
+        return ConnStats() if self._metrics is None else self._metrics.conn(name)
+
+    def _feed(self, loop: asyncio.AbstractEventLoop) -> None:
+        r'''
+        把`TaskReleaser`的调度器转接到事件循环内的队列, 收到`count`个`end`后结束.
+        运行在守护线程中, 连接异常退出时不会阻塞事件循环的关闭.
+        '''
+        ends = 0
+        while ends < self._count:
+            msg: Msg = self._msg_queue.get(0)
+            if msg('end'): ends += 1
+            try: asyncio.run_coroutine_threadsafe(self._tasks.put(msg), loop).result()
+            except RuntimeError: return
+
+    async def _main(self) -> None:
+        self._executor = ThreadPoolExecutor(self._io_workers)
+        self._tasks = asyncio.Queue(self._count)
+        self._logger.info(self._locale('send.thread.connect'))
+        try:
+            conns = [_SendConn(self, uid) for uid in range(self._count)]
+            for conn in conns: await conn.connect()
+            Thread(target=self._feed, args=(asyncio.get_running_loop(),), daemon=True).start()
+            await asyncio.gather(*(conn.work() for conn in conns))
+        finally: self._executor.shutdown(False, cancel_futures=True)
+
+    def _run(self) -> None:
+        asyncio.run(self._main())
+
+    def join(self) -> None:
+        self._thread.join()
+
+    def run(self) -> None:
+        self._logger.info(self._locale('send.engine.start').format(self._count))
+        self._thread.start()
+
+class _RecvConn:
+    r'''`AioReceiver`中的一条数据连接, 协议与`RecvThread`相同.'''
+    def __init__(self, engine, uid: int, connection: socket) -> None:
+        self._engine: AioReceiver = engine
+        self._uid = uid
+        self._connection = connection
+        self._connection.setblocking(False)
+        self._packer = Packer(Coder(), 'loose', engine._logger, FRAME_V2)
+        self._buffers = [RecvBuffer(READ_SIZE), RecvBuffer(READ_SIZE)]
+        self._ack_batch = max(1, engine._ack_window // 2)
+        self._ack_seq = 0
+        self._ack_time = monotonic()
+        self._nacks: list[int] = []
+        self._stats = engine._conn_stats(f'AioReceiver{uid}')
+
+    def _new_hash(self) -> Any:
+        checksum = self._engine._checksum
+        return None if checksum == 'none' else new_hash(checksum)
+
+    async def _io(self, func, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._engine._executor, func, *args)
+
+    async def _recv_data(self, file: Any, size: int, mode: str, hasher: Any) -> None:
+        if mode == 'stream':
+            # receive into one buffer while the other one is being written
+            loop = asyncio.get_running_loop()
+            pending = None
+            try:
+                while size > 0:
+                    view = await self._buffers[0].recv_exact_async(
+                        self._connection, min(READ_SIZE, size)
+                    )
+                    if pending is not None: await pending
+                    pending = loop.run_in_executor(
+                        self._engine._executor, _write, file, view, hasher
+                    )
+                    self._buffers.reverse()
+                    size -= len(view)
+                if pending is not None:
+                    await pending
+                    pending = None
+            finally:
+                if pending is not None: await asyncio.wait((pending,))
+            return
+        recv_size = 0
+        while recv_size < size:
+            data = await self._packer.recvPacketAsync(self._connection)
+            if data is None: raise ConnectionError('bad data packet.')
+            await self._io(_write, file, data, hasher)
+            recv_size += len(data)
+
+    async def _verify(self, hashers: list[Any], rel_paths: list[str],
+                      index: int, seq: int) -> bool:
+        engine = self._engine
+        if engine._checksum == 'none': return True
+        trailer = await self._packer.recvPacketAsync(self._connection)
+        digests = [hasher.hexdigest() for hasher in hashers]
+        if not isinstance(trailer, dict) or trailer.get('digest') != digests:
+            self._nacks.append(seq)
+            engine._logger.warn(
+                engine._locale('recv.thread.bad_digest'),
+                make_short_log(rel_paths[0])
+            )
+            return False
+        if engine._digest_book is not None:
+            for rel_path, digest in zip(rel_paths, digests):
+                engine._digest_book.record(rel_path, index, digest)
+        return True
+
+    async def _send_ack(self, seq: int, force: bool = False) -> None:
+        if seq is None: return
+        now = monotonic()
+        if force or self._nacks or seq - self._ack_seq >= self._ack_batch \
+            or now - self._ack_time >= ACK_INTERVAL:
+            ack: dict[str, Any] = {"ack": seq}
+            if self._nacks:
+                ack['nack'] = self._nacks
+                self._nacks = []
+            await _send_frame(self._connection, self._packer.packFrame(ack))
+            self._ack_seq = seq
+            self._ack_time = now
+
+    async def _recv_file(self, rel_path: str, size: int, mode: str, index: int,
+                         seq: int, file_path: str) -> bool:
+        file = await self._io(open_target, file_path, 'wb')
+        hasher = self._new_hash()
+        try: await self._recv_data(file, size, mode, hasher)
+        finally: await self._io(file.close)
+        return await self._verify([hasher], [rel_path], index, seq)
+
+    def _peer_closed(self) -> bool:
+        try: return not self._connection.recv(1, MSG_PEEK)
+        except BlockingIOError: return False
+        except OSError: return True
+
+    async def work(self) -> None:
+        engine = self._engine
+        while True:
+            msg: Msg = Msg.make_msg(await self._packer.recvPacketAsync(self._connection))
+            if msg('bad_package'):
+                engine._logger.warn(engine._locale('recv.thread.bad_package'))
+                if self._peer_closed(): break
+                continue
+            elif msg('end'):
+                await self._send_ack(msg['seq'], True)
+                engine._logger.info(
+                    engine._locale('recv.thread.end').format(self._uid),
+                    msg['reason']
+                )
+                break
+            elif msg('sync'):
+                await self._send_ack(msg['seq'], True)
+                continue
+            elif msg('split'):
+                engine._logger.info(
+                    engine._locale('recv.thread.recv_split'),
+                    make_short_log(engine._apex_path + msg['path'])
+                )
+                if engine._block_writer is None:
+                    engine._msg_queue.put(Msg('split', {
+                        "sid": msg['sid'],
+                        "path": engine._apex_path + msg['path'],
+                        "rel": msg['path'],
+                        "size": msg['size'],
+                        "cnt": msg['cnt']
+                    }))
+            elif msg('block') and engine._block_writer is not None:
+                region = await self._io(
+                    engine._block_writer.open_region, msg['sid'],
+                    engine._apex_path + msg['path'], msg['total'], msg['cnt'], msg['front']
+                )
+                hasher = self._new_hash()
+                await self._recv_data(region, msg['size'], msg['mode'], hasher)
+                if await self._verify([hasher], [msg['path']], msg['index'], msg['seq']):
+                    await self._io(region.close)
+                    if engine._journal is not None:
+                        engine._journal.record_block(
+                            msg['path'], msg['front'], msg['size'],
+                            engine._apex_path + msg['path']
+                        )
+                    engine._logger.tally(engine._locale('recv.thread.recv_blocks'))
+            elif msg('block'):
+                file_path = f"{engine._cache}\\{msg['sid']}_{msg['index']}.block"
+                if await self._recv_file(msg['path'], msg['size'], msg['mode'],
+                                         msg['index'], msg['seq'], file_path):
+                    engine._logger.tally(engine._locale('recv.thread.recv_blocks'))
+                    engine._msg_queue.put(Msg('block_end', {
+                        "sid": msg['sid'],
+                        "index": msg['index'],
+                        "path": file_path
+                    }))
+            elif msg('single'):
+                file_path = engine._apex_path + msg['path']
+                if await self._recv_file(msg['path'], msg['size'], msg['mode'],
+                                         0, msg['seq'], file_path):
+                    if engine._journal is not None:
+                        engine._journal.record_file(msg['path'], msg['size'], file_path)
+                    engine._logger.info(
+                        engine._locale('recv.thread.recv_single'),
+                        make_short_log(file_path)
+                    )
+            elif msg('bundle'):
+                hashers = []
+                for rel_path, size in msg['entries']:
+                    file = await self._io(open_target, engine._apex_path + rel_path, 'wb')
+                    hashers.append(self._new_hash())
+                    try: await self._recv_data(file, size, msg['mode'], hashers[-1])
+                    finally: await self._io(file.close)
+                rel_paths = [entry[0] for entry in msg['entries']]
+                if await self._verify(hashers, rel_paths, 0, msg['seq']):
+                    if engine._journal is not None:
+                        for rel_path, size in msg['entries']:
+                            engine._journal.record_file(
+                                rel_path, size, engine._apex_path + rel_path
+                            )
+                    engine._logger.info(
+                        engine._locale('recv.thread.recv_bundle'),
+                        len(msg['entries'])
+                    )
+            if msg['size'] and not msg('split'):
+                self._stats.done(msg['size'], task_files(msg))
+            await self._send_ack(msg['seq'])
+        self._connection.close()
+
+class AioReceiver:
+    r'''
+    基于asyncio的接收引擎, 在一个事件循环中服务已接受的全部数据连接,
+    用法与一组`RecvThread`相同(`run`/`join`). 文件写入交给`io_workers`个线程.
+
+    只支持`aio_recv_supported`为真的任务.
+    '''
+    _locale: LangFile
+    _logger: LoggerWrapper
+    _msg_queue: Queue
+    _connections: list[socket]
+    _apex_path: str
+    _cache: str
+    _ack_window: int
+    _block_writer: BlockWriter
+    _checksum: str
+    _digest_book: DigestBook
+    _journal: Journal
+    _io_workers: int
+    _metrics: Metrics
+    _executor: ThreadPoolExecutor
+    _thread: Thread
+    def __init__(self, msg_queue: Queue, connections: list[socket],
+                 logger: LoggerWrapper, lang: str, apex_path: str, cache: str,
+                 ack_window: int = 32, block_writer: BlockWriter = None,
+                 checksum: str = 'none', digest_book: DigestBook = None,
+                 journal: Journal = None, io_workers: int = 4,
+                 metrics: Metrics = None) -> None:
+        self._locale = LangFile({})
+        self._locale.load_from_file(lang)
+        self._logger = logger
+        self._msg_queue = msg_queue
+        self._connections = connections
+        self._apex_path = apex_path
+        self._cache = cache.removesuffix('\\')
+        self._ack_window = ack_window
+        self._block_writer = block_writer
+        self._checksum = checksum
+        self._digest_book = digest_book
+        self._journal = journal
+        self._io_workers = io_workers
+        self._metrics = metrics
+        self._thread = Thread(target=self._run)
+
+    def _conn_stats(self, name: str) -> ConnStats:
+        return ConnStats() if self._metrics is None else self._metrics.conn(name)
+
+    async def _main(self) -> None:
+        self._executor = ThreadPoolExecutor(self._io_workers)
+        conns = [
+            _RecvConn(self, uid, connection)
+            for uid, connection in enumerate(self._connections)
+        ]
+        await asyncio.gather(*(conn.work() for conn in conns))
+        self._executor.shutdown()
+
+    def _run(self) -> None:
+        asyncio.run(self._main())
+
+    def join(self) -> None:
+        self._thread.join()
+
+    def run(self) -> None:
+        self._logger.info(self._locale('recv.engine.start').format(len(self._connections)))
+        self._thread.start()
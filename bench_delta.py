@@ -0,0 +1,179 @@
+r'''
+增量传输与完整发送的对比测试: 经127.0.0.1运行`session.py`中发送端与接收端的完整流程.
+
+用法: `python bench_delta.py [大小 ...] [--change 0.01] [--dir 目录]`,
+大小写法与配置文件相同, 例如 `python bench_delta.py 1GB 10GB 50GB`.
+每个大小生成一个随机文件作为接收端的旧版本, 按`--change`比例分散改写并插入少量字节
+作为发送端的新版本, 分别测量完整发送与增量发送(接收端已有旧版本)的耗时,
+以及发送端socket上实际收发的字节数(含帧头、加密器的编码、块签名与确认).
+两次发送均使用`FRAME_V2`与4条连接, 其余取发送端的默认配置.
+'''
+
+from session import SEND_DEFAULTS, RECV_DEFAULTS, scan_task, send_task, recv_task
+from tuner import PeerMemory
+from config import JsonFileConfig, LangFile
+from tool import size_to_byte
+from bench_engine import QuietLogger
+from threading import Thread, Lock
+from time import perf_counter
+from random import Random
+from hashlib import blake2b
+import os, sys, socket, shutil, tempfile, session, thread
+
+_CHUNK = 67108864
+_LANG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Locales', 'zh_CN.json')
+
+class CountingSocket(socket.socket):
+    r'''发送端使用的socket, 统计实际写入与读出的字节数(含帧头、加密器与确认).'''
+    _lock = Lock()
+    sent = 0
+    received = 0
+
+    @classmethod
+    def _count(cls, sent: int, received: int) -> None:
+        with cls._lock:
+            cls.sent += sent
+            cls.received += received
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock: cls.sent = cls.received = 0
+
+    def send(self, data, flags: int = 0) -> int:
+        size = super().send(data, flags)
+        self._count(size, 0)
+        return size
+
+    def sendall(self, data, flags: int = 0) -> None:
+        super().sendall(data, flags)
+        self._count(memoryview(data).nbytes, 0)
+
+    def sendfile(self, file, offset: int = 0, count: int = None) -> int:
+        size = super().sendfile(file, offset, count)
+        self._count(size, 0)
+        return size
+
+    def recv(self, bufsize: int, flags: int = 0) -> bytes:
+        data = super().recv(bufsize, flags)
+        if not flags & socket.MSG_PEEK: self._count(0, len(data))
+        return data
+
+    def recv_into(self, buffer, nbytes: int = 0, flags: int = 0) -> int:
+        size = super().recv_into(buffer, nbytes, flags)
+        if not flags & socket.MSG_PEEK: self._count(0, size)
+        return size
+
+# the sender opens its info and data connections through these modules
+session.socket = CountingSocket
+thread.socket = CountingSocket
+
+def make_pair(dir_path: str, size: int, change: float, rnd: Random) -> tuple[str, str]:
+    old_path = os.path.join(dir_path, 'old.bin')
+    new_path = os.path.join(dir_path, 'new.bin')
+    with open(old_path, 'wb') as old, open(new_path, 'wb') as new:
+        left = size
+        while left > 0:
+            data = bytearray(rnd.randbytes(min(_CHUNK, left)))
+            old.write(data)
+            # rewrite `change` of each chunk in 4KB pieces, plus one small insertion
+            for _ in range(int(len(data) * change) // 4096):
+                pos = rnd.randrange(0, max(1, len(data) - 4096))
+                data[pos: pos + 4096] = rnd.randbytes(4096)
+            if change > 0:
+                pos = rnd.randrange(0, len(data))
+                data[pos: pos] = rnd.randbytes(rnd.randint(1, 4096))
+            new.write(data)
+            left -= _CHUNK
+    return old_path, new_path
+
+def file_digest(file_path: str) -> bytes:
+    hasher = blake2b()
+    with open(file_path, 'rb') as file:
+        while data := file.read(_CHUNK): hasher.update(data)
+    return hasher.digest()
+
+def run_transfer(src_dir: str, work_dir: str, delta: bool) -> tuple[float, int]:
+    r'''
+    经`session.py`的发送与接收流程把`src_dir`发送到`work_dir`下的`dst`,
+    返回耗时与发送端socket上双向的字节数.
+    '''
+    logger = QuietLogger()
+    locale = LangFile({})
+    locale.load_from_file(_LANG)
+    send_config = JsonFileConfig({
+        **SEND_DEFAULTS,
+        "lang_file": _LANG,
+        "stats_file": os.path.join(work_dir, 'send_stats.json'),
+        "framing": 2,
+        "auto_tune": False,
+        "thread_count": 4,
+        "resume": False,
+        "delta": delta,
+        "delta_min": '1B'
+    })
+    recv_config = JsonFileConfig({
+        **RECV_DEFAULTS,
+        "lang_file": _LANG,
+        "stats_file": os.path.join(work_dir, 'recv_stats.json'),
+        "block_cache": os.path.join(work_dir, 'cache'),
+        "journal_dir": os.path.join(work_dir, 'journal')
+    })
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(send_config['thread_count'] + 1)
+    def receive() -> None:
+        info_exchange, _ = server.accept()
+        recv_task(
+            recv_config, info_exchange, server, os.path.join(work_dir, 'dst'),
+            logger, locale
+        )
+    CountingSocket.reset()
+    start = perf_counter()
+    receiver = Thread(target=receive)
+    receiver.start()
+    task_config = scan_task(send_config, src_dir, logger, locale)
+    send_task(
+        send_config, task_config, server.getsockname(), logger, locale,
+        PeerMemory(os.path.join(work_dir, 'peers.json'))
+    )
+    receiver.join()
+    cost = perf_counter() - start
+    server.close()
+    return cost, CountingSocket.sent + CountingSocket.received
+
+def main(args: list[str]) -> None:
+    sizes: list[str] = []
+    change = 0.01
+    dir_path = None
+    while args:
+        arg = args.pop(0)
+        if arg == '--change': change = float(args.pop(0))
+        elif arg == '--dir': dir_path = args.pop(0)
+        else: sizes.append(arg)
+    if not sizes: sizes = ['256MB']
+    if dir_path is not None: os.makedirs(dir_path, exist_ok=True)
+    rnd = Random(15)
+    for size_str in sizes:
+        with tempfile.TemporaryDirectory(dir=dir_path) as temp_dir:
+            size = size_to_byte(size_str)
+            src_dir = os.path.join(temp_dir, 'src')
+            dst_dir = os.path.join(temp_dir, 'dst', 'src')
+            os.makedirs(src_dir)
+            os.makedirs(dst_dir)
+            old_path, new_path = make_pair(temp_dir, size, change, rnd)
+            shutil.move(new_path, os.path.join(src_dir, 'data.bin'))
+            out_path = os.path.join(dst_dir, 'data.bin')
+            expect = file_digest(os.path.join(src_dir, 'data.bin'))
+            full_time, full_wire = run_transfer(src_dir, temp_dir, False)
+            assert file_digest(out_path) == expect
+            ## the receiver holds the old version as the delta basis
+            shutil.copyfile(old_path, out_path)
+            delta_time, delta_wire = run_transfer(src_dir, temp_dir, True)
+            assert file_digest(out_path) == expect
+            print(f'{size_str:>8} change {change:.2%}  '
+                  f'full {full_time:8.2f}s {full_wire / 1048576:10.1f}MB  '
+                  f'delta {delta_time:8.2f}s {delta_wire / 1048576:10.1f}MB  '
+                  f'wire saved {1 - delta_wire / max(1, full_wire):.1%}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,138 @@
+r'''
+线程引擎与异步引擎的对比测试, 收发两端在同一进程内经本机回环连接.
+
+用法: `python bench_engine.py [总大小] [--files 256] [--conns 4,24,128]
+[--checksum none] [--dir 目录]`, 大小写法与配置文件相同.
+生成`--files`个等大的随机文件, 对每个连接数分别用两种引擎各发送一次,
+输出吞吐量(MB/s)与每GB消耗的CPU时间(收发两端之和, 由`process_time`测得).
+'''
+
+from tcp import *
+from task import Msg
+from scheduler import Scheduler
+from thread import SendThread, RecvThread
+from aio import AioSender, AioReceiver
+from logger import LoggerWrapper, LoggerPacket
+from tool import size_to_byte
+from threading import Thread
+from queue import Queue
+from time import perf_counter, process_time
+from socket import socket, AF_INET, SOCK_STREAM
+from hashlib import blake2b
+import os, sys, tempfile
+
+_LANG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Locales', 'zh_CN.json')
+_CHUNK = 16777216
+
+class QuietLogger(LoggerWrapper):
+    r'''丢弃全部日志, 避免日志输出影响测量结果.'''
+    def __init__(self) -> None:
+        super().__init__('bench', None)
+
+    def pushLog(self, logs_pack: LoggerPacket) -> None:
+        pass
+
+    def getWrapperInstance(self, phase_name: str):
+        return self
+
+def make_files(dir_path: str, total: int, count: int) -> list[tuple[str, int]]:
+    size = total // count
+    files = []
+    for index in range(count):
+        file_path = os.path.join(dir_path, f'f{index}.bin')
+        with open(file_path, 'wb') as file:
+            left = size
+            while left > 0:
+                file.write(os.urandom(min(_CHUNK, left)))
+                left -= _CHUNK
+        files.append((file_path, size))
+    return files
+
+def tree_digest(files: list[str]) -> bytes:
+    hasher = blake2b()
+    for file_path in files:
+        with open(file_path, 'rb') as file:
+            while data := file.read(_CHUNK): hasher.update(data)
+    return hasher.digest()
+
+def run_once(engine: str, files: list[tuple[str, int]], out_dir: str,
+             conns: int, checksum: str) -> tuple[float, float]:
+    logger = QuietLogger()
+    server = socket(AF_INET, SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(conns)
+    addr = server.getsockname()
+    tasks = Scheduler(len(files))
+    for file_path, size in files:
+        tasks.put(Msg('single', {
+            "file_path": file_path,
+            "path": '/' + os.path.basename(file_path),
+            "size": size
+        }))
+    tasks.close(Msg('end', {"reason": 'bench'}))
+
+    connections = []
+    def accept() -> None:
+        for _ in range(conns): connections.append(server.accept()[0])
+
+    start_wall, start_cpu = perf_counter(), process_time()
+    acceptor = Thread(target=accept)
+    acceptor.start()
+    if engine == 'asyncio':
+        senders = [AioSender(tasks, addr, conns, logger, _LANG, 'stream',
+                             True, 32, checksum)]
+        for t in senders: t.run()
+        acceptor.join()
+        receivers = [AioReceiver(Queue(), connections, logger, _LANG, out_dir,
+                                 out_dir, 32, None, checksum)]
+    else:
+        senders = [SendThread(tasks, addr, uid, logger, _LANG, 'stream',
+                              FRAME_V2, True, 32, None, checksum)
+                   for uid in range(conns)]
+        acceptor.join()
+        receivers = [RecvThread(Queue(), connection, uid, logger, _LANG, out_dir,
+                                out_dir, FRAME_V2, 32, None, checksum)
+                     for uid, connection in enumerate(connections)]
+        for t in senders: t.run()
+    for t in receivers: t.run()
+    for t in senders: t.join()
+    for t in receivers: t.join()
+    server.close()
+    return perf_counter() - start_wall, process_time() - start_cpu
+
+def main(args: list[str]) -> None:
+    total_str = '1GB'
+    count = 256
+    conn_counts = [4, 24, 128]
+    checksum = 'none'
+    dir_path = None
+    while args:
+        arg = args.pop(0)
+        if arg == '--files': count = int(args.pop(0))
+        elif arg == '--conns': conn_counts = [int(x) for x in args.pop(0).split(',')]
+        elif arg == '--checksum': checksum = args.pop(0)
+        elif arg == '--dir': dir_path = args.pop(0)
+        else: total_str = arg
+    total = size_to_byte(total_str)
+    if dir_path is not None: os.makedirs(dir_path, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=dir_path) as temp_dir:
+        src_dir = os.path.join(temp_dir, 'src')
+        os.makedirs(src_dir)
+        files = make_files(src_dir, total, count)
+        expect = tree_digest([file_path for file_path, _ in files])
+        sent = sum(size for _, size in files)
+        for conns in conn_counts:
+            for engine in ('thread', 'asyncio'):
+                out_dir = os.path.join(temp_dir, f'{engine}_{conns}')
+                os.makedirs(out_dir)
+                wall, cpu = run_once(engine, files, out_dir, conns, checksum)
+                received = [os.path.join(out_dir, os.path.basename(file_path))
+                            for file_path, _ in files]
+                assert tree_digest(received) == expect
+                for file_path in received: os.remove(file_path)
+                print(f'{engine:>8} {conns:>4} conns  '
+                      f'{sent / 1048576 / wall:9.1f} MB/s  '
+                      f'{cpu / (sent / 1073741824):7.2f} CPU s/GB')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,308 @@
+r'''
+端到端回环测试: 不经过广播与输入, 在同一进程内经127.0.0.1运行`session.py`中
+发送端与接收端的完整流程(`scan_task`、`send_task`、`recv_task`), 与`Thrower.py`/`Catcher.py`相同.
+
+用法: `python bench_loopback.py [--datasets small,large,mixed] [--threads 4,24,auto]
+[--split adaptive,16MB] [--scale 1.0] [--repeat 1] [--set 键=值] [--dir 目录]
+[--out 结果.jsonl] [--verify]`, 以及`python bench_loopback.py --compare 旧.jsonl 新.jsonl`.
+
+数据集由固定种子生成, 参数相同时文件树完全相同, 生成后保存在`--dir`下供之后的运行复用:
+- `small`: 100000个4KB文件, 每个文件夹1000个
+- `large`: 4个10GB文件
+- `mixed`: 常见项目目录的形状: 大量大小呈对数正态分布的小文件(一半为文本)、
+  少量1MB~64MB的文件、3个1GB的文件、空文件与空文件夹
+
+`--scale`按比例缩减小文件的个数与大文件的大小, 用于快速试跑. `--split`中的`adaptive`
+使用自适应分块, 其余取值为固定的`split_limit`; `--threads`中的`auto`使用连接数自动调优;
+其余配置取两端的默认值, `--set`覆盖发送配置, 如`--set checksum=blake2b`.
+默认的`framing`为1(旧版协议), 以`--set framing=2`启用流式发送、窗口确认等新协议的功能.
+
+每个配置在单独的子进程中运行, 以分别测得CPU时间(收发两端之和)与峰值RSS.
+每次运行向`--out`追加一行JSON, `--compare`按数据集与配置对比两份结果的平均值.
+'''
+
+from session import SEND_DEFAULTS, RECV_DEFAULTS, scan_task, send_task, recv_task
+from tuner import PeerMemory
+from config import JsonFileConfig, LangFile
+from tool import size_to_byte
+from bench_engine import QuietLogger, tree_digest
+from threading import Thread
+from time import perf_counter, process_time, strftime, localtime
+from socket import socket, AF_INET, SOCK_STREAM
+from random import Random
+from typing import Any
+import os, sys, json, math, shutil, subprocess, platform
+
+_LANG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Locales', 'zh_CN.json')
+_CHUNK = 16777216
+_WORDS = [
+    'import', 'return', 'self', 'value', 'config', 'thread', 'data', 'file',
+    'path', 'error', 'None', 'True', 'for', 'in', 'if', 'else', 'def', 'class'
+]
+
+def plan_small(scale: float) -> tuple[list[tuple[str, int]], list[str]]:
+    count = max(1, round(100000 * scale))
+    return [(os.path.join(f'd{index // 1000:03d}', f'f{index:06d}.bin'), 4096)
+            for index in range(count)], []
+
+def plan_large(scale: float) -> tuple[list[tuple[str, int]], list[str]]:
+    size = max(1, round(10 * 1073741824 * scale))
+    return [(f'large{index}.bin', size) for index in range(4)], []
+
+def plan_mixed(scale: float) -> tuple[list[tuple[str, int]], list[str]]:
+    rnd = Random(3)
+    folders = ['']
+    for index in range(max(4, round(400 * scale))):
+        parent = rnd.choice(folders[-50:]) if rnd.random() < 0.7 else rnd.choice(folders)
+        folders.append(os.path.join(parent, f'dir{index}'))
+    files: list[tuple[str, int]] = []
+    for index in range(max(1, round(20000 * scale))):
+        size = 0 if rnd.random() < 0.01 else min(1048576, int(rnd.lognormvariate(math.log(8192), 1.5)))
+        suffix = '.txt' if index % 2 else '.bin'
+        files.append((os.path.join(rnd.choice(folders), f's{index}{suffix}'), size))
+    for index in range(max(1, round(200 * scale))):
+        files.append((os.path.join(rnd.choice(folders), f'm{index}.bin'),
+                      rnd.randint(1048576, 67108864)))
+    for index in range(3):
+        files.append((os.path.join(rnd.choice(folders), f'l{index}.bin'),
+                      max(1, round(1073741824 * scale))))
+    empty = [os.path.join(rnd.choice(folders), f'empty{index}')
+             for index in range(max(1, round(50 * scale)))]
+    return files, empty
+
+DATASETS = {"small": plan_small, "large": plan_large, "mixed": plan_mixed}
+
+def _write_file(file_path: str, size: int, seed: int) -> None:
+    rnd = Random(seed)
+    text = file_path.endswith('.txt')
+    with open(file_path, 'wb') as file:
+        left = size
+        while left > 0:
+            step = min(_CHUNK, left)
+            if text:
+                data = ' '.join(rnd.choices(_WORDS, k=step // 4 + 1)).encode()[:step]
+            else: data = rnd.randbytes(step)
+            file.write(data)
+            left -= step
+
+def make_dataset(root_dir: str, name: str, scale: float) -> tuple[str, list[tuple[str, int]]]:
+    r'''生成(或复用已生成的)数据集, 返回数据集的文件夹与`(相对路径, 大小)`列表.'''
+    files, empty = DATASETS[name](scale)
+    src_dir = os.path.join(root_dir, f'{name}_{scale:g}')
+    mark_path = src_dir + '.json'
+    mark = {"files": len(files), "bytes": sum(size for _, size in files)}
+    if os.path.exists(mark_path):
+        with open(mark_path, 'r', encoding='utf-8') as file:
+            if json.load(file) == mark: return src_dir, files
+    shutil.rmtree(src_dir, ignore_errors=True)
+    for dir_path in empty: os.makedirs(os.path.join(src_dir, dir_path), exist_ok=True)
+    for index, (rel_path, size) in enumerate(files):
+        file_path = os.path.join(src_dir, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        _write_file(file_path, size, index)
+    with open(mark_path, 'w', encoding='utf-8') as file: json.dump(mark, file)
+    return src_dir, files
+
+def peak_rss() -> int:
+    r'''本进程的峰值常驻内存(B).'''
+    try: import resource
+    except ImportError:
+        import ctypes
+        from ctypes import wintypes
+        class _Counters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+                (field, ctypes.c_size_t) for field in (
+                    'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                    'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                    'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage'
+                )
+            ]
+        counters = _Counters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+        )
+        return counters.PeakWorkingSetSize
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def run_once(src_dir: str, work_dir: str, threads: str, split: str,
+             overrides: dict[str, Any]) -> dict[str, Any]:
+    r'''
+    经`session.py`中发送端与接收端的流程完整发送一次`src_dir`, 返回耗时、CPU时间与峰值内存.
+    `threads`为`auto`时使用自动调优, 否则固定连接数.
+    '''
+    logger = QuietLogger()
+    locale = LangFile({})
+    locale.load_from_file(_LANG)
+    save_folder = os.path.join(work_dir, 'dst')
+    os.makedirs(save_folder)
+    ## run files stay in work_dir, the tuned count is not carried between runs
+    send_config = JsonFileConfig({
+        **SEND_DEFAULTS, **overrides,
+        "lang_file": _LANG,
+        "stats_file": os.path.join(work_dir, 'send_stats.json')
+    })
+    if threads == 'auto': send_config['auto_tune'] = True
+    else: send_config.data_field.update(auto_tune=False, thread_count=int(threads))
+    if split == 'adaptive': send_config['split_policy'] = 'adaptive'
+    else: send_config.data_field.update(split_policy='fixed', split_limit=split)
+    recv_config = JsonFileConfig({
+        **RECV_DEFAULTS,
+        "lang_file": _LANG,
+        "stats_file": os.path.join(work_dir, 'recv_stats.json'),
+        "block_cache": os.path.join(work_dir, 'cache'),
+        "journal_dir": os.path.join(work_dir, 'journal')
+    })
+
+    server = socket(AF_INET, SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(send_config['thread_max'] + 1)
+    client_addr = server.getsockname()
+    def receive() -> None:
+        info_exchange, _ = server.accept()
+        recv_task(recv_config, info_exchange, server, save_folder, logger, locale)
+    receiver = Thread(target=receive)
+    receiver.start()
+
+    start_wall, start_cpu = perf_counter(), process_time()
+    task_config = scan_task(send_config, src_dir, logger, locale)
+    scan_time = perf_counter() - start_wall
+    send_task(
+        send_config, task_config, client_addr, logger, locale,
+        PeerMemory(os.path.join(work_dir, 'peers.json'))
+    )
+    receiver.join()
+    wall, cpu = perf_counter() - start_wall, process_time() - start_cpu
+    server.close()
+    ## a streamed scan only knows its totals once it is done
+    if task_config['file_count'] is None:
+        tree_scan = task_config['file_entry']
+        task_config['file_count'] = tree_scan.file_count
+        task_config['total_size'] = tree_scan.total_size
+    return {
+        "files": task_config['file_count'],
+        "bytes": task_config['total_size'],
+        "wall": wall,
+        "scan": scan_time,
+        "cpu": cpu,
+        "peak_rss": peak_rss()
+    }
+
+def check_copy(src_dir: str, dst_dir: str, files: list[tuple[str, int]], verify: bool) -> bool:
+    r'''核对文件数与大小, `verify`为真时再比较全部内容的摘要.'''
+    for rel_path, size in files:
+        dst_path = os.path.join(dst_dir, rel_path)
+        if not os.path.isfile(dst_path) or os.path.getsize(dst_path) != size: return False
+    if not verify: return True
+    return tree_digest([os.path.join(src_dir, rel_path) for rel_path, _ in files]) == \
+        tree_digest([os.path.join(dst_dir, rel_path) for rel_path, _ in files])
+
+def _key(record: dict[str, Any]) -> tuple:
+    return (record['dataset'], record['scale'], record['threads'], record['split'],
+            json.dumps(record['set'], sort_keys=True))
+
+def _load(file_path: str) -> dict[tuple, dict[str, float]]:
+    r'''读取结果文件, 按配置对各指标取平均.'''
+    groups: dict[tuple, list[dict[str, Any]]] = {}
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                groups.setdefault(_key(record), []).append(record)
+    return {
+        key: {field: sum(r[field] for r in records) / len(records)
+              for field in ('mb_s', 'files_s', 'cpu', 'peak_rss')}
+        for key, records in groups.items()
+    }
+
+def compare(old_path: str, new_path: str) -> None:
+    old, new = _load(old_path), _load(new_path)
+    for key in sorted(old.keys() & new.keys()):
+        dataset, scale, threads, split, overrides = key
+        before, after = old[key], new[key]
+        change = (after['mb_s'] / before['mb_s'] - 1) * 100 if before['mb_s'] else 0.0
+        print(f'{dataset:>6} x{scale:<5g} {threads:>4} conns {split:>8} {overrides}  '
+              f'{before["mb_s"]:8.1f} -> {after["mb_s"]:8.1f} MB/s ({change:+.1f}%)  '
+              f'{before["cpu"]:7.1f} -> {after["cpu"]:7.1f} CPU s  '
+              f'{before["peak_rss"] / 1048576:6.0f} -> {after["peak_rss"] / 1048576:6.0f} MB RSS')
+
+def _parse_value(text: str) -> Any:
+    try: return json.loads(text)
+    except json.JSONDecodeError: return text
+
+def main(args: list[str]) -> None:
+    if args[:1] == ['--compare']:
+        compare(args[1], args[2])
+        return
+    if args[:1] == ['--run']:
+        # child process: one configuration, the result goes to stdout
+        _, src_dir, work_dir, threads, split, overrides = args
+        print(json.dumps(run_once(src_dir, work_dir, threads, split, json.loads(overrides))))
+        return
+    datasets = ['small', 'large', 'mixed']
+    thread_counts = ['4', '24']
+    splits = ['adaptive', '16MB']
+    scale = 1.0
+    repeat = 1
+    overrides: dict[str, Any] = {}
+    root_dir = os.path.join('.', 'Bench')
+    out_path = os.path.join('.', 'Logs', 'bench_loopback.jsonl')
+    verify = False
+    while args:
+        arg = args.pop(0)
+        if arg == '--datasets': datasets = args.pop(0).split(',')
+        elif arg == '--threads': thread_counts = args.pop(0).split(',')
+        elif arg == '--split': splits = args.pop(0).split(',')
+        elif arg == '--scale': scale = float(args.pop(0))
+        elif arg == '--repeat': repeat = int(args.pop(0))
+        elif arg == '--set':
+            key, _, value = args.pop(0).partition('=')
+            overrides[key] = _parse_value(value)
+        elif arg == '--dir': root_dir = args.pop(0)
+        elif arg == '--out': out_path = args.pop(0)
+        elif arg == '--verify': verify = True
+    for split in splits:
+        if split != 'adaptive': size_to_byte(split)
+    for threads in thread_counts:
+        if threads != 'auto': int(threads)
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    for dataset in datasets:
+        src_dir, files = make_dataset(root_dir, dataset, scale)
+        for threads in thread_counts:
+            for split in splits:
+                for _ in range(repeat):
+                    work_dir = os.path.join(root_dir, 'run')
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                    child = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), '--run', src_dir,
+                         work_dir, threads, split, json.dumps(overrides)],
+                        stdout=subprocess.PIPE, check=True, text=True
+                    )
+                    result = json.loads(child.stdout.strip().splitlines()[-1])
+                    dst_dir = os.path.join(work_dir, 'dst', os.path.basename(src_dir))
+                    if not check_copy(src_dir, dst_dir, files, verify):
+                        raise RuntimeError(f'{dataset}: received tree differs from the source')
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                    record = {
+                        "time": strftime('%Y-%m-%d %H:%M:%S', localtime()),
+                        "host": platform.node(),
+                        "python": platform.python_version(),
+                        "dataset": dataset,
+                        "scale": scale,
+                        "threads": threads if threads == 'auto' else int(threads),
+                        "split": split,
+                        "set": overrides,
+                        **result,
+                        "mb_s": result['bytes'] / 1048576 / result['wall'],
+                        "files_s": result['files'] / result['wall']
+                    }
+                    with open(out_path, 'a', encoding='utf-8') as file:
+                        file.write(json.dumps(record) + '\n')
+                    print(f'{dataset:>6} {threads:>4} conns {split:>8}  '
+                          f'{record["mb_s"]:9.1f} MB/s  {record["files_s"]:9.0f} files/s  '
+                          f'{result["cpu"]:7.1f} CPU s  '
+                          f'{result["peak_rss"] / 1048576:6.0f} MB RSS')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
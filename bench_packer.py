@@ -0,0 +1,207 @@
+r'''
+`Packer`与`Coder`的单帧开销测试.
+
+用法: `python bench_packer.py [--sizes 64B,1KB,4KB,16KB,64KB,1MB] [--bytes 64MB]
+[--framing 1,2] [--modes json,pickle,raw] [--codecs base64,none] [--compress none,zlib,lzma,bz2]
+[--tcp] [--out 结果.jsonl]`.
+
+对每种分帧版本、序列化方式(`SM_*`)、加密器(`base64`为默认的`Coder`,
+`none`对应配置中的`packet_codec: false`, 仅`FRAME_V2`可用)、压缩方式与包体大小:
+- 在`socketpair`(`--tcp`时为本机回环TCP连接)上由一个线程连续`sendPacket`, 另一线程`recvPacket`,
+  测得每秒帧数与包体吞吐量(MB/s), 每种组合发送约`--bytes`字节(至少1000帧, 至多50000帧)
+- 在内存中的模拟连接上单线程收发, 统计每帧的socket调用次数(`sendall`/`recv_into`,
+  每次至少一个系统调用; 模拟连接总能一次交付所需的字节, 接收端为下限)
+  与`tracemalloc`测得的每帧临时内存峰值, 以包体的倍数表示复制的次数
+
+压缩方式(`CM_*`)仅用于`FRAME_V2`的`raw`包体: 包体为可压缩的文本, 发送前以等级1压缩一次
+(与`CompressPolicy`相同, 压缩耗时不计入), 接收端由`Packer`解压; 吞吐量与内存倍数按压缩前的大小计.
+
+大小不带单位时按字节计. `FRAME_V1`包体(编码后)须小于64KiB, 超出的组合跳过. `--out`时每个组合追加一行JSON.
+'''
+
+from tcp import *
+from tool import size_to_byte
+from codec import CompressPolicy, CompressStats
+from threading import Thread
+from time import perf_counter
+from socket import socket, socketpair, AF_INET, SOCK_STREAM
+from typing import Any
+from random import Random
+import os, sys, json, tracemalloc
+
+SM_NAMES = {"json": SM_JSON, "pickle": SM_PICKLE, "raw": SM_RAW}
+CM_NAMES = {"none": CM_NONE, "zlib": CM_ZLIB, "lzma": CM_LZMA, "bz2": CM_BZ2}
+_WORDS = [b'import', b'return', b'self', b'value', b'config', b'thread', b'data', b'file']
+MIN_FRAMES = 1000
+MAX_FRAMES = 50000
+TRACE_FRAMES = 50
+
+class MemorySocket:
+    r'''只实现`Packer`用到的`sendall`与`recv_into`, 记录调用次数, 发送的数据原样留待接收.'''
+    def __init__(self) -> None:
+        self.sent: list[bytes] = []
+        self.send_calls = 0
+        self.recv_calls = 0
+        self._data = memoryview(b'')
+        self._pointer = 0
+
+    def sendall(self, data: bytes) -> None:
+        self.send_calls += 1
+        self.sent.append(data)
+
+    def load(self) -> None:
+        r'''把已发送的数据转为待接收的数据.'''
+        self._data = memoryview(b''.join(self.sent))
+        self._pointer = 0
+        self.sent.clear()
+
+    def recv_into(self, buffer: memoryview, nbytes: int = 0) -> int:
+        self.recv_calls += 1
+        size = min(nbytes or len(buffer), len(self._data) - self._pointer)
+        buffer[:size] = self._data[self._pointer: self._pointer + size]
+        self._pointer += size
+        return size
+
+def parse_size(text: str) -> int:
+    r'''同`size_to_byte`, 但不带单位的数字按字节计.'''
+    return int(text) if text.isdigit() else size_to_byte(text)
+
+def make_object(mode: int, size: int) -> Any:
+    if mode == SM_RAW: return os.urandom(size)
+    return {"type": 'bench', "data": 'x' * size}
+
+def make_compressed(method: str, size: int) -> bytes:
+    r'''生成`size`字节的文本并以`method`压缩.'''
+    text = b' '.join(Random(size).choices(_WORDS, k=size // 5 + 1))[:size]
+    packed, _ = CompressPolicy(method, 1, float('inf')).compress(text, CompressStats())
+    return packed
+
+def fits_v1(obj: Any, mode: int) -> bool:
+    packer = Packer(Coder(), 'strict')
+    return len(Coder().encrypt(packer._serialize(obj, mode))) < 65536
+
+def _connect(tcp: bool) -> tuple[socket, socket]:
+    if not tcp: return socketpair()
+    server = socket(AF_INET, SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket(AF_INET, SOCK_STREAM)
+    client.connect(server.getsockname())
+    peer, _ = server.accept()
+    server.close()
+    return client, peer
+
+def measure_rate(framing: int, mode: int, use_codec: bool, obj: Any,
+                 frames: int, tcp: bool, compressed: int = CM_NONE) -> float:
+    r'''在真实连接上收发`frames`帧, 返回耗时(秒).'''
+    sender, receiver = _connect(tcp)
+    send_packer = Packer(Coder(), 'strict', None, framing, use_codec)
+    recv_packer = Packer(Coder(), 'strict', None, framing, use_codec)
+
+    def send() -> None:
+        for _ in range(frames): send_packer.sendPacket(sender, obj, None, mode, compressed)
+
+    start = perf_counter()
+    send_thread = Thread(target=send)
+    send_thread.start()
+    for _ in range(frames): recv_packer.recvPacket(receiver, None, mode)
+    elapsed = perf_counter() - start
+    send_thread.join()
+    sender.close()
+    receiver.close()
+    return elapsed
+
+def measure_overhead(framing: int, mode: int, use_codec: bool, obj: Any,
+                     compressed: int = CM_NONE) -> dict[str, float]:
+    r'''单线程经`MemorySocket`收发, 返回每帧的socket调用次数与临时内存峰值(B).'''
+    client = MemorySocket()
+    send_packer = Packer(Coder(), 'strict', None, framing, use_codec)
+    recv_packer = Packer(Coder(), 'strict', None, framing, use_codec)
+    # grow the receive buffer before measuring
+    send_packer.sendPacket(client, obj, None, mode, compressed)
+    client.load()
+    recv_packer.recvPacket(client, None, mode)
+    client.send_calls = client.recv_calls = 0
+    send_peak = recv_peak = 0
+    tracemalloc.start()
+    for _ in range(TRACE_FRAMES):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        send_packer.sendPacket(client, obj, None, mode, compressed)
+        send_peak += tracemalloc.get_traced_memory()[1] - base
+        client.load()
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        recv_packer.recvPacket(client, None, mode)
+        recv_peak += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {
+        "send_calls": client.send_calls / TRACE_FRAMES,
+        "recv_calls": client.recv_calls / TRACE_FRAMES,
+        "send_alloc": send_peak / TRACE_FRAMES,
+        "recv_alloc": recv_peak / TRACE_FRAMES
+    }
+
+def main(args: list[str]) -> None:
+    sizes = [64, 1024, 4096, 16384, 65536, 1048576]
+    volume = size_to_byte('64MB')
+    framings = [FRAME_V1, FRAME_V2]
+    modes = ['json', 'pickle', 'raw']
+    codecs = ['base64', 'none']
+    methods = ['none', 'zlib', 'lzma', 'bz2']
+    tcp = False
+    out_path = None
+    while args:
+        arg = args.pop(0)
+        if arg == '--sizes': sizes = [parse_size(x) for x in args.pop(0).split(',')]
+        elif arg == '--bytes': volume = parse_size(args.pop(0))
+        elif arg == '--framing': framings = [int(x) for x in args.pop(0).split(',')]
+        elif arg == '--modes': modes = args.pop(0).split(',')
+        elif arg == '--codecs': codecs = args.pop(0).split(',')
+        elif arg == '--compress': methods = args.pop(0).split(',')
+        elif arg == '--tcp': tcp = True
+        elif arg == '--out': out_path = args.pop(0)
+    print(f'{"frame":>5} {"mode":>6} {"codec":>6} {"cm":>5} {"size":>8}  {"frames/s":>10} {"MB/s":>9}  '
+          f'{"send/recv calls":>15}  {"send/recv alloc KB (x size)":>30}')
+    for framing in framings:
+        for codec in codecs:
+            use_codec = codec == 'base64'
+            if framing == FRAME_V1 and not use_codec: continue
+            for mode_name in modes:
+                mode = SM_NAMES[mode_name]
+                for method in methods:
+                    compressed = CM_NAMES[method]
+                    ## the compressed flag only exists in FRAME_V2 and marks raw bytes
+                    if compressed != CM_NONE and (framing != FRAME_V2 or mode != SM_RAW): continue
+                    for size in sizes:
+                        if compressed == CM_NONE: obj = make_object(mode, size)
+                        else: obj = make_compressed(method, size)
+                        if framing == FRAME_V1 and not fits_v1(obj, mode): continue
+                        frames = max(MIN_FRAMES, min(MAX_FRAMES, volume // max(1, size)))
+                        elapsed = measure_rate(framing, mode, use_codec, obj, frames, tcp, compressed)
+                        overhead = measure_overhead(framing, mode, use_codec, obj, compressed)
+                        record = {
+                            "framing": framing,
+                            "mode": mode_name,
+                            "codec": codec,
+                            "compress": method,
+                            "size": size,
+                            "wire_size": len(obj) if mode == SM_RAW else size,
+                            "tcp": tcp,
+                            "frames": frames,
+                            "frames_s": frames / elapsed,
+                            "mb_s": frames * size / 1048576 / elapsed,
+                            **overhead
+                        }
+                        if out_path is not None:
+                            with open(out_path, 'a', encoding='utf-8') as file:
+                                file.write(json.dumps(record) + '\n')
+                        calls = f'{overhead["send_calls"]:.1f} / {overhead["recv_calls"]:.1f}'
+                        allocs = (f'{overhead["send_alloc"] / 1024:.1f} ({overhead["send_alloc"] / size:.1f})'
+                                  f' / {overhead["recv_alloc"] / 1024:.1f} ({overhead["recv_alloc"] / size:.1f})')
+                        print(f'{"V" + str(framing):>5} {mode_name:>6} {codec:>6} {method:>5} {size:>8}  '
+                              f'{record["frames_s"]:10.0f} {record["mb_s"]:9.1f}  '
+                              f'{calls:>15}  {allocs:>30}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
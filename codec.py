@@ -0,0 +1,94 @@
+from os import path
+from time import thread_time
+from threading import Lock
+from typing import Callable
+from zlib import compress as _zcompress
+from bz2 import compress as _bz2compress
+try: from lzma import compress as _lzmacompress
+except ImportError: _lzmacompress = None
+from tcp import CM_NONE, CM_ZLIB, CM_LZMA, CM_BZ2
+
+__all__ = ['COMPRESSED_EXTS', 'CompressStats', 'CompressPolicy']
+
+COMPRESSED_EXTS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lz4', '.zst', '.7z', '.rar', '.cab',
+    '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm', '.wmv', '.flv'
+}
+
+class CompressStats:
+    r'''
+    单个发送线程的压缩统计, 只由所属线程写入, 任务结束后用`merge`汇总.
+    - `raw_bytes`: 参与压缩的原始字节数
+    - `sent_bytes`: 这些数据实际发送的字节数
+    - `cpu_time`: 压缩耗费的线程CPU时间(秒)
+    '''
+    def __init__(self) -> None:
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.cpu_time = 0.0
+
+    def saved(self) -> int:
+        return self.raw_bytes - self.sent_bytes
+
+    def merge(self, other) -> None:
+        self.raw_bytes += other.raw_bytes
+        self.sent_bytes += other.sent_bytes
+        self.cpu_time += other.cpu_time
+
+class CompressPolicy:
+    r'''
+    按块自适应的压缩策略, 所有发送线程共用一个实例.
+
+    - 跳过`COMPRESSED_EXTS`中已压缩格式的文件
+    - 每个任务以首个数据块试压缩, 压缩比(压缩后/原始)不低于`ratio`时直接发送原始数据
+    - 发送过程中累计压缩比变差时放弃压缩, 同一文件的后续块也不再尝试
+
+    `method`为`zlib`, `lzma`或`bz2`, `level`为对应的压缩等级(lzma为preset).
+    '''
+    _method: int
+    _compress: Callable[[bytes], bytes]
+    _ratio: float
+    _lock: Lock
+    _poor_files: set[str]
+    def __init__(self, method: str, level: int = 1, ratio: float = 0.9) -> None:
+        if method == 'zlib':
+            self._method = CM_ZLIB
+            self._compress = lambda data: _zcompress(data, level)
+        elif method == 'bz2':
+            self._method = CM_BZ2
+            self._compress = lambda data: _bz2compress(data, max(1, level))
+        elif method == 'lzma' and _lzmacompress is not None:
+            self._method = CM_LZMA
+            self._compress = lambda data: _lzmacompress(data, preset=level)
+        else:
+            raise ValueError(f'Unsupported compression method: {method}')
+        self._ratio = ratio
+        self._lock = Lock()
+        self._poor_files = set()
+
+    def should_try(self, file_path: str) -> bool:
+        if path.splitext(file_path)[1].lower() in COMPRESSED_EXTS: return False
+        with self._lock:
+            return file_path not in self._poor_files
+
+    def give_up(self, file_path: str) -> None:
+        with self._lock:
+            self._poor_files.add(file_path)
+
+    def worth(self, raw_size: int, sent_size: int) -> bool:
+        return sent_size < raw_size * self._ratio
+
+    def compress(self, data: bytes, stats: CompressStats) -> tuple[bytes, int]:
+        r'''压缩`data`, 压缩无益时返回原始数据与`CM_NONE`.'''
+        start = thread_time()
+        packed = self._compress(data)
+        stats.cpu_time += thread_time() - start
+        stats.raw_bytes += len(data)
+        if self.worth(len(data), len(packed)):
+            stats.sent_bytes += len(packed)
+            return packed, self._method
+        stats.sent_bytes += len(data)
+        return data, CM_NONE
@@ -24,6 +24,12 @@ TEXT_KEY = Literal[
     'menu.recv',
 
     'msg.task_end',
+    'msg.conn_retired',
+
+    'stats.file',
+    'stats.conn',
+    'stats.total',
+    'stats.progress',
 
     'send.launch.start',
     'send.launch.show_key',
@@ -39,12 +45,24 @@ TEXT_KEY = Literal[
     'send.work.end',
     'send.work.make_task',
     'send.work.wait_quit',
+    'send.compress.report',
+    'send.dedup.report',
+    'send.resume.skip',
+    'send.engine.start',
+    'send.engine.fallback',
+    'send.tune.start',
+    'send.tune.grow',
+    'send.tune.settle',
 
     'send.exit',
 
     'send.thread.start',
     'send.thread.connect',
     'send.thread.exit',
+    'send.thread.retransmit',
+    'send.thread.retry_limit',
+    'send.thread.delta',
+    'send.thread.dedup',
 
     'show_task.type',
     'show_task.file_count',
@@ -52,6 +70,7 @@ TEXT_KEY = Literal[
     'show_task.choose_path',
     'show_task.thread_cnt',
     'show_task.file_name',
+    'show_task.stream_scan',
 
     'recv.launch.start',
     'recv.launch.give_save_folder',
@@ -70,11 +89,22 @@ TEXT_KEY = Literal[
     'recv.prepare.warn_skip',
     'recv.prepare.recv_connect',
     'recv.prepare.cache',
+    'recv.prepare.direct_write',
+    'recv.prepare.resume',
+    'recv.resume.kept',
+    'recv.engine.start',
+    'recv.engine.fallback',
+
+    'recv.block_writer.done',
+    'recv.block_writer.give_up',
 
     'recv.file_merge.loop',
     'recv.file_merge.stop',
     'recv.file_merge.new_merge',
-    'recv.file_merge.new_block',
+    'recv.file_merge.new_blocks',
+    'recv.file_merge.manifest_ok',
+    'recv.file_merge.manifest_bad',
+    'recv.file_merge.give_up',
 
     'recv.work.wait_quit',
 
@@ -83,7 +113,12 @@ TEXT_KEY = Literal[
     'recv.thread.bad_package',
     'recv.thread.recv_single',
     'recv.thread.recv_split',
-    'recv.thread.recv_block',
+    'recv.thread.recv_blocks',
+    'recv.thread.recv_bundle',
+    'recv.thread.bad_digest',
+    'recv.thread.recv_delta',
+    'recv.thread.recv_dedup',
+    'recv.thread.bad_ref',
 
     'recv.exit'
 ]
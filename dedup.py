@@ -0,0 +1,95 @@
+from hashlib import blake2b
+from threading import Lock, Condition
+from typing import BinaryIO, Iterator, Union
+
+__all__ = ['CDC_MIN', 'CDC_MAX', 'cut_chunks', 'chunk_id',
+           'SentChunks', 'ChunkStore']
+
+CDC_MIN = 16384
+CDC_MAX = 262144
+REF_TIMEOUT = 10.0
+
+# bytes are split into a "hot" quarter and the rest, a boundary follows
+# 7 hot bytes in a row: chunks average about 64KB
+_MARKS = bytes.maketrans(
+    bytes(range(256)),
+    bytes(49 if blake2b(bytes([i]), digest_size=1).digest()[0] < 64 else 48
+          for i in range(256))
+)
+_PATTERN = b'1' * 7
+
+def cut_chunks(file: BinaryIO, read_size: int = 4194304) -> Iterator[bytes]:
+    r'''
+    按内容定义的边界切分`file`: 边界只由其前7个字节决定, 插入或删除数据后
+    其余位置的边界不变. 字节分类与查找均由`bytes.translate`与`bytes.find`完成,
+    块长度介于`CDC_MIN`与`CDC_MAX`之间.
+    '''
+    buffer = b''
+    marks = b''
+    pos = 0
+    eof = False
+    while True:
+        if len(buffer) - pos < CDC_MAX and not eof:
+            data = file.read(read_size)
+            eof = not data
+            buffer = buffer[pos:] + data
+            marks = marks[pos:] + data.translate(_MARKS)
+            pos = 0
+        if pos >= len(buffer): return
+        end = marks.find(_PATTERN, pos + CDC_MIN - len(_PATTERN), pos + CDC_MAX)
+        cut = min(pos + CDC_MAX, len(buffer)) if end < 0 else end + len(_PATTERN)
+        yield buffer[pos: cut]
+        pos = cut
+
+def chunk_id(data: bytes) -> str:
+    return blake2b(data, digest_size=16).hexdigest()
+
+class SentChunks:
+    r'''
+    发送端在本次任务中已发送过的块, 所有发送线程共用.
+    `claim`返回`True`的线程负责发送该块的数据, 其余线程只发送引用.
+    '''
+    _lock: Lock
+    _sent: set[str]
+    saved_bytes: int
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._sent = set()
+        self.saved_bytes = 0
+
+    def claim(self, cid: str, size: int) -> bool:
+        with self._lock:
+            if cid in self._sent:
+                self.saved_bytes += size
+                return False
+            self._sent.add(cid)
+            return True
+
+class ChunkStore:
+    r'''
+    接收端已写入的块的位置表, 所有接收线程共用.
+    引用可能先于其数据到达(数据在另一条连接上), `read`会等待至多`REF_TIMEOUT`秒.
+    '''
+    _cond: Condition
+    _chunks: dict[str, tuple[str, int, int]]
+    def __init__(self) -> None:
+        self._cond = Condition()
+        self._chunks = {}
+
+    def register(self, cid: str, file_path: str, offset: int, size: int) -> None:
+        with self._cond:
+            self._chunks[cid] = (file_path, offset, size)
+            self._cond.notify_all()
+
+    def read(self, cid: str, timeout: float = REF_TIMEOUT) -> Union[bytes, None]:
+        with self._cond:
+            if not self._cond.wait_for(lambda: cid in self._chunks, timeout):
+                return None
+            file_path, offset, size = self._chunks[cid]
+        try:
+            with open(file_path, 'rb') as file:
+                file.seek(offset)
+                data = file.read(size)
+        except OSError: return None
+        if len(data) != size or chunk_id(data) != cid: return None
+        return data
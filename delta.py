@@ -0,0 +1,170 @@
+from hashlib import blake2b
+from math import isqrt
+from struct import Struct
+from zlib import adler32
+from typing import Any, BinaryIO, Iterator, Union
+
+__all__ = ['block_size_for', 'make_signatures', 'SignatureIndex',
+           'delta_ops', 'apply_copy']
+
+_SIG = Struct('>I8s')
+_ADLER_MOD = 65521
+
+MIN_BLOCK = 2048
+MAX_BLOCK = 1048576
+LITERAL_MAX = 1048576
+COPY_MAX = 67108864
+ROLL_BLOCKS = 8
+PROBE_INTERVAL = 64
+LOOKAHEAD = 4
+
+def block_size_for(size: int) -> int:
+    r'''按rsync的做法取约`sqrt(size)`的块大小, 对齐到1KB.'''
+    block = -(-isqrt(size) // 1024) * 1024
+    return max(MIN_BLOCK, min(MAX_BLOCK, block))
+
+def _strong(data: Union[bytes, memoryview]) -> bytes:
+    return blake2b(data, digest_size=8).digest()
+
+def make_signatures(file: BinaryIO, block_size: int) -> bytes:
+    r'''
+    计算接收端已有文件的块签名, 每块12字节: 4字节adler32弱校验与8字节blake2b强校验.
+    '''
+    sigs = bytearray()
+    buffer = bytearray(block_size)
+    while True:
+        read_size = file.readinto(buffer)
+        if not read_size: break
+        block = memoryview(buffer)[:read_size]
+        sigs += _SIG.pack(adler32(block), _strong(block))
+    return bytes(sigs)
+
+class SignatureIndex:
+    r'''接收端块签名的查找表, 弱校验命中后再比对强校验.'''
+    _block_size: int
+    _weak: dict[int, dict[bytes, int]]
+    def __init__(self, sigs: bytes, block_size: int) -> None:
+        self._block_size = block_size
+        self._weak = {}
+        for index, (weak, strong) in enumerate(_SIG.iter_unpack(sigs)):
+            self._weak.setdefault(weak, {}).setdefault(strong, index)
+
+    def __len__(self) -> int:
+        return len(self._weak)
+
+    def find(self, weak: int, data: Union[bytes, memoryview]) -> Union[int, None]:
+        strongs = self._weak.get(weak)
+        if strongs is None: return None
+        return strongs.get(_strong(data))
+
+def _aligned(index: SignatureIndex, data: memoryview, block_size: int) -> bool:
+    r'''其后`LOOKAHEAD`个对齐块中有能匹配的块时视为原地修改, 不必滚动查找.'''
+    for front in range(block_size, len(data) - block_size + 1, block_size):
+        block = data[front: front + block_size]
+        if index.find(adler32(block), block) is not None: return True
+    return False
+
+def _roll(index: SignatureIndex, data: memoryview, block_size: int,
+          limit: int) -> Union[tuple[int, int], None]:
+    r'''在`data`中逐字节滚动弱校验, 寻找偏移`1..limit`处的匹配块.'''
+    weak = adler32(data[:block_size])
+    a = weak & 0xFFFF
+    b = weak >> 16
+    weak_table = index._weak
+    for shift in range(1, min(limit, len(data) - block_size) + 1):
+        out_byte = data[shift - 1]
+        in_byte = data[shift + block_size - 1]
+        a = (a - out_byte + in_byte) % _ADLER_MOD
+        b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+        # most shifts miss the weak table, so skip slicing until they hit
+        if (b << 16) | a not in weak_table: continue
+        found = index.find((b << 16) | a, data[shift: shift + block_size])
+        if found is not None: return shift, found
+    return None
+
+def delta_ops(file: BinaryIO, index: SignatureIndex, block_size: int,
+              hasher: Any = None) -> Iterator[tuple[str, Any]]:
+    r'''
+    逐个产生重建`file`所需的指令:
+    - `('copy', (block_index, count))`: 复制接收端已有文件中连续的`count`个块
+    - `('literal', data)`: 原样写入`data`
+
+    先按块对齐比对, 不匹配且其后几个对齐块也不匹配时才逐字节滚动查找. 滚动在Python中较慢, 因此只在匹配块之后的
+    `ROLL_BLOCKS`个块内进行, 此后每`PROBE_INTERVAL`个块试探一次, 以便以接近C实现的速度
+    处理原地修改, 同时仍能处理插入与删除造成的错位.
+    `hasher`不为空时按顺序更新为`file`全部内容的摘要.
+    '''
+    buffer = bytearray()
+    pos = 0
+    eof = False
+    literal = bytearray()
+    copy_start, copy_count = -1, 0
+    roll_budget = ROLL_BLOCKS
+    missed = 0
+    while True:
+        if len(buffer) - pos < (LOOKAHEAD + 1) * block_size and not eof:
+            chunk = file.read(max(LITERAL_MAX, (LOOKAHEAD + 1) * block_size))
+            if not chunk: eof = True
+            del buffer[:pos]
+            buffer += chunk
+            pos = 0
+        view = memoryview(buffer)
+        if pos >= len(view):
+            view.release()
+            break
+        block = view[pos: pos + block_size]
+        found = index.find(adler32(block), block) if len(index) else None
+        if found is None and len(index) and len(block) == block_size \
+            and (roll_budget > 0 or missed % PROBE_INTERVAL == 0) \
+            and not _aligned(index, view[pos: pos + (LOOKAHEAD + 1) * block_size], block_size):
+            roll_budget -= 1
+            match = _roll(index, view[pos: pos + 2 * block_size], block_size, block_size - 1)
+            if match is not None:
+                shift, found = match
+                literal += view[pos: pos + shift]
+                if hasher is not None: hasher.update(view[pos: pos + shift])
+                pos += shift
+                block = view[pos: pos + block_size]
+        if found is None:
+            literal += block
+            missed += 1
+        else:
+            if literal:
+                if copy_count:
+                    yield 'copy', (copy_start, copy_count)
+                    copy_count = 0
+                yield 'literal', bytes(literal)
+                literal.clear()
+            if copy_count and (copy_start + copy_count != found \
+                               or copy_count * block_size >= COPY_MAX):
+                yield 'copy', (copy_start, copy_count)
+                copy_count = 0
+            if not copy_count: copy_start = found
+            copy_count += 1
+            roll_budget = ROLL_BLOCKS
+            missed = 0
+        if hasher is not None: hasher.update(block)
+        pos += len(block)
+        block.release()
+        view.release()
+        if len(literal) >= LITERAL_MAX:
+            if copy_count:
+                yield 'copy', (copy_start, copy_count)
+                copy_count = 0
+            yield 'literal', bytes(literal)
+            literal.clear()
+    if copy_count: yield 'copy', (copy_start, copy_count)
+    if literal: yield 'literal', bytes(literal)
+
+def apply_copy(basis: BinaryIO, target: Any, block_index: int, count: int,
+               block_size: int) -> int:
+    r'''把`basis`中自第`block_index`块起的`count`个块写入`target`, 返回写入的字节数.'''
+    basis.seek(block_index * block_size)
+    size = count * block_size
+    copied = 0
+    while copied < size:
+        data = basis.read(min(LITERAL_MAX, size - copied))
+        if not data: break
+        target.write(data)
+        copied += len(data)
+    return copied
@@ -0,0 +1,101 @@
+from tcp import Packer, SM_RAW
+from socket import socket
+from concurrent.futures import ThreadPoolExecutor
+from zlib import compress, decompress
+import os
+
+__all__ = ['pack_dirs', 'unpack_dirs', 'send_dirs', 'recv_dirs', 'make_dirs']
+
+# raw bytes per packet, still below the FRAME_V1 limit after base64
+DIR_CHUNK = 32768
+
+def _put_varint(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _get_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80: return value, pos
+        shift += 7
+
+def pack_dirs(rel_paths: list[str], compressed: bool = True) -> bytes:
+    r'''
+    把文件夹相对路径列表编码为紧凑的清单: 排序后每条路径只记录与上一条共有的前缀长度
+    和剩余部分(前缀编码), `compressed`为真时再以zlib压缩.
+    排序后父文件夹总在子文件夹之前.
+    '''
+    out = bytearray()
+    last = b''
+    for rel_path in sorted(rel_paths):
+        encoded = rel_path.encode('utf-8')
+        # binary search on slice comparisons instead of a per-byte loop
+        shared, high = 0, min(len(last), len(encoded))
+        while shared < high:
+            middle = (shared + high + 1) // 2
+            if last[:middle] == encoded[:middle]: shared = middle
+            else: high = middle - 1
+        _put_varint(out, shared)
+        _put_varint(out, len(encoded) - shared)
+        out += encoded[shared:]
+        last = encoded
+    return compress(out) if compressed else bytes(out)
+
+def unpack_dirs(data: bytes, count: int, compressed: bool = True) -> list[str]:
+    r'''`pack_dirs`的逆过程, `count`为路径条数.'''
+    if compressed: data = decompress(data)
+    rel_paths: list[str] = []
+    last = b''
+    pos = 0
+    for _ in range(count):
+        shared, pos = _get_varint(data, pos)
+        length, pos = _get_varint(data, pos)
+        last = last[:shared] + data[pos: pos + length]
+        pos += length
+        rel_paths.append(last.decode('utf-8'))
+    return rel_paths
+
+def send_dirs(packer: Packer, client: socket, rel_paths: list[str],
+              compressed: bool = True) -> None:
+    r'''先发送清单头`{count, chunks, compressed}`, 再按`DIR_CHUNK`分包发送清单, 不受单包大小限制.'''
+    data = pack_dirs(rel_paths, compressed)
+    chunks = [data[front: front + DIR_CHUNK] for front in range(0, len(data), DIR_CHUNK)]
+    packer.sendPacket(client, {
+        "count": len(rel_paths),
+        "chunks": len(chunks),
+        "compressed": compressed
+    })
+    for chunk in chunks: packer.sendPacket(client, chunk, None, SM_RAW)
+
+def recv_dirs(packer: Packer, client: socket) -> list[str]:
+    head = packer.recvPacket(client)
+    data = bytearray()
+    for _ in range(head['chunks']):
+        data += packer.recvPacket(client, None, SM_RAW)
+    return unpack_dirs(bytes(data), head['count'], head['compressed'])
+
+def make_dirs(dir_paths: list[str], workers: int = 8) -> int:
+    r'''
+    按层批量创建文件夹: 同一深度的文件夹由`workers`个线程并行创建, 上一层完成后再创建下一层,
+    在慢速(网络)文件系统上可同时发出多个请求. 返回已存在而跳过的文件夹数.
+    '''
+    levels: dict[int, list[str]] = {}
+    for dir_path in dir_paths:
+        depth = dir_path.count('\\') + dir_path.count('/')
+        levels.setdefault(depth, []).append(dir_path)
+
+    def make_one(dir_path: str) -> int:
+        try: os.mkdir(dir_path)
+        except FileExistsError: return 1
+        return 0
+
+    skipped = 0
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        for depth in sorted(levels):
+            skipped += sum(executor.map(make_one, levels[depth]))
+    return skipped
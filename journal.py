@@ -0,0 +1,129 @@
+from os import path, remove, fsync
+from hashlib import blake2b
+from threading import Lock, Thread, Event
+from typing import Any, TextIO
+import json
+
+__all__ = ['make_job_id', 'Journal']
+
+# seconds between group commits of the journal
+SYNC_INTERVAL = 1.0
+
+def make_job_id(task_config: dict[str, Any]) -> str:
+    r'''
+    由任务的路径、文件数、总大小与最新的修改时间生成任务ID, 同一任务重新发送时ID不变;
+    任一文件被原地改写(大小不变)后ID也会变化, 不会沿用旧的进度.
+    '''
+    key = json.dumps([
+        task_config['apex_path'],
+        task_config['file_count'],
+        task_config['total_size'],
+        max((entry.mtime for entry in task_config['file_entry']), default=0)
+    ])
+    return blake2b(key.encode('utf-8'), digest_size=12).hexdigest()
+
+class Journal:
+    r'''
+    接收端的完成日志, 每个任务ID对应一个只追加的文件, 每行一条JSON记录:
+    - `["f", rel_path, size]`: 文件已完整接收
+    - `["b", rel_path, front, size]`: 直接写入模式下的一个数据块已写入
+    - `["x", rel_path]`: 撤销该文件此前的全部记录(如校验清单不一致), 续传时重新发送
+
+    传输中断后以同一任务ID重新连接时, 由`done_set`把已完成的部分告知发送端.
+    未写完的末行会在载入时被忽略.
+
+    记录先在内存中排队, 每`SYNC_INTERVAL`秒成组提交一次: 先对记录所指的数据文件`fsync`,
+    再写入记录并对日志本身`fsync`, 崩溃后日志中不会出现数据尚未落盘的记录.
+    '''
+    _file_path: str
+    _file: TextIO
+    _lock: Lock
+    _files: dict[str, int]
+    _blocks: set[tuple[str, int, int]]
+    _pending: list[tuple[list, str]]
+    _stop: Event
+    _thread: Thread
+    def __init__(self, file_path: str) -> None:
+        self._file_path = file_path
+        self._lock = Lock()
+        self._files = {}
+        self._blocks = set()
+        self._pending = []
+        self._stop = Event()
+        if path.isfile(file_path):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try: record = json.loads(line)
+                    except ValueError: continue
+                    self._load(record)
+        self._file = open(file_path, 'a', encoding='utf-8')
+        self._thread = Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def _load(self, record: list) -> None:
+        if record[0] == 'f':
+            self._files[record[1]] = record[2]
+        elif record[0] == 'b':
+            self._blocks.add(tuple(record[1:]))
+        elif record[0] == 'x':
+            self._files.pop(record[1], None)
+            self._blocks = {block for block in self._blocks if block[0] != record[1]}
+
+    def _append(self, record: list, data_path: str = None) -> None:
+        with self._lock:
+            self._load(record)
+            self._pending.append((record, data_path))
+
+    @staticmethod
+    def _sync_data(data_path: str) -> bool:
+        try:
+            with open(data_path, 'r+b') as file: fsync(file.fileno())
+        except OSError: return False
+        return True
+
+    def _commit(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending: return
+        synced: dict[str, bool] = {}
+        lines = []
+        for record, data_path in pending:
+            if data_path is not None:
+                if data_path not in synced: synced[data_path] = self._sync_data(data_path)
+                # data that cannot be synced is received again on resume
+                if not synced[data_path]: continue
+            lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.write(''.join(lines))
+        self._file.flush()
+        fsync(self._file.fileno())
+
+    def _work(self) -> None:
+        while not self._stop.wait(SYNC_INTERVAL): self._commit()
+
+    def record_file(self, rel_path: str, size: int, data_path: str = None) -> None:
+        r'''`data_path`为写入的目标文件, 提交记录前先将其落盘.'''
+        self._append(['f', rel_path, size], data_path)
+
+    def record_block(self, rel_path: str, front: int, size: int, data_path: str = None) -> None:
+        self._append(['b', rel_path, front, size], data_path)
+
+    def forget(self, rel_path: str) -> None:
+        self._append(['x', rel_path])
+
+    def size(self) -> int:
+        return len(self._files) + len(self._blocks)
+
+    def done_set(self) -> dict[str, list]:
+        with self._lock:
+            return {
+                "files": [list(item) for item in self._files.items()],
+                "blocks": [list(block) for block in self._blocks]
+            }
+
+    def close(self, finished: bool) -> None:
+        r'''提交剩余的记录并关闭日志, 任务完成时删除日志文件.'''
+        self._stop.set()
+        self._thread.join()
+        if not finished: self._commit()
+        self._file.close()
+        if finished: remove(self._file_path)
@@ -8,14 +8,16 @@ r'''
 '''
 from typing import Literal as _Literal, Callable as _Callable, Union as _Union, Any as _Any
 from threading import Thread as _Thread, Lock as _Lock
-from queue import Empty as _Empty
+from queue import Empty as _Empty, SimpleQueue as _SimpleQueue
 from multiprocessing import Queue as _Queue, Process as _Process, Lock as _PLock
 from random import randint as _randint
-from time import strftime as _strftime, localtime as _localtime
+from time import strftime as _strftime, localtime as _localtime, monotonic as _monotonic
 from os.path import exists as _exists
 from os import makedirs as _mkdir
 
-LOGSIGN = _Literal['warn', 'info', 'error', 'stop']
+LOGSIGN = _Literal['warn', 'info', 'error', 'stop', 'progress', 'tally']
+LOGLEVEL = _Literal['info', 'warn', 'error']
+LEVELS = {'info': 0, 'warn': 1, 'error': 2}
 TCOLOR = _Literal['yellow', 'red', 'default', 'green', 'black', 'blue', 'purple', 'cyan', 'white']
 COLORMAP = {'black': '30', 'red': '31', 'green': '32', 'yellow': '33', 'blue': '34', 'purple': '35', 'cyan': '36', 'white': '37'}
 
@@ -68,7 +70,10 @@ class LoggerWrapper:
     关于`LoggerPacket`的详细参数参见`LoggerPacket`类的说明.
 
     #### 注意: 继承并重写后的类需要通过`ProcessLogger`的`changeWrapper`方法装载.
+
+    `min_level`以下的日志在格式化之前直接返回, 由`ThreadLogger`按`log_level`设置.
     '''
+    min_level: int = 0
     def __init__(self, phase_name: str, logs_queue: _Queue) -> None:
         self.phase_name: str = phase_name
         self.logs_queue: _Queue = logs_queue
@@ -85,6 +90,10 @@ class LoggerWrapper:
             return LoggerPacket('red', self.phase_name, 'ERROR', logs)
         elif sign == 'stop':
             return LoggerPacket('yellow', self.phase_name, 'STOP', logs)
+        elif sign == 'progress':
+            return LoggerPacket('cyan', self.phase_name, 'PROGRESS', logs)
+        elif sign == 'tally':
+            return LoggerPacket('default', self.phase_name, 'TALLY', logs)
         else:
             return LoggerPacket('default', self.phase_name, 'unknown', logs)
         
@@ -92,19 +101,39 @@ class LoggerWrapper:
         self.pushLog(self.logsPacketer(reason + end, 'stop'))
 
     def info(self, *logs: _Any, sep: str = ' ', end = '\n') -> None:
+        if self.min_level > 0: return
         log_t = sep.join([str(log) for log in logs]) + end
         self.pushLog(self.logsPacketer(log_t, 'info'))
     
     def error(self, *logs: _Any, sep: str = ' ', end = '\n') -> None:
+        if self.min_level > 2: return
         log_t = sep.join([str(log) for log in logs]) + end
         self.pushLog(self.logsPacketer(log_t, 'error'))
     
     def warn(self, *logs: _Any, sep: str = ' ', end = '\n') -> None:
+        if self.min_level > 1: return
         log_t = sep.join([str(log) for log in logs]) + end
         self.pushLog(self.logsPacketer(log_t, 'warn'))
+
+    def progress(self, *logs: _Any, sep: str = ' ') -> None:
+        r'''
+        更新控制台底部的进度行, 不写入日志文件. 新的进度行覆盖旧的,
+        其他日志输出在进度行之上; 内容为空时清除进度行.
+        '''
+        self.pushLog(self.logsPacketer(sep.join([str(log) for log in logs]), 'progress'))
+
+    def tally(self, text: str) -> None:
+        r'''
+        计数一次高频事件, 不逐条输出. `ThreadLogger`按`text`与段落名(去掉末尾编号)合并计数,
+        每`TALLY_INTERVAL`秒输出一行`text.format(次数)`; `text`应为不含变量的模板.
+        '''
+        if self.min_level > 0: return
+        self.pushLog(self.logsPacketer(text, 'tally'))
     
     def getWrapperInstance(self, phase_name: str):
-        return LoggerWrapper(self.phase_name + '/' + phase_name, self.logs_queue)
+        wrapper = LoggerWrapper(self.phase_name + '/' + phase_name, self.logs_queue)
+        wrapper.min_level = self.min_level
+        return wrapper
 
 class ProcessLogger:
     r'''
@@ -136,9 +165,18 @@ class ProcessLogger:
     def disableColorOutput(self) -> None:
         self._color_output = False
 
+    def _colorText(self, packet: LoggerPacket, text: str) -> str:
+        color_id = packet.getColorPrefix()
+        if self._color_output:
+            if color_id != None:
+                text = '\033[0;{}m'.format(color_id) + text
+            text += '\033[m'
+        return text
+
     def _work(self) -> None:
         if self.file_output:
             file_out = open(self.logs_folder + '\\' + self.log_file_name, 'w', encoding = 'utf-8')
+        progress = ''
         while True:
             if not self.stopping:
                 packet: LoggerPacket = self.logs_queue.get()
@@ -148,16 +186,21 @@ class ProcessLogger:
                     if self.file_output: file_out.close()
                     break
 
+            if packet.level == 'PROGRESS':
+                progress = self._colorText(packet, packet.logs) if packet.logs else ''
+                print('\r\033[K' + progress, flush = True, end='')
+                continue
+            if packet.level == 'TALLY':
+                packet = LoggerPacket(packet.text_color, packet.phase_name, 'info', packet.logs.format(1) + '\n')
+
             text = packet.getStr()
 
             if self.file_output:
                 file_out.write(text)
                 file_out.flush()
-            color_id = packet.getColorPrefix()
-            if self._color_output:
-                if color_id != None:
-                    text = '\033[0;{}m'.format(color_id) + text
-                text += '\033[m'
+            text = self._colorText(packet, text)
+            # keep the progress line below the other logs
+            if progress: text = '\r\033[K' + text + progress
             print(text, flush = True, end='')
 
             if packet.level == 'STOP':
@@ -175,15 +218,26 @@ class ProcessLogger:
         return self.wrapper(phase_name, self.logs_queue)
     
 class ThreadLogger:
-    '''`ThreadLogger`与`ProcessLogger`在使用上完全一致, 但是`ThreadLogger`在另一线程上运行, 而`ProcessLogger`在另一进程上运行'''
+    r'''
+    `ThreadLogger`与`ProcessLogger`在使用上完全一致, 但是`ThreadLogger`在另一线程上运行, 而`ProcessLogger`在另一进程上运行
 
-    def __init__(self, file_output: bool = False, logs_folder_name: str = None) -> None:
+    日志经进程内队列传递, 输出线程每次取出队列中的全部日志, 合并为一次控制台输出与一次文件写入;
+    文件在缓冲超过`FLUSH_SIZE`字节或距上次刷新超过`FLUSH_INTERVAL`秒时刷新, 调用方不会被磁盘阻塞.
+    `log_level`为`'warn'`或`'error'`时, 更低等级的日志在格式化之前即被丢弃.
+    '''
+    FLUSH_SIZE = 65536
+    FLUSH_INTERVAL = 1.0
+    TALLY_INTERVAL = 2.0
+
+    def __init__(self, file_output: bool = False, logs_folder_name: str = None,
+                 log_level: LOGLEVEL = 'info') -> None:
         self._color_output = True
-        self.logs_queue = _Queue()
+        self.logs_queue = _SimpleQueue()
         self.logger_thread = None
         self.logs_folder = '.\\Logs' if logs_folder_name == None else logs_folder_name.removesuffix('\\')
         self.log_file_name = ''
         self.file_output = file_output
+        self.min_level = LEVELS.get(log_level, 0)
         self.wrapper = LoggerWrapper
         self.stopping = False
         self.stop_lock = _Lock()
@@ -193,33 +247,80 @@ class ThreadLogger:
                 _mkdir(self.logs_folder)
             self.log_file_name = _strftime('%Y-%m-%d_%H-%M-%S_', _localtime()) + str(_randint(10000, 99999)) + '.log'
 
+    def _colorText(self, packet: LoggerPacket, text: str) -> str:
+        color_id = packet.getColorPrefix()
+        if self._color_output:
+            if color_id != None:
+                text = '\033[0;{}m'.format(color_id) + text
+            text += '\033[m'
+        return text
+
+    def _takeTallies(self, tallies: dict[tuple[str, str], list]) -> list[LoggerPacket]:
+        packets = [
+            LoggerPacket(packet.text_color, phase_name, 'info', text.format(count) + '\n')
+            for (phase_name, text), (count, packet) in tallies.items()
+        ]
+        tallies.clear()
+        return packets
+
     def _work(self) -> None:
         if self.file_output:
             file_out = open(self.logs_folder + '\\' + self.log_file_name, 'w', encoding = 'utf-8')
+        progress = ''
+        unflushed = 0
+        last_flush = last_tally = _monotonic()
+        tallies: dict[tuple[str, str], list] = {}
         while True:
-            if not self.stopping:
-                packet: LoggerPacket = self.logs_queue.get()
-            else:
-                try: packet: LoggerPacket = self.logs_queue.get(True, 5.0)
-                except _Empty:
-                    if self.file_output: file_out.close()
-                    break
-            
-            text = packet.getStr()
+            packets: list[LoggerPacket] = []
+            try:
+                # wake up now and then to flush the file and the tallies
+                packets.append(self.logs_queue.get(True, 5.0 if self.stopping else self.FLUSH_INTERVAL))
+                while True: packets.append(self.logs_queue.get_nowait())
+            except _Empty: pass
+            if not packets and self.stopping: break
+
+            now = _monotonic()
+            lines: list[LoggerPacket] = []
+            for packet in packets:
+                if packet.level == 'TALLY':
+                    key = (packet.phase_name.rstrip('0123456789'), packet.logs)
+                    if key in tallies: tallies[key][0] += 1
+                    else: tallies[key] = [1, packet]
+                    continue
+                if packet.level == 'STOP':
+                    lines.extend(self._takeTallies(tallies))
+                    with self.stop_lock:
+                        self.stopping = True
+                lines.append(packet)
+            if tallies and (now - last_tally >= self.TALLY_INTERVAL or self.stopping):
+                lines.extend(self._takeTallies(tallies))
+                last_tally = now
+
+            console: list[str] = []
+            file_text: list[str] = []
+            for packet in lines:
+                if packet.level == 'PROGRESS':
+                    progress = self._colorText(packet, packet.logs) if packet.logs else ''
+                    console.append('\r\033[K')
+                    continue
+                text = packet.getStr()
+                file_text.append(text)
+                console.append('\r\033[K' + self._colorText(packet, text))
+            if console:
+                # keep the progress line below the other logs
+                print(''.join(console) + progress, flush = True, end='')
 
             if self.file_output:
-                file_out.write(text)
-                file_out.flush()
-            color_id = packet.getColorPrefix()
-            if self._color_output:
-                if color_id != None:
-                    text = '\033[0;{}m'.format(color_id) + text
-                text += '\033[m'
-            print(text, flush = True, end='')
-
-            if packet.level == 'STOP':
-                with self.stop_lock:
-                    self.stopping = True
+                if file_text:
+                    text = ''.join(file_text)
+                    file_out.write(text)
+                    unflushed += len(text)
+                if unflushed and (unflushed >= self.FLUSH_SIZE or
+                                  now - last_flush >= self.FLUSH_INTERVAL or self.stopping):
+                    file_out.flush()
+                    unflushed = 0
+                    last_flush = now
+        if self.file_output: file_out.close()
 
     def startLogThread(self) -> None:
         self.logger_thread = _Thread(target = self._work)
@@ -232,4 +333,6 @@ class ThreadLogger:
         self.wrapper = wrapper
 
     def getWrapperInstance(self, phase_name: str) -> LoggerWrapper:
-        return self.wrapper(phase_name, self.logs_queue)
\ No newline at end of file
+        wrapper = self.wrapper(phase_name, self.logs_queue)
+        wrapper.min_level = self.min_level
+        return wrapper
@@ -0,0 +1,234 @@
+from config import LangFile
+from logger import LoggerWrapper
+from threading import Thread, Event, Lock
+from time import perf_counter
+from typing import Callable, Any
+import os, json
+
+__all__ = ['ConnStats', 'Metrics', 'Progress']
+
+RTT_SMOOTH = 0.125
+RATE_SMOOTH = 0.2
+
+class ConnStats:
+    r'''
+    单条连接的计数器, 只由所属线程写入, 采样线程读取时不加锁.
+    - `bytes`/`tasks`: 已完成任务的数据量与任务数
+    - `files`: 已完成的文件数, 分块文件的每一块计`1 / 块数`
+    - `times`: 各阶段的累计耗时(秒), 由`lap`记录
+    - `rtt`: 消息发出到被确认的平滑时间(秒), 包含接收端处理与批量确认的延迟
+    '''
+    bytes: int
+    tasks: int
+    files: float
+    times: dict[str, float]
+    rtt: float
+    _mark: float
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.tasks = 0
+        self.files = 0.0
+        self.times = {}
+        self.rtt = 0.0
+        self._mark = perf_counter()
+
+    def lap(self, phase: str) -> None:
+        r'''把距上一次`lap`的时间记入`phase`.'''
+        now = perf_counter()
+        self.times[phase] = self.times.get(phase, 0.0) + now - self._mark
+        self._mark = now
+
+    def done(self, size: int, files: float = 1.0) -> None:
+        self.bytes += size
+        self.tasks += 1
+        self.files += files
+
+    def sample_rtt(self, rtt: float) -> None:
+        self.rtt = rtt if not self.rtt else self.rtt + RTT_SMOOTH * (rtt - self.rtt)
+
+class Metrics:
+    r'''
+    一次任务的运行统计.
+
+    `conn`为每条连接登记一个`ConnStats`, `gauge`登记按需读取的数值(如调度器中的任务数).
+    `run`后每`interval`秒把快照改写到`file_path`(先写临时文件再替换, 读取方不会读到半个文件),
+    `stop`写入最终快照并把每条连接的统计输出到日志. `file_path`为空时只输出最终报告.
+    '''
+    _file_path: str
+    _interval: float
+    _logger: LoggerWrapper
+    _locale: LangFile
+    _lock: Lock
+    _conns: dict[str, ConnStats]
+    _gauges: dict[str, Callable[[], int]]
+    _last: dict[str, tuple[float, int]]
+    _start: float
+    _stop: Event
+    _thread: Thread
+    def __init__(self, file_path: str, interval: float, logger: LoggerWrapper,
+                 locale: LangFile) -> None:
+        self._file_path = file_path
+        self._interval = interval
+        self._logger = logger
+        self._locale = locale
+        self._lock = Lock()
+        self._conns = {}
+        self._gauges = {}
+        self._last = {}
+        self._start = perf_counter()
+        self._stop = Event()
+        self._thread = Thread(target=self._work, daemon=True)
+
+    def conn(self, name: str) -> ConnStats:
+        stats = ConnStats()
+        with self._lock: self._conns[name] = stats
+        return stats
+
+    def gauge(self, name: str, read: Callable[[], int]) -> None:
+        with self._lock: self._gauges[name] = read
+
+    def totals(self) -> tuple[int, float]:
+        r'''全部连接已完成的数据量与文件数, 只读取各线程自己的计数器, 不加锁.'''
+        with self._lock: conns = list(self._conns.values())
+        return sum(stats.bytes for stats in conns), sum(stats.files for stats in conns)
+
+    def snapshot(self) -> dict[str, Any]:
+        r'''当前的统计快照, `rate`为距上次快照的速率, `avg_rate`为全程平均速率(B/s).'''
+        now = perf_counter()
+        elapsed = max(now - self._start, 1e-9)
+        with self._lock:
+            conns = list(self._conns.items())
+            gauges = list(self._gauges.items())
+        conn_info: dict[str, Any] = {}
+        total = 0
+        for name, stats in conns:
+            sent = stats.bytes
+            last_time, last_bytes = self._last.get(name, (self._start, 0))
+            self._last[name] = (now, sent)
+            total += sent
+            conn_info[name] = {
+                "bytes": sent,
+                "tasks": stats.tasks,
+                "rate": (sent - last_bytes) / max(now - last_time, 1e-9),
+                "avg_rate": sent / elapsed,
+                "rtt_ms": stats.rtt * 1000,
+                "times": {phase: round(t, 3) for phase, t in dict(stats.times).items()}
+            }
+        return {
+            "elapsed": elapsed,
+            "bytes": total,
+            "avg_rate": total / elapsed,
+            "gauges": {name: read() for name, read in gauges},
+            "conns": conn_info
+        }
+
+    def _write(self, snapshot: dict[str, Any]) -> None:
+        if not self._file_path: return
+        temp_path = self._file_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(snapshot, file, indent=4)
+            os.replace(temp_path, self._file_path)
+        except OSError: pass
+
+    def _work(self) -> None:
+        while not self._stop.wait(self._interval):
+            self._write(self.snapshot())
+
+    def run(self) -> None:
+        if self._file_path:
+            os.makedirs(os.path.dirname(self._file_path) or '.', exist_ok=True)
+            self._logger.info(self._locale('stats.file'), self._file_path)
+        self._thread.start()
+
+    def stop(self) -> dict[str, Any]:
+        r'''停止采样, 写入并在日志中报告最终快照.'''
+        self._stop.set()
+        if self._thread.is_alive(): self._thread.join()
+        snapshot = self.snapshot()
+        self._write(snapshot)
+        for name, info in snapshot['conns'].items():
+            phases = ', '.join(
+                f'{phase} {seconds:.1f}s' for phase, seconds in info['times'].items()
+            )
+            self._logger.info(self._locale('stats.conn').format(
+                name, info['bytes'] / 1048576, info['tasks'],
+                info['avg_rate'] / 1048576, info['rtt_ms'], phases
+            ))
+        self._logger.info(self._locale('stats.total').format(
+            snapshot['bytes'] / 1048576, snapshot['avg_rate'] / 1048576,
+            snapshot['elapsed']
+        ))
+        return snapshot
+
+def _format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+class Progress:
+    r'''
+    控制台中的单行进度, 每`interval`秒由`Metrics.totals`汇总各线程的计数器并刷新一次,
+    数据线程本身不做任何额外的同步.
+
+    `total()`返回`(总字节数, 总文件数, 是否已确定)`, 边扫描边发送时总量随扫描增长,
+    确定前不显示剩余时间. `base()`返回断点续传中已完成的`(字节数, 文件数)`.
+    速率取各周期速率的指数平滑, 剩余时间由平滑速率估计.
+    '''
+    _metrics: Metrics
+    _logger: LoggerWrapper
+    _locale: LangFile
+    _total: Callable[[], tuple[int, int, bool]]
+    _base: Callable[[], tuple[int, float]]
+    _interval: float
+    _rate: float
+    _last: tuple[float, int]
+    _stop: Event
+    _thread: Thread
+    def __init__(self, metrics: Metrics, logger: LoggerWrapper, locale: LangFile,
+                 total: Callable[[], tuple[int, int, bool]],
+                 base: Callable[[], tuple[int, float]] = None,
+                 interval: float = 0.5) -> None:
+        self._metrics = metrics
+        self._logger = logger
+        self._locale = locale
+        self._total = total
+        self._base = base if base is not None else lambda: (0, 0.0)
+        self._interval = interval
+        self._rate = 0.0
+        self._last = (perf_counter(), 0)
+        self._stop = Event()
+        self._thread = Thread(target=self._work, daemon=True)
+
+    def _line(self) -> str:
+        done_bytes, done_files = self._metrics.totals()
+        now = perf_counter()
+        last_time, last_bytes = self._last
+        self._last = (now, done_bytes)
+        rate = (done_bytes - last_bytes) / max(now - last_time, 1e-9)
+        self._rate = rate if not self._rate else self._rate + RATE_SMOOTH * (rate - self._rate)
+        base_bytes, base_files = self._base()
+        done_bytes += base_bytes
+        done_files += base_files
+        total_bytes, total_files, known = self._total()
+        eta = '--:--:--'
+        if known and self._rate > 0:
+            eta = _format_eta(max(0, total_bytes - done_bytes) / self._rate)
+        return self._locale('stats.progress').format(
+            done_bytes / 1048576, total_bytes / 1048576,
+            done_bytes / total_bytes * 100 if total_bytes else 0.0,
+            int(done_files), total_files, self._rate / 1048576, eta
+        )
+
+    def _work(self) -> None:
+        while not self._stop.wait(self._interval):
+            self._logger.progress(self._line())
+
+    def run(self) -> None:
+        if self._interval > 0: self._thread.start()
+
+    def stop(self) -> None:
+        r'''停止刷新并清除进度行.'''
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+            self._logger.progress('')
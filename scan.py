@@ -0,0 +1,103 @@
+from os import scandir
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from threading import Thread
+from queue import Queue
+from typing import NamedTuple, Iterator
+
+__all__ = ['FileEntry', 'scan_tree', 'TreeScan']
+
+class FileEntry(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+
+def _scan_dir(dir_path: str) -> tuple[list[FileEntry], list[str]]:
+    r'''扫描单个文件夹, 文件的大小与修改时间取自`DirEntry.stat()`, Windows下无需额外的系统调用.'''
+    files: list[FileEntry] = []
+    sub_dirs: list[str] = []
+    try:
+        with scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        # linked folders are neither listed nor entered
+                        if not entry.is_symlink(): sub_dirs.append(entry.path)
+                        continue
+                    stat = entry.stat()
+                except OSError: continue
+                files.append(FileEntry(entry.path, stat.st_size, stat.st_mtime))
+    except OSError: pass
+    return files, sub_dirs
+
+def _scan_results(folder_path: str,
+                  workers: int) -> Iterator[tuple[str, list[FileEntry], list[str]]]:
+    r'''按完成顺序产生每个文件夹的扫描结果, 子文件夹在父文件夹的结果产生时才提交.'''
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        pending: dict[Future, str] = {executor.submit(_scan_dir, folder_path): folder_path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_path = pending.pop(future)
+                files, sub_dirs = future.result()
+                for sub_dir in sub_dirs:
+                    pending[executor.submit(_scan_dir, sub_dir)] = sub_dir
+                yield dir_path, files, sub_dirs
+
+def scan_tree(folder_path: str, workers: int = 8) -> tuple[list[FileEntry], list[str]]:
+    r"""
+    以`workers`个线程并行扫描`folder_path`, 返回`(file_entries, folder_paths)`:
+    - `file_entries`: 所有文件的`FileEntry(path, size, mtime)`
+    - `folder_paths`: 所有文件夹的路径列表 (包括`folder_path`本身), 父文件夹总在子文件夹之前
+
+    结果与`os.walk`自顶向下的顺序一致, 不受各线程完成先后的影响.
+    """
+    results = {dir_path: (files, sub_dirs)
+               for dir_path, files, sub_dirs in _scan_results(folder_path, workers)}
+    file_entries: list[FileEntry] = []
+    folder_paths: list[str] = []
+    stack = [folder_path]
+    while stack:
+        dir_path = stack.pop()
+        files, sub_dirs = results[dir_path]
+        folder_paths.append(dir_path)
+        file_entries.extend(files)
+        stack.extend(reversed(sub_dirs))
+    return file_entries, folder_paths
+
+class TreeScan:
+    r'''
+    边扫描边发送时使用的扫描器: 后台线程扫描`folder_path`, 迭代时按发现顺序产生`FileEntry`,
+    不必等待整个目录树扫描结束.
+
+    `dir_path`、`file_count`与`total_size`随扫描增长, `finished`为真后即为最终结果;
+    `dir_path`中父文件夹总在子文件夹之前.
+    '''
+    _queue: Queue
+    _thread: Thread
+    dir_path: list[str]
+    file_count: int
+    total_size: int
+    finished: bool
+    def __init__(self, folder_path: str, workers: int = 8) -> None:
+        self._queue = Queue()
+        self._thread = Thread(target=self._work, args=(folder_path, workers), daemon=True)
+        self.dir_path = []
+        self.file_count = 0
+        self.total_size = 0
+        self.finished = False
+        self._thread.start()
+
+    def _work(self, folder_path: str, workers: int) -> None:
+        try:
+            for dir_path, files, _ in _scan_results(folder_path, workers):
+                self.dir_path.append(dir_path)
+                self.file_count += len(files)
+                self.total_size += sum(entry.size for entry in files)
+                if files: self._queue.put(files)
+        finally:
+            self.finished = True
+            self._queue.put(None)
+
+    def __iter__(self) -> Iterator[FileEntry]:
+        while (files := self._queue.get()) is not None:
+            yield from files
@@ -0,0 +1,109 @@
+from collections import deque
+from threading import Condition, Semaphore
+from typing import Any
+
+__all__ = ['Scheduler']
+
+# fallback only, put/get/close notify waiting threads
+WAIT_TIMEOUT = 0.5
+
+class Scheduler:
+    r'''
+    发送任务的调度器, 代替所有发送线程共用的`Queue`.
+
+    每个发送线程(`uid`)有自己的双端队列, 任务按轮转放入各队列, 线程只从自己队列的头部取任务;
+    自己的队列为空时从最长的队列头部窃取, 因此新加入的连接也能立即分到剩余任务中最大的一个.
+    队列中的任务总数不超过`maxsize`, 放满时`put`阻塞.
+
+    `close`后, 取任务时所有队列均为空的线程得到`end`, 不必按线程数放入`end`.
+    '''
+    _deques: list[deque]
+    _active: list[bool]
+    _cond: Condition
+    _space: Semaphore
+    _idle: int
+    _next: int
+    _end: Any
+    def __init__(self, maxsize: int = 512) -> None:
+        self._deques = []
+        self._active = []
+        self._cond = Condition()
+        self._space = Semaphore(maxsize)
+        self._idle = 0
+        self._next = 0
+        self._end = None
+
+    def _take(self, uid: int) -> Any:
+        try: return self._deques[uid].popleft()
+        except IndexError: pass
+        for victim in sorted(self._deques, key=len, reverse=True):
+            try: return victim.popleft()
+            except IndexError: continue
+        return None
+
+    def _register(self, uid: int) -> None:
+        with self._cond:
+            # _active first: readers outside the lock index it by len(_deques)
+            while uid >= len(self._deques):
+                self._active.append(True)
+                self._deques.append(deque())
+
+    def put(self, msg: Any) -> None:
+        self._space.acquire()
+        with self._cond:
+            # a connection added by the tuner registers concurrently
+            if not self._deques: self._register(0)
+            count = len(self._deques)
+            target = self._next % count
+            for step in range(count):
+                if self._active[(self._next + step) % count]:
+                    target = (self._next + step) % count
+                    break
+            self._next = target + 1
+            self._deques[target].append(msg)
+            if self._idle: self._cond.notify_all()
+
+    def get(self, uid: int) -> Any:
+        if uid >= len(self._deques): self._register(uid)
+        while True:
+            msg = self._take(uid)
+            if msg is not None:
+                self._space.release()
+                if self._idle:
+                    with self._cond: self._cond.notify_all()
+                return msg
+            with self._cond:
+                # re-check under the lock so a concurrent put is not missed
+                self._idle += 1
+                msg = self._take(uid)
+                if msg is None:
+                    if self._end is not None:
+                        self._idle -= 1
+                        return self._end
+                    self._cond.wait(WAIT_TIMEOUT)
+                # join may be waiting for this task to be taken
+                elif self._idle > 1: self._cond.notify_all()
+                self._idle -= 1
+            if msg is not None:
+                self._space.release()
+                return msg
+
+    def leave(self, uid: int) -> None:
+        r'''线程`uid`不再取任务, 之后的任务不再放入其队列, 已有的任务由其他线程窃取.'''
+        if uid < len(self._active): self._active[uid] = False
+
+    def pending(self) -> int:
+        return sum(len(tasks) for tasks in self._deques)
+
+    def join(self) -> None:
+        r'''等待所有任务被取走.'''
+        with self._cond:
+            self._idle += 1
+            while self.pending(): self._cond.wait(WAIT_TIMEOUT)
+            self._idle -= 1
+
+    def close(self, end: Any) -> None:
+        r'''不再放入任务, 此后取不到任务的线程得到`end`.'''
+        with self._cond:
+            self._end = end
+            self._cond.notify_all()
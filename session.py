@@ -0,0 +1,501 @@
+from tcp import *
+from config import *
+from logger import ThreadLogger, LoggerWrapper
+from task import *
+from thread import *
+from codec import CompressPolicy, CompressStats
+from journal import make_job_id, Journal
+from dedup import SentChunks, ChunkStore
+from aio import AioSender, AioReceiver, aio_send_supported, aio_recv_supported
+from tuner import PeerMemory, ConnTuner, ConnAcceptor
+from dirtree import send_dirs, recv_dirs, make_dirs
+from metrics import Metrics, Progress
+
+import os
+from socket import *
+from typing import Any, Union
+
+__all__ = ['SEND_DEFAULTS', 'RECV_DEFAULTS', 'scan_task', 'send_task', 'recv_task']
+
+# default send config, overridden by Configs/cfg_send.json
+SEND_DEFAULTS: dict[str, Any] = {
+    "save_logs": False,
+    "log_level": 'info',
+    "thread_count": 20,
+    "split_limit": '16MB',
+    "split_policy": 'adaptive',
+    "split_min": '1MB',
+    "split_max": '128MB',
+    "schedule": 'largest',
+    "scan_workers": 8,
+    "stream_scan": False,
+    "dir_compress": True,
+    "stats_file": r'.\Logs\send_stats.json',
+    "stats_interval": 2.0,
+    "progress_interval": 0.5,
+    "data_mode": 'stream',
+    "framing": FRAME_V1,
+    "packet_codec": True,
+    "ack_window": 32,
+    "bundle_limit": '64KB',
+    "bundle_size": '4MB',
+    "compression": 'none',
+    "compress_level": 1,
+    "compress_ratio": 0.9,
+    "checksum": 'none',
+    "resume": True,
+    "delta": False,
+    "delta_min": '64MB',
+    "dedup": False,
+    "dedup_min": '64KB',
+    "engine": 'thread',
+    "io_workers": 4,
+    "auto_tune": True,
+    "thread_min": 4,
+    "thread_max": 64,
+    "tune_step": 4,
+    "tune_interval": 2.0,
+    "tune_gain": 0.05,
+    "lang_file": r'.\Locales\zh_CN.json',
+}
+
+# default receive config, overridden by Configs/cfg_recv.json
+RECV_DEFAULTS: dict[str, Any] = {
+    "save_logs": False,
+    "log_level": 'info',
+    "lang_file": r'.\Locales\zh_CN.json',
+    "block_cache": r'.\Cache',
+    "direct_write": True,
+    "journal_dir": r'.\Journal',
+    "engine": 'thread',
+    "io_workers": 4,
+    "mkdir_workers": 8,
+    "stats_file": r'.\Logs\recv_stats.json',
+    "stats_interval": 2.0,
+    "progress_interval": 0.5
+}
+
+def scan_task(start_config: JsonFileConfig, target_path: str,
+             main_logger: LoggerWrapper, lang_text: LangFile) -> dict[str, Any]:
+    r'''扫描`target_path`并显示任务信息, 返回`get_task_config`给出的任务配置.'''
+    # get task info
+    ## a streamed scan sends the folder list with stop_fm, which needs FRAME_V2
+    stream_scan = start_config['stream_scan'] and start_config['framing'] == FRAME_V2
+    task_config = get_task_config(
+        target_path, start_config['scan_workers'], stream_scan
+    )
+    tree_scan = task_config['file_entry'] if task_config['file_count'] is None else None
+    ## show task info
+    main_logger.info(lang_text('show_task.type'), task_config['task_type'])
+    main_logger.info(lang_text('show_task.choose_path'), task_config['apex_path'])
+    if tree_scan is None:
+        main_logger.info(lang_text('show_task.file_count'), task_config['file_count'])
+        main_logger.info(lang_text('show_task.total_size'), task_config['total_size'])
+    else: main_logger.info(lang_text('show_task.stream_scan'))
+    return task_config
+
+def send_task(start_config: JsonFileConfig, task_config: dict[str, Any],
+              client_addr: tuple[str, int], thread_logger: ThreadLogger,
+              lang_text: LangFile, peer_memory: PeerMemory) -> None:
+    r'''
+    连接接收端`client_addr`并发送`scan_task`得到的任务, 直到发出`stop_fm`与文件夹清单.
+    自动调优得到的连接数记录在`peer_memory`中.
+    '''
+    main_logger = thread_logger.getWrapperInstance('main')
+    tree_scan = task_config['file_entry'] if task_config['file_count'] is None else None
+
+    # connect to client
+    main_packer = Packer(Coder(), 'loose', main_logger)
+    info_exchange = socket(AF_INET, SOCK_STREAM)
+    info_exchange.connect(client_addr)
+    
+    # choose engine
+    use_aio = start_config['engine'] == 'asyncio'
+    if use_aio and not aio_send_supported(start_config):
+        main_logger.warn(lang_text('send.engine.fallback'))
+        use_aio = False
+
+    # an older receiver only speaks FRAME_V1 with per-message beats and packet data
+    framing: int = start_config['framing']
+    ack_window = start_config['ack_window'] if framing == FRAME_V2 else 0
+    data_mode = start_config['data_mode'] if framing == FRAME_V2 else 'packet'
+
+    # connection count, tuned per receiver on the thread engine
+    ## an older receiver accepts exactly thread_cnt connections
+    auto_tune = start_config['auto_tune'] and not use_aio and framing == FRAME_V2
+    thread_cnt = start_config['thread_count']
+    if auto_tune:
+        thread_cnt = max(
+            start_config['thread_min'],
+            min(start_config['thread_max'], peer_memory.get(client_addr[0]) or 0)
+        )
+
+    # send task info
+    main_logger.info(lang_text('send.launch.connected'))
+    apex_path: str = task_config['apex_path']
+    ## the receiver's done set may exceed a FRAME_V1 packet
+    resume = start_config['resume'] and framing == FRAME_V2
+    ## the job id needs the totals of the whole tree
+    resume = resume and tree_scan is None
+    task_info = {
+        "type": task_config['task_type'],
+        "file_name": os.path.basename(apex_path),
+        "file_count": task_config['file_count'],
+        "total_size": task_config['total_size'],
+        "thread_cnt": thread_cnt,
+        "auto_tune": auto_tune,
+        "framing": framing,
+        "ack_window": ack_window,
+        "checksum": start_config['checksum'],
+        "delta": start_config['delta'],
+        "dedup": start_config['dedup'],
+        "block_path": True,
+        "stream_scan": tree_scan is not None,
+        "dir_manifest": framing == FRAME_V2
+    }
+    if resume: task_info['job_id'] = make_job_id(task_config)
+    main_packer.sendPacket(info_exchange, task_info)
+    ## later packets use the negotiated framing
+    main_packer = Packer(Coder(), 'loose', main_logger, framing)
+
+    # send dir info
+    main_logger.info(lang_text('send.prepare.folder'))
+    rel_dirs = [dir_path.removeprefix(apex_path) for dir_path in task_config['dir_path']]
+    if framing == FRAME_V2:
+        send_dirs(main_packer, info_exchange, rel_dirs, start_config['dir_compress'])
+    else:
+        ## one packet per folder, as older receivers expect
+        main_packer.sendPacket(info_exchange, len(rel_dirs))
+        for rel_dir in rel_dirs: main_packer.sendPacket(info_exchange, rel_dir)
+    del rel_dirs
+
+    # work confirmed by the receiver in an interrupted session
+    done = main_packer.recvPacket(info_exchange) if resume else None
+
+    # task releaser
+    task_releaser = TaskReleaser(
+        task_config, start_config,
+        lang_text, thread_logger.getWrapperInstance('TaskReleaser'), done
+    )
+    task_queue = task_releaser.get_reference()
+
+    # compression policy shared by all threads
+    compress_policy = None
+    if start_config['compression'] != 'none' and framing == FRAME_V2:
+        compress_policy = CompressPolicy(
+            start_config['compression'],
+            start_config['compress_level'],
+            start_config['compress_ratio']
+        )
+
+    # digests of verified blocks, sent as a manifest with stop_fm
+    digest_book = DigestBook()
+
+    # chunks already sent in this job, shared by all threads
+    sent_chunks = SentChunks()
+
+    # per-connection counters and the scheduler depth, sampled to a stats file
+    metrics = Metrics(
+        start_config['stats_file'], start_config['stats_interval'],
+        thread_logger.getWrapperInstance('Metrics'), lang_text
+    )
+    metrics.gauge('queue_depth', task_queue.pending)
+    metrics.run()
+
+    # one refreshing progress line instead of counting log lines
+    if tree_scan is None:
+        progress_total = lambda: (task_config['total_size'], task_config['file_count'], True)
+    else:
+        progress_total = lambda: (
+            tree_scan.total_size, tree_scan.file_count, tree_scan.finished
+        )
+    progress = Progress(
+        metrics, main_logger, lang_text, progress_total,
+        task_releaser.skipped_work, start_config['progress_interval']
+    )
+    progress.run()
+
+    # make threads
+    def make_send_thread(uid: int) -> SendThread:
+        send_thread = SendThread(
+            task_queue, client_addr, uid,
+            thread_logger.getWrapperInstance(f'SendThread{uid}'),
+            start_config['lang_file'], data_mode,
+            framing, start_config['packet_codec'],
+            ack_window, compress_policy,
+            start_config['checksum'], digest_book, sent_chunks,
+            metrics.conn(f'SendThread{uid}')
+        )
+        send_thread.run()
+        return send_thread
+
+    send_thread_list: list[Union[SendThread, AioSender]]
+    tuner = None
+    if use_aio:
+        send_thread_list = [AioSender(
+            task_queue, client_addr, thread_cnt,
+            thread_logger.getWrapperInstance('AioSender'),
+            start_config['lang_file'], data_mode,
+            start_config['packet_codec'], ack_window,
+            start_config['checksum'], digest_book, start_config['io_workers'],
+            metrics
+        )]
+        send_thread_list[0].run()
+    elif auto_tune:
+        tuner = ConnTuner(
+            make_send_thread, thread_logger.getWrapperInstance('ConnTuner'),
+            lang_text, thread_cnt, start_config['tune_step'],
+            start_config['thread_max'], start_config['tune_interval'],
+            start_config['tune_gain']
+        )
+        tuner.launch()
+        ## grows while tasks are handed out, fixed once the releaser finishes
+        send_thread_list = tuner.threads
+    else:
+        send_thread_list = [make_send_thread(i) for i in range(thread_cnt)]
+
+    # give control to TaskReleaser
+    if tuner is None: task_releaser.loop()
+    else: task_releaser.loop(tuner.finish, tuner.live_count)
+
+    # remember the tuned count for this receiver
+    if tuner is not None:
+        peer_memory.set(client_addr[0], tuner.finish())
+        peer_memory.save()
+
+    # wait join
+    main_logger.info(lang_text('send.work.wait_quit'))
+    for t in send_thread_list: t.join()
+    progress.stop()
+    metrics.stop()
+
+    # compression report
+    if compress_policy is not None:
+        compress_stats = CompressStats()
+        for t in send_thread_list: compress_stats.merge(t.get_compress_stats())
+        main_logger.info(lang_text('send.compress.report').format(
+            compress_stats.raw_bytes, compress_stats.sent_bytes,
+            compress_stats.saved(), compress_stats.cpu_time
+        ))
+
+    if sent_chunks.saved_bytes > 0:
+        main_logger.info(lang_text('send.dedup.report').format(sent_chunks.saved_bytes))
+
+    # send stop fm
+    stop_args = {"reason": lang_text('msg.task_end')}
+    ## files given up after the retry limit, the receiver keeps its journal
+    stop_args['failed'] = [
+        rel_path for t in send_thread_list for rel_path in t.failed
+    ]
+    ## the manifest may exceed a FRAME_V1 packet
+    if framing == FRAME_V2 and start_config['checksum'] != 'none':
+        stop_args['manifest'] = digest_book.manifest()
+    ## totals of a streamed scan, its folders follow as a manifest
+    if tree_scan is not None:
+        stop_args['dir_manifest'] = True
+        stop_args['file_count'] = tree_scan.file_count
+        stop_args['total_size'] = tree_scan.total_size
+        main_logger.info(lang_text('show_task.file_count'), tree_scan.file_count)
+        main_logger.info(lang_text('show_task.total_size'), tree_scan.total_size)
+    main_packer.sendPacket(info_exchange, Msg.make_dict(
+        Msg('stop_fm', stop_args)
+    ))
+    ## folders (including empty ones) of a streamed scan
+    if tree_scan is not None:
+        send_dirs(
+            main_packer, info_exchange,
+            [dir_path.removeprefix(apex_path) for dir_path in tree_scan.dir_path],
+            start_config['dir_compress']
+        )
+
+def recv_task(start_config: JsonFileConfig, info_exchange: socket,
+              tcp_accept_socket: socket, save_folder: str,
+              thread_logger: ThreadLogger, lang_text: LangFile) -> None:
+    r'''
+    由已连接的`info_exchange`接收任务, 数据连接从`tcp_accept_socket`接受,
+    文件保存到`save_folder`下. 返回时所有接收线程已结束.
+    '''
+    main_logger = thread_logger.getWrapperInstance('main')
+    main_packer = Packer(Coder(), 'loose', main_logger)
+    task_config = main_packer.recvPacket(info_exchange)
+    ## show task info
+    main_logger.info(lang_text('show_task.type'), task_config['type'])
+    main_logger.info(lang_text('show_task.file_name'), task_config['file_name'])
+    if task_config.get('stream_scan', False):
+        main_logger.info(lang_text('show_task.stream_scan'))
+    else:
+        main_logger.info(lang_text('show_task.file_count'), task_config['file_count'])
+        main_logger.info(lang_text('show_task.total_size'), task_config['total_size'])
+    main_logger.info(lang_text('show_task.thread_cnt'), task_config['thread_cnt'])
+    ## older senders do not announce framing
+    framing = task_config.get('framing', FRAME_V1)
+    main_packer = Packer(Coder(), 'loose', main_logger, framing)
+    
+    # recv dir info
+    main_logger.info(lang_text('recv.prepare.folder'))
+    dir_name: str = task_config['file_name']
+    ## older senders send one packet per folder
+    if task_config.get('dir_manifest', False):
+        rel_paths = recv_dirs(main_packer, info_exchange)
+    else:
+        dir_path_cnt = main_packer.recvPacket(info_exchange)
+        rel_paths = [main_packer.recvPacket(info_exchange) for _ in range(dir_path_cnt)]
+    dir_paths: list[str] = [
+        os.path.join(save_folder, dir_name) + rel_path for rel_path in rel_paths
+    ]
+    main_logger.info(lang_text('recv.prepare.folder_cnt'), len(dir_paths))
+
+    # make apex_path
+    if task_config['type'] == 'file':
+        apex_path = save_folder
+    elif task_config['type'] == 'dir':
+        apex_path = os.path.join(save_folder, dir_name)
+
+    # create dirs
+    main_logger.info(lang_text('recv.prepare.create_folder'))
+    skip_create = make_dirs(dir_paths, start_config['mkdir_workers'])
+    if skip_create > 0:
+        main_logger.warn(lang_text('recv.prepare.warn_skip'), skip_create)
+    del rel_paths, dir_paths, skip_create
+
+    # verified digests, checked against the sender's manifest
+    checksum: str = task_config.get('checksum', 'none')
+    digest_book = DigestBook() if checksum != 'none' else None
+
+    # direct write needs self-describing block headers from the sender
+    block_writer = None
+    if start_config['direct_write'] and task_config.get('block_path', False):
+        block_writer = BlockWriter(
+            lang_text, thread_logger.getWrapperInstance('BlockWriter')
+        )
+        main_logger.info(lang_text('recv.prepare.direct_write'))
+    else:
+        # create cache folder
+        if not os.path.exists(start_config['block_cache']):
+            os.makedirs(start_config['block_cache'])
+        main_logger.info(lang_text('recv.prepare.cache'), start_config['block_cache'])
+
+    # resume journal keyed by the sender's job id
+    journal = None
+    resumed = (0, 0)
+    if task_config.get('job_id') is not None:
+        os.makedirs(start_config['journal_dir'], exist_ok=True)
+        journal = Journal(os.path.join(
+            start_config['journal_dir'], f"{task_config['job_id']}.journal"
+        ))
+        if journal.size() > 0:
+            main_logger.info(lang_text('recv.prepare.resume'), journal.size())
+        done = journal.done_set()
+        ## cached blocks are not journaled, split files restart in merge mode
+        if block_writer is None: done['blocks'] = []
+        resumed = (
+            sum(size for _, size in done['files']) + sum(block[2] for block in done['blocks']),
+            len(done['files'])
+        )
+        main_packer.sendPacket(info_exchange, done)
+
+    # locations of deduplicated chunks, shared by all threads
+    chunk_store = ChunkStore() if task_config.get('dedup', False) else None
+
+    # create MergeFile
+    merge_file = MergeFile(
+        lang_text, thread_logger.getWrapperInstance('MergeFile'),
+        framing, digest_book, journal
+    )
+    merge_msg = merge_file.get_queue()
+
+    # per-connection counters and the merge backlog, sampled to a stats file
+    metrics = Metrics(
+        start_config['stats_file'], start_config['stats_interval'],
+        thread_logger.getWrapperInstance('Metrics'), lang_text
+    )
+    metrics.gauge('merge_backlog', merge_file.backlog)
+    metrics.run()
+
+    # totals of a streamed scan arrive with stop_fm
+    progress = Progress(
+        metrics, main_logger, lang_text,
+        lambda: (
+            task_config['total_size'] or 0, task_config['file_count'] or 0,
+            not task_config.get('stream_scan', False)
+        ),
+        lambda: resumed, start_config['progress_interval']
+    )
+    progress.run()
+
+    # create receivers
+    def make_recv_thread(connection: socket, uid: int) -> RecvThread:
+        return RecvThread(
+            merge_msg, connection, uid,
+            thread_logger.getWrapperInstance(f'RecvThread{uid}'),
+            start_config['lang_file'], apex_path, start_config['block_cache'],
+            framing, task_config.get('ack_window', 0), block_writer,
+            checksum, digest_book, journal, chunk_store,
+            metrics.conn(f'RecvThread{uid}')
+        )
+
+    main_logger.info(lang_text('recv.prepare.recv_connect'))
+    recv_threads: list[Union[RecvThread, AioReceiver]] = []
+    use_aio = start_config['engine'] == 'asyncio'
+    if use_aio and not aio_recv_supported(task_config):
+        main_logger.warn(lang_text('recv.engine.fallback'))
+        use_aio = False
+    acceptor = None
+    if task_config.get('auto_tune', False):
+        ## the sender opens and retires connections while tuning
+        acceptor = ConnAcceptor(tcp_accept_socket, make_recv_thread)
+        acceptor.run()
+    else:
+        connections: list[socket] = []
+        for i in range(task_config['thread_cnt']):
+            connection, addr = tcp_accept_socket.accept()
+            connections.append(connection)
+        if use_aio:
+            recv_threads.append(AioReceiver(
+                merge_msg, connections,
+                thread_logger.getWrapperInstance('AioReceiver'),
+                start_config['lang_file'], apex_path, start_config['block_cache'],
+                task_config['ack_window'], block_writer,
+                checksum, digest_book, journal, start_config['io_workers'],
+                metrics
+            ))
+        else:
+            for i, connection in enumerate(connections):
+                recv_threads.append(make_recv_thread(connection, i))
+        ## launch threads
+        for t in recv_threads: t.run()
+
+    # give control to merge_file
+    stop_msg = merge_file.loop(info_exchange)
+    ## a streamed scan sends its folders as a manifest after stop_fm
+    stream_dirs = None
+    if stop_msg['dir_manifest']:
+        stream_dirs = recv_dirs(main_packer, info_exchange)
+    info_exchange.close()
+    progress.stop()
+
+    # a streamed scan creates folders on demand, empty ones come after stop_fm
+    if stream_dirs is not None:
+        make_dirs(
+            [f'{apex_path}{rel_path}' for rel_path in stream_dirs],
+            start_config['mkdir_workers']
+        )
+        main_logger.info(lang_text('recv.prepare.folder_cnt'), len(stream_dirs))
+        main_logger.info(lang_text('show_task.file_count'), stop_msg['file_count'])
+        main_logger.info(lang_text('show_task.total_size'), stop_msg['total_size'])
+
+    # wait join
+    main_logger.info(lang_text('recv.work.wait_quit'))
+    ## every sender connection has ended once stop_fm arrives
+    if acceptor is not None:
+        acceptor.stop()
+        recv_threads = acceptor.threads
+    for t in recv_threads: t.join()
+    ## files with blocks the sender gave up are never completed
+    if block_writer is not None: block_writer.abandon()
+    metrics.stop()
+    if journal is not None:
+        ## a failed or unverified run keeps its journal for the next attempt
+        finished = not stop_msg['failed'] and merge_file.verified()
+        if not finished: main_logger.warn(lang_text('recv.resume.kept'))
+        journal.close(finished)
@@ -4,26 +4,34 @@ Author: DarkskyX15
 LastEditTime: 2024-07-24 13:52:14
 '''
 
-from time import sleep
 from os import path, remove
-from typing import Literal, Any, BinaryIO
-from queue import Queue, Full, Empty
-from tool import get_multi_paths, make_short_log, size_to_byte
+import os
+from typing import Literal, Any, BinaryIO, Iterator, Callable, Union
+from queue import Queue
+from tool import make_short_log, size_to_byte, open_target
+from scan import FileEntry, TreeScan, scan_tree
 from logger import LoggerWrapper
 from config import LangFile
-from threading import Thread
+from threading import Thread, Lock, Event
 from socket import *
 from tcp import *
+from journal import Journal
+from scheduler import Scheduler
 
-__all__ = ['MSG_TYPE', 'Msg',
-           'get_task_config', 'TaskReleaser', 'MergeFile']
+__all__ = ['MSG_TYPE', 'Msg', 'get_task_config', 'SplitPolicy', 'TaskReleaser',
+           'MergeFile', 'BlockWriter', 'DigestBook']
 
 MSG_TYPE = Literal[
     'end', 'single', 'split',
     'block', 'block_end', 'stop_fm',
-    'bad_package'
+    'bundle', 'sync', 'delta', 'dedup', 'bad_package', 'give_up'
 ]
 
+BUNDLE_MAX_ENTRIES = 1024
+SPLIT_ALIGN = 1048576
+# blocks per connection left in the remaining work under the adaptive policy
+TASKS_PER_CONN = 4
+
 class Msg:
     msg: MSG_TYPE
     args: dict[str, Any]
@@ -46,158 +54,367 @@ class Msg:
         if data is None: return Msg('bad_package', {})
         return Msg(data.get('msg', 'bad_package'), data.get('args', {}))
 
-def get_task_config(task_path: str) -> dict[str, Any]:
+def get_task_config(task_path: str, scan_workers: int = 8,
+                    stream: bool = False) -> dict[str, Any]:
+    r'''
+    扫描`task_path`生成任务配置. `file_entry`中的大小与修改时间随任务传给`TaskReleaser`,
+    每个文件只stat一次.
+
+    `stream`为真时不等待扫描结束: `file_entry`为`TreeScan`, 文件数与总大小为`None`,
+    文件夹列表在扫描结束后由`TreeScan`给出.
+    '''
     task_config: dict[str, Any]
     task_path = task_path.removesuffix('\\')
     if path.isfile(task_path):
+        stat = os.stat(task_path)
         task_config = {
             "task_type": 'file',
             "apex_path": task_path,
             "dir_path": [],
             "file_count": 1,
-            "file_path": [task_path],
-            "total_size": path.getsize(task_path)
+            "file_entry": [FileEntry(task_path, stat.st_size, stat.st_mtime)],
+            "total_size": stat.st_size
         }
     else:
         task_config = {
             "task_type": 'dir',
             "apex_path": task_path,
         }
-        tot_size = 0
-        file_path, dir_path = get_multi_paths(task_path)
-        for file in file_path:
-            tot_size += path.getsize(file)
-        task_config['file_path'] = file_path
+        if stream:
+            task_config['file_entry'] = TreeScan(task_path, scan_workers)
+            task_config['dir_path'] = []
+            task_config['total_size'] = None
+            task_config['file_count'] = None
+            return task_config
+        file_entry, dir_path = scan_tree(task_path, scan_workers)
+        task_config['file_entry'] = file_entry
         task_config['dir_path'] = dir_path
-        task_config['total_size'] = tot_size
-        task_config['file_count'] = len(file_path)
+        task_config['total_size'] = sum(entry.size for entry in file_entry)
+        task_config['file_count'] = len(file_entry)
     return task_config
 
-class TaskReleaser:
-    _msg_queue: Queue
-    _push_buffer: list[Msg]
+class SplitPolicy:
+    r'''
+    决定每个文件的分块大小.
+    - `fixed`: 沿用`split_limit`
+    - `adaptive`: 块大小取`剩余字节 / (连接数 * TASKS_PER_CONN)`, 对齐到1MB并限制在
+      `split_min`与`split_max`之间. 任务前段剩余工作多, 块较大, 分块与缓存文件较少;
+      临近结束时块变小, 使全部连接都有数据可发.
+
+    文件大于1.5倍块大小时才分块. `consume`登记已生成任务的文件, 用于计算剩余字节;
+    边扫描边发送时总大小随扫描增长, 由`set_total`更新.
+    '''
+    _adaptive: bool
     _split_limit: int
+    _split_min: int
+    _split_max: int
+    _total: int
+    _consumed: int
+    def __init__(self, start_info: dict[str, Any], total_size: int) -> None:
+        self._adaptive = start_info['split_policy'] == 'adaptive'
+        self._split_limit = size_to_byte(start_info['split_limit'])
+        self._split_min = max(SPLIT_ALIGN, size_to_byte(start_info['split_min']))
+        self._split_max = max(self._split_min, size_to_byte(start_info['split_max']))
+        self._total = total_size or 0
+        self._consumed = 0
+
+    def block_size(self, file_size: int, connections: int) -> int:
+        r'''返回`file_size`字节的文件应使用的块大小, 不分块时返回0.'''
+        if not self._adaptive: block = self._split_limit
+        else:
+            left = max(0, self._total - self._consumed)
+            block = left // (max(1, connections) * TASKS_PER_CONN)
+            block = block // SPLIT_ALIGN * SPLIT_ALIGN
+            block = max(self._split_min, min(self._split_max, block))
+        return block if file_size > 1.5 * block else 0
+
+    def consume(self, file_size: int) -> None:
+        self._consumed += file_size
+
+    def set_total(self, total_size: int) -> None:
+        self._total = total_size
+
+class TaskReleaser:
+    _msg_queue: Scheduler
+    _split: SplitPolicy
+    _live_count: Callable[[], int]
     _apex_path: str
-    _file_list: list[str]
+    _file_list: Union[list[FileEntry], TreeScan]
+    _schedule: str
     _task_type: str
     _thread_cnt: int
     _logger: LoggerWrapper
     _locale: LangFile
     _split_id: int
+    _bundle_limit: int
+    _bundle_size: int
+    _bundle: list[list]
+    _bundle_bytes: int
+    _delta_min: int
+    _dedup_min: int
+    _done_files: dict[str, int]
+    _done_blocks: set[tuple[str, int, int]]
+    _done_splits: dict[str, list[tuple[int, int]]]
+    _skipped: list[int]
+    _skipped_work: list[int]
     def __init__(self, task_info: dict[str, Any],
                  start_info: dict[str, Any],
                  locale: LangFile,
-                 logger: LoggerWrapper) -> None:
+                 logger: LoggerWrapper,
+                 done: dict[str, list] = None) -> None:
         self._split_id = 0
-        self._msg_queue = Queue(512)
-        self._split_limit = size_to_byte(start_info['split_limit'])
+        self._msg_queue = Scheduler(512)
+        self._split = SplitPolicy(start_info, task_info['total_size'])
         self._thread_cnt = start_info['thread_count']
+        self._live_count = lambda: self._thread_cnt
         self._apex_path = task_info['apex_path']
-        self._file_list = task_info['file_path']
+        self._file_list = task_info['file_entry']
+        self._schedule = start_info['schedule']
         self._task_type = task_info['task_type']
         self._logger = logger
         self._locale = locale
-        self._push_buffer = []
-    
-    def _generate_task(self, file_path: str) -> None:
-        file_size = path.getsize(file_path)
+        # bundle headers list every entry, so they need FRAME_V2
+        if start_info['framing'] == FRAME_V2:
+            self._bundle_limit = size_to_byte(start_info['bundle_limit'])
+        else: self._bundle_limit = 0
+        self._bundle_size = size_to_byte(start_info['bundle_size'])
+        # delta replies need FRAME_V2 and the windowed ack stream to sync on
+        if start_info['delta'] and start_info['framing'] == FRAME_V2 \
+            and start_info['ack_window'] > 0:
+            self._delta_min = size_to_byte(start_info['delta_min'])
+        else: self._delta_min = 0
+        # unresolved chunk references are repaired through nacks
+        if start_info['dedup'] and start_info['framing'] == FRAME_V2 \
+            and start_info['ack_window'] > 0:
+            self._dedup_min = size_to_byte(start_info['dedup_min'])
+        else: self._dedup_min = 0
+        self._bundle = []
+        self._bundle_bytes = 0
+        # work the receiver already confirmed in an earlier session
+        if done is None: done = {"files": [], "blocks": []}
+        self._done_files = dict(done['files'])
+        self._done_blocks = set(tuple(block) for block in done['blocks'])
+        ## a resumed file keeps the block size of the interrupted session
+        self._done_splits = {}
+        for rel_path, front, size in self._done_blocks:
+            self._done_splits.setdefault(rel_path, []).append((front, size))
+        self._skipped = [0, 0]
+        self._skipped_work = [0, 0]
+
+    def _flush_bundle(self) -> Iterator[Msg]:
+        if not self._bundle: return
+        self._logger.info(
+            self._locale('send.work.make_task').format('bundle'),
+            len(self._bundle)
+        )
+        yield Msg('bundle', {
+            "entries": self._bundle,
+            "size": self._bundle_bytes
+        })
+        self._bundle = []
+        self._bundle_bytes = 0
+
+    def _generate_task(self, file_entry: FileEntry) -> Iterator[Msg]:
+        r'''逐个产生`file_entry`对应的任务, 任务只记录路径、偏移与长度, 由发送线程按需打开文件.'''
+        file_path, file_size, _ = file_entry
         rel_path = file_path.removeprefix(self._apex_path)
-        if file_size > 1.5 * (self._split_limit):
+        if isinstance(self._file_list, TreeScan):
+            self._split.set_total(self._file_list.total_size)
+        block_size = self._block_size(rel_path, file_size)
+        self._split.consume(file_size)
+        if self._done_files.get(rel_path) == file_size:
+            self._skipped[0] += 1
+            self._skipped_work[0] += file_size
+            self._skipped_work[1] += 1
+            return
+        if self._delta_min and file_size >= self._delta_min:
+            self._logger.info(
+                self._locale('send.work.make_task').format('delta'),
+                make_short_log(file_path)
+            )
+            yield Msg('delta', {
+                "file_path": file_path,
+                "path": rel_path,
+                "size": file_size
+            })
+            return
+        if self._dedup_min and file_size >= self._dedup_min:
+            self._logger.info(
+                self._locale('send.work.make_task').format('dedup'),
+                make_short_log(file_path)
+            )
+            yield Msg('dedup', {
+                "file_path": file_path,
+                "path": rel_path,
+                "size": file_size
+            })
+            return
+        if block_size:
+            # `cnt` counts the blocks sent in this session only
+            blocks = [
+                (block_index, front, min(block_size, file_size - front))
+                for block_index, front in enumerate(range(0, file_size, block_size))
+            ]
+            remain = [block for block in blocks
+                      if (rel_path, block[1], block[2]) not in self._done_blocks]
+            self._skipped[1] += len(blocks) - len(remain)
+            self._skipped_work[0] += file_size - sum(block[2] for block in remain)
+            # the remaining blocks count as one whole file in progress
+            if not remain:
+                self._skipped_work[1] += 1
+                return
             self._logger.info(
                 self._locale('send.work.make_task').format('split'),
                 make_short_log(file_path)
             )
-            block_cnt = file_size // self._split_limit
-            final_block = file_size - block_cnt * self._split_limit
-            self._msg_queue.put(Msg('split', {
+            yield Msg('split', {
                 "size": file_size,
                 "sid": self._split_id,
                 "path": rel_path,
-                "cnt": block_cnt + (1 if final_block > 0 else 0)
-            }))
-            block_index = 0
-            for front in range(0, file_size - final_block, self._split_limit):
-                file = open(file_path, 'rb')
-                file.seek(front)
-                self._msg_queue.put(Msg('block', {
-                    "size": self._split_limit,
-                    "index": block_index,
-                    "file": file,
-                    "sid": self._split_id
-                }))
-                block_index += 1
-            if final_block > 0:
-                file = open(file_path, 'rb')
-                file.seek(block_cnt * self._split_limit)
-                self._msg_queue.put(Msg('block', {
-                    "size": final_block,
+                "cnt": len(remain)
+            })
+            for block_index, front, size in remain:
+                yield Msg('block', {
+                    "size": size,
                     "index": block_index,
-                    "file": file,
-                    "sid": self._split_id
-                }))
+                    "front": front,
+                    "file_path": file_path,
+                    "sid": self._split_id,
+                    "path": rel_path,
+                    "total": file_size,
+                    "cnt": len(remain)
+                })
             self._split_id += 1
+        elif file_size < self._bundle_limit:
+            self._bundle.append([file_path, rel_path, file_size])
+            self._bundle_bytes += file_size
+            if self._bundle_bytes >= self._bundle_size \
+                or len(self._bundle) >= BUNDLE_MAX_ENTRIES:
+                yield from self._flush_bundle()
         else:
             self._logger.info(
                 self._locale('send.work.make_task').format('single'),
                 make_short_log(file_path)
             )
-            self._msg_queue.put(Msg('single', {
-                "file": open(file_path, 'rb'),
+            yield Msg('single', {
+                "file_path": file_path,
                 "path": rel_path,
                 "size": file_size
-            }))
-
-    def _try_push(self) -> None:
-        index = 0
-        buffer_size = len(self._push_buffer)
-        while index < buffer_size:
-            try:
-                self._msg_queue.put_nowait(self._push_buffer[index])
-            except Full:
-                sleep(1.0)
-                continue
-            index += 1
-        self._push_buffer.clear()
+            })
 
-    def _end_work(self) -> None:
-        for _ in range(self._thread_cnt):
-            self._push_buffer.append(Msg('end',{
-                "reason": self._locale('msg.task_end')
-            }))
-        self._try_push()
+    def _block_size(self, rel_path: str, file_size: int) -> int:
+        for front, size in self._done_splits.get(rel_path, []):
+            # any block but the last one has the full block size
+            if front + size < file_size: return size
+        return self._split.block_size(file_size, self._live_count())
 
-    def loop(self) -> None:
-        self._logger.info(self._locale('send.work.loop'))
+    def _generate_tasks(self) -> Iterator[Msg]:
         if self._task_type == 'dir':
-            for file_path in self._file_list:
-                self._generate_task(file_path)
-                self._try_push()
+            file_list = self._file_list
+            # a streamed scan is sent in discovery order
+            if self._schedule == 'largest' and not isinstance(file_list, TreeScan):
+                # big files first keep them off the tail, small files and bundles fill the gaps
+                file_list = sorted(file_list, key=lambda entry: entry.size, reverse=True)
+            for file_entry in file_list:
+                yield from self._generate_task(file_entry)
+            yield from self._flush_bundle()
         elif self._task_type == 'file':
             self._apex_path = '\\'.join(self._apex_path.split('\\')[:-1])
-            self._generate_task(self._file_list[0])
-            self._try_push()
-        self._end_work()
+            yield from self._generate_task(self._file_list[0])
+            # a small single file ends up in a bundle as well
+            yield from self._flush_bundle()
+
+    def loop(self, finish_tuning: Callable[[], int] = None,
+             live_count: Callable[[], int] = None) -> None:
+        r'''
+        生成全部任务, 任务全部被取走后关闭调度器, 此后发送线程取到`end`.
+        连接数由`ConnTuner`调整时, `live_count`给出当前的连接数供分块策略使用,
+        `finish_tuning`在任务全部被取走后结束调优.
+        '''
+        if live_count is not None: self._live_count = live_count
+        self._logger.info(self._locale('send.work.loop'))
+        # the bounded scheduler blocks generation until SendThreads catch up
+        for msg in self._generate_tasks():
+            self._msg_queue.put(msg)
         self._msg_queue.join()
+        if finish_tuning is not None: finish_tuning()
+        self._msg_queue.close(Msg('end', {
+            "reason": self._locale('msg.task_end')
+        }))
+        if self._skipped[0] or self._skipped[1]:
+            self._logger.info(
+                self._locale('send.resume.skip').format(*self._skipped)
+            )
         self._logger.info(self._locale('send.work.end'))
-    
-    def get_reference(self) -> Queue:
+
+    def skipped_work(self) -> tuple[int, int]:
+        r'''断点续传中已跳过的字节数与文件数, 随任务生成增长.'''
+        return self._skipped_work[0], self._skipped_work[1]
+
+    def get_reference(self) -> Scheduler:
         return self._msg_queue
 
+class DigestBook:
+    r'''
+    记录每个文件(分块文件按块序号)校验通过的摘要, 供发送端生成清单、接收端核对清单.
+    - `record`: 登记`rel_path`第`index`块的摘要
+    - `manifest`: 导出`{rel_path: [digest, ...]}`形式的清单
+    - `compare`: 返回与本地记录不一致的文件列表
+    '''
+    _lock: Lock
+    _digests: dict[str, dict[int, str]]
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._digests = {}
+
+    def record(self, rel_path: str, index: int, digest: str) -> None:
+        with self._lock:
+            self._digests.setdefault(rel_path, {})[index] = digest
+
+    def manifest(self) -> dict[str, list[str]]:
+        with self._lock:
+            return {
+                rel_path: [blocks[index] for index in sorted(blocks)]
+                for rel_path, blocks in self._digests.items()
+            }
+
+    def compare(self, manifest: dict[str, list[str]]) -> list[str]:
+        local = self.manifest()
+        return [
+            rel_path for rel_path, digests in manifest.items()
+            if local.get(rel_path) != digests
+        ]
+
 class MergeFile:
     _msg_queue: Queue
     _logger: LoggerWrapper
     _locale: LangFile
-    def __init__(self, locale: str, logger: LoggerWrapper) -> None:
+    _framing: int
+    _digest_book: DigestBook
+    _journal: Journal
+    _merge_queues: dict[int, Queue]
+    _bad_files: list[str]
+    def __init__(self, locale: str, logger: LoggerWrapper,
+                 framing: int = FRAME_V1, digest_book: DigestBook = None,
+                 journal: Journal = None) -> None:
         self._logger = logger
         self._locale = locale
+        self._framing = framing
+        self._digest_book = digest_book
+        self._journal = journal
         self._msg_queue = Queue()
+        self._merge_queues = {}
+        self._bad_files = []
 
     @staticmethod
-    def _merge_work(msg_queue: Queue, cnt: int, fpath: str) -> None:
-        writer = open(fpath, 'wb')
+    def _merge_work(msg_queue: Queue, cnt: int, fpath: str, done: Event,
+                    journal: Journal = None, rel_path: str = None,
+                    size: int = 0) -> None:
+        writer = open_target(fpath, 'wb')
         merge_buffer: set[int] = set()
         file_io_map: dict[int, tuple[BinaryIO, str]] = {}
         merge_index = 0
+        given_up = False
         while merge_index < cnt:
             if merge_index in merge_buffer:
                 file_io = file_io_map.get(merge_index)
@@ -211,22 +428,29 @@ class MergeFile:
                 file_io_map.pop(merge_index)
                 merge_index += 1
                 continue
-            try:
-                msg: Msg = msg_queue.get_nowait()
-                msg_queue.task_done()
-                if msg('block_end'):
-                    file_io = open(msg['path'], 'rb')
-                    file_io_map[msg['index']] = (file_io, msg['path'])
-                    merge_buffer.add(msg['index'])
-            except Empty:
-                sleep(1.0)
+            msg: Msg = msg_queue.get()
+            msg_queue.task_done()
+            if msg('block_end'):
+                file_io = open(msg['path'], 'rb')
+                file_io_map[msg['index']] = (file_io, msg['path'])
+                merge_buffer.add(msg['index'])
+            elif msg('give_up'):
+                # the sender gave up a block, the rest will never complete the file
+                for file_io in file_io_map.values():
+                    file_io[0].close()
+                    remove(file_io[1])
+                given_up = True
+                break
         del merge_buffer, file_io_map
         writer.close()
+        if journal is not None and not given_up:
+            journal.record_file(rel_path, size, fpath)
+        done.set()
 
     @staticmethod
-    def _manager_thread(msg_queue: Queue, sock: socket) -> None:
+    def _manager_thread(msg_queue: Queue, sock: socket, framing: int) -> None:
         sock.settimeout(None)
-        packer = Packer(Coder(), 'loose')
+        packer = Packer(Coder(), 'loose', framing=framing)
         while True:
             msg: Msg = Msg.make_msg(packer.recvPacket(sock))
             if msg('stop_fm'):
@@ -234,14 +458,46 @@ class MergeFile:
                 break
         del packer
 
-    def loop(self, manager: socket) -> None:
+    def _check_manifest(self, manifest: dict[str, list[str]]) -> None:
+        if manifest is None or self._digest_book is None: return
+        bad_files = self._digest_book.compare(manifest)
+        self._bad_files = bad_files
+        if not bad_files:
+            self._logger.info(
+                self._locale('recv.file_merge.manifest_ok'), len(manifest)
+            )
+            return
+        for rel_path in bad_files:
+            self._logger.error(
+                self._locale('recv.file_merge.manifest_bad'),
+                make_short_log(rel_path)
+            )
+            if self._journal is not None: self._journal.forget(rel_path)
+
+    def _give_up(self, failed: list[str], merge_done: dict[int, Event],
+                 merge_rel: dict[int, str]) -> None:
+        r'''停止发送端已放弃的文件的整合, 这些文件计入校验失败.'''
+        failed_set = set(failed)
+        for sid, done in merge_done.items():
+            if done.is_set() or merge_rel[sid] not in failed_set: continue
+            self._merge_queues[sid].put(Msg('give_up', {}))
+            self._bad_files.append(merge_rel[sid])
+            self._logger.error(
+                self._locale('recv.file_merge.give_up'),
+                make_short_log(merge_rel[sid])
+            )
+
+    def loop(self, manager: socket) -> Msg:
+        r'''整合分块文件直到收到`stop_fm`, 返回该消息供调用方处理其中的扫描结果.'''
         self._logger.info(self._locale('recv.file_merge.loop'))
         manager_thread = Thread(
             target=self._manager_thread,
-            args=(self._msg_queue, manager)
+            args=(self._msg_queue, manager, self._framing)
         )
         manager_thread.start()
-        msg_queue_map: dict[int, Queue] = {}
+        msg_queue_map = self._merge_queues
+        merge_done: dict[int, Event] = {}
+        merge_rel: dict[int, str] = {}
         merge_threads: list[Thread] = []
         while True:
             msg: Msg = self._msg_queue.get()
@@ -251,15 +507,21 @@ class MergeFile:
                     self._locale('recv.file_merge.stop'),
                     msg["reason"]
                 )
+                self._check_manifest(msg['manifest'])
+                self._give_up(msg['failed'] or [], merge_done, merge_rel)
+                stop_msg = msg
                 break
             elif msg('split'):
                 mq = msg_queue_map.get(msg['sid'], None)
                 if mq is None:
                     mq = Queue()
                     msg_queue_map[msg['sid']] = mq
+                merge_done[msg['sid']] = Event()
+                merge_rel[msg['sid']] = msg['rel']
                 merge_thread = Thread(
                     target=MergeFile._merge_work,
-                    args=(mq, msg['cnt'], msg['path'])
+                    args=(mq, msg['cnt'], msg['path'], merge_done[msg['sid']],
+                          self._journal, msg['rel'], msg['size'])
                 )
                 merge_threads.append(merge_thread)
                 merge_thread.start()
@@ -274,16 +536,104 @@ class MergeFile:
                     mq = Queue()
                     msg_queue_map[msg['sid']] = mq
                 mq.put(msg)
-                self._logger.info(
-                    self._locale('recv.file_merge.new_block').format(
-                        msg['sid'], msg['index']
-                    )
-                )
+                self._logger.tally(self._locale('recv.file_merge.new_blocks'))
+        for done in merge_done.values(): done.wait()
         for t in merge_threads: t.join()
         manager_thread.join()
         for index in msg_queue_map.keys():
             msg_queue_map[index].join()
         self._msg_queue.join()
+        return stop_msg
 
     def get_queue(self) -> Queue:
-        return self._msg_queue
\ No newline at end of file
+        return self._msg_queue
+
+    def verified(self) -> bool:
+        r'''`loop`结束后, 校验清单核对未发现不一致时为真(未核对时也为真).'''
+        return not self._bad_files
+
+    def backlog(self) -> int:
+        r'''尚未处理的消息数与等待整合的缓存块数.'''
+        return self._msg_queue.qsize() + sum(
+            mq.qsize() for mq in list(self._merge_queues.values())
+        )
+
+class _BlockRegion:
+    r'''`BlockWriter.open_region`返回的类文件对象, 顺序写入即写到目标文件的对应偏移处.'''
+    def __init__(self, writer, sid: int, offset: int) -> None:
+        self._writer: BlockWriter = writer
+        self._sid = sid
+        self._offset = offset
+    def write(self, data: bytes) -> int:
+        size = self._writer.write_at(self._sid, self._offset, data)
+        self._offset += size
+        return size
+    def close(self) -> None:
+        self._writer.finish_block(self._sid)
+
+class BlockWriter:
+    r'''
+    直接写入模式下分块文件的接收端.
+
+    每个分块文件只打开一次, 首个到达的块按`split`消息中的`size`预分配目标文件,
+    各`RecvThread`把自己的块写到对应的偏移处(支持时使用`os.pwrite`),
+    收齐`cnt`个块后关闭文件. 不需要块缓存目录和`MergeFile`整合线程.
+    '''
+    _lock: Lock
+    _files: dict[int, list]
+    _logger: LoggerWrapper
+    _locale: LangFile
+    def __init__(self, locale: LangFile, logger: LoggerWrapper) -> None:
+        self._lock = Lock()
+        self._files = {}
+        self._logger = logger
+        self._locale = locale
+
+    def open_region(self, sid: int, fpath: str, size: int, cnt: int,
+                    front: int) -> _BlockRegion:
+        with self._lock:
+            if sid not in self._files:
+                # keep blocks written by an interrupted session
+                file = open_target(fpath, 'r+b' if path.isfile(fpath) else 'w+b', buffering=0)
+                file.truncate(size)
+                # [file, file_lock, received_blocks, block_count, path]
+                self._files[sid] = [file, Lock(), 0, cnt, fpath]
+        return _BlockRegion(self, sid, front)
+
+    def write_at(self, sid: int, offset: int, data: bytes) -> int:
+        entry = self._files[sid]
+        if hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            written = 0
+            while written < len(view):
+                written += os.pwrite(entry[0].fileno(), view[written:], offset + written)
+            return written
+        with entry[1]:
+            entry[0].seek(offset)
+            return entry[0].write(data)
+
+    def finish_block(self, sid: int) -> None:
+        with self._lock:
+            entry = self._files[sid]
+            entry[2] += 1
+            if entry[2] < entry[3]: return
+            self._files.pop(sid)
+        entry[0].close()
+        self._logger.info(
+            self._locale('recv.block_writer.done').format(sid),
+            make_short_log(entry[4])
+        )
+
+    def abandon(self) -> list[str]:
+        r'''
+        所有接收线程结束后调用: 关闭仍未收齐的文件(发送端已放弃其中的块), 返回这些文件的路径.
+        '''
+        with self._lock:
+            entries = list(self._files.values())
+            self._files.clear()
+        for entry in entries:
+            entry[0].close()
+            self._logger.error(
+                self._locale('recv.block_writer.give_up'), make_short_log(entry[4])
+            )
+        return [entry[4] for entry in entries]
@@ -1,18 +1,45 @@
 
 from logger import LoggerWrapper as _LogW
-from typing import Literal as _Literal, Union as _Union, Any as _Any
+from typing import Literal as _Literal, Union as _Union, Any as _Any, BinaryIO as _BinaryIO
 from socket import socket as _socket
+from asyncio import get_running_loop as _get_running_loop
 from base64 import b64decode as _b64de, b64encode as _b64en
 from json import dumps as _dumps, loads as _loads
 from pickle import loads as _ploads, dumps as _pdumps
+from struct import Struct as _Struct
+from zlib import decompress as _zde
+from bz2 import decompress as _bz2de
+try: from lzma import decompress as _lzmade
+except ImportError: _lzmade = None
 
-__all__ = ['Packer', 'PacketError', 'Coder',
-           'SM_JSON', 'SM_PICKLE', 'SM_RAW']
+__all__ = ['Packer', 'PacketError', 'Coder', 'RecvBuffer',
+           'SM_JSON', 'SM_PICKLE', 'SM_RAW',
+           'CM_NONE', 'CM_ZLIB', 'CM_LZMA', 'CM_BZ2',
+           'FRAME_V1', 'FRAME_V2', 'MAX_FRAME_SIZE']
 
 SM_JSON = 0
 SM_PICKLE = 1
 SM_RAW = 2
 
+CM_NONE = 0
+CM_ZLIB = 1
+CM_LZMA = 2
+CM_BZ2 = 3
+
+FRAME_V1 = 1
+FRAME_V2 = 2
+MAX_FRAME_SIZE = 268435456
+
+_V2_HEADER = _Struct('>BI')
+_V2_MAGIC = 0xA0
+_V2_MAGIC_MASK = 0xE0
+_FLAG_SM_MASK = 0x03
+_FLAG_CODED = 0x04
+_FLAG_CM_SHIFT = 3
+_FLAG_CM_MASK = 0x18
+
+_DECOMPRESS = {CM_ZLIB: _zde, CM_LZMA: _lzmade, CM_BZ2: _bz2de}
+
 class PacketError(Exception):
     r'''在`Packer`类的方法执行过程中遇错误默认抛出的错误类型'''
     def __init__(self, msg: str, args: tuple[object]) -> None:
@@ -31,6 +58,7 @@ class Coder:
     继承并重写其中的`encrypt`和`decrypt`方法来实现自定义的加密器.
 
     正确的`encrypt`和`decrypt`方法接受`data`和`key`, 返回加密或解密后的数据(以`bytes`的形式).
+    `decrypt`收到的`data`可能是指向接收缓冲区的`memoryview`.
 
     重写`__init__`方法时必须指定属性`self.name`(以`str`类型指定加密器的名字), 否则遇异常处理会出现错误.
     '''
@@ -44,6 +72,53 @@ class Coder:
     def decrypt(self, data: bytes, key: bytes = None) -> _Union[bytes, None]:
         return _b64de(data)
 
+class RecvBuffer:
+    r'''
+    单个连接独占的可复用接收缓冲区, 通过`recv_into`直接填充预分配的`bytearray`.
+
+    `recv_exact`返回的`memoryview`指向缓冲区本身, 仅在下一次接收前有效;
+    需要保留数据时应自行复制(`bytes(view)`).
+    '''
+    def __init__(self, size: int = 65536) -> None:
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def view(self, size: int) -> memoryview:
+        if size > len(self._buffer):
+            self._view.release()
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+            self._view = memoryview(self._buffer)
+        return self._view[:size]
+
+    def recv_exact(self, client: _socket, size: int) -> memoryview:
+        view = self.view(size)
+        pointer = 0
+        while pointer < size:
+            recv_size = client.recv_into(view[pointer:])
+            if recv_size == 0: raise ConnectionError('peer closed.')
+            pointer += recv_size
+        return view
+
+    def recv_to_file(self, client: _socket, file: _BinaryIO, size: int,
+                     chunk_size: int = 1048576) -> None:
+        view = self.view(min(size, chunk_size))
+        while size > 0:
+            recv_size = client.recv_into(view, min(size, len(view)))
+            if recv_size == 0: raise ConnectionError('peer closed.')
+            file.write(view[:recv_size])
+            size -= recv_size
+
+    async def recv_exact_async(self, client: _socket, size: int) -> memoryview:
+        r'''`recv_exact`的异步版本, `client`须为非阻塞socket.'''
+        loop = _get_running_loop()
+        view = self.view(size)
+        pointer = 0
+        while pointer < size:
+            recv_size = await loop.sock_recv_into(client, view[pointer:])
+            if recv_size == 0: raise ConnectionError('peer closed.')
+            pointer += recv_size
+        return view
+
 class Packer:
     r'''
     自定义的包装类, 一定程度上解决TCP的粘包问题.
@@ -52,16 +127,141 @@ class Packer:
     - `encoder`: 包装器所用的加密器对象
     - `error`: 错误处理类型(`loose`或`strict`)
     - `logger`: 可选传入的LoggerWrapper对象
+    - `framing`: 分帧版本, `FRAME_V1`为2字节长度头(包体需小于64KiB),
+      `FRAME_V2`为1字节标志位加4字节长度头(包体上限为`max_frame`)
+    - `use_codec`: 仅对`FRAME_V2`有效, 为假时不经过加密器直接发送
+
+    `FRAME_V2`的标志位记录了包体的序列化方式、是否经过加密器以及压缩方式(`CM_*`),
+    接收时按标志位在`SM_JSON`与`SM_RAW`间选择, 压缩的包体会被自动解压.
+    `SM_PICKLE`的包体只在`serialization_method`为`SM_PICKLE`时还原, 其余情况按错误处理,
+    不会对对端发来的数据执行`pickle.loads`.
+
+    每个`Packer`持有一个`RecvBuffer`, 因此一个`Packer`只应服务于一个连接.
     '''
-    def __init__(self, encoder: Coder, error: _Literal['strict', 'loose'] = 'strict', logger: _LogW = None) -> None:
+    def __init__(self, encoder: Coder, error: _Literal['strict', 'loose'] = 'strict', logger: _LogW = None,
+                 framing: int = FRAME_V1, use_codec: bool = True, max_frame: int = MAX_FRAME_SIZE) -> None:
         self._encoder = encoder
         self._error: _Literal['strict', 'loose'] = error
         self._use_logger = False if logger == None else True
         self._logw = logger
+        self._framing = framing
+        self._use_codec = use_codec if framing == FRAME_V2 else True
+        self._max_frame = max_frame
+        self._buffer = RecvBuffer()
+
+    def _fail(self, e_str: str, args: tuple[object]) -> None:
+        if self._error == 'strict': raise PacketError(e_str, args)
+        err = PacketError('[TCPPacketErr]' + e_str, args)
+        if self._use_logger: self._logw.error(err)
+        else: print(err)
+
+    def _send_v2(self, client: _socket, coded: bytes, flags: int) -> bool:
+        pack_size = len(coded)
+        if pack_size > self._max_frame:
+            self._fail(f'Packet is too big: {pack_size}Bytes', ())
+            return False
+        try:
+            pack_header = _V2_HEADER.pack(_V2_MAGIC | flags, pack_size)
+            if pack_size <= 65536:
+                client.sendall(pack_header + coded)
+            else:
+                client.sendall(pack_header)
+                client.sendall(coded)
+            return True
+        except Exception as e:
+            self._fail('Error occurred during sending process: ', e.args)
+            return False
+
+    def _recv_v2(self, client: _socket) -> tuple[int, memoryview]:
+        flags, pack_size = _V2_HEADER.unpack(
+            self._buffer.recv_exact(client, _V2_HEADER.size)
+        )
+        if flags & _V2_MAGIC_MASK != _V2_MAGIC:
+            raise ValueError(f'Bad frame header: {flags:#x}')
+        if pack_size > self._max_frame:
+            raise ValueError(f'Packet is too big: {pack_size}Bytes')
+        return flags, self._buffer.recv_exact(client, pack_size)
+
+    def getFraming(self) -> int:
+        return self._framing
+
+    def _serialize(self, obj: object, serialization_method: int) -> _Union[bytes, None]:
+        if serialization_method == SM_RAW: return obj
+        if serialization_method == SM_JSON:
+            try: return _dumps(obj).encode('utf-8')
+            except Exception as e:
+                if self._error == 'strict': raise PacketError('Fail JSON', e.args)
+                else:
+                    err = PacketError('Fail JSON', e.args)
+                    if self._use_logger: self._logw.error(err)
+                    else: print(err)
+                return None
+        return _pdumps(obj, fix_imports = False)
 
+    def _encode_v2(self, obj: object, key: bytes, serialization_method: int,
+                   compressed: int) -> _Union[tuple[bytes, int], None]:
+        send_data = self._serialize(obj, serialization_method)
+        if send_data is None: return None
+        flags = serialization_method | (compressed << _FLAG_CM_SHIFT)
+        if not self._use_codec: return send_data, flags
+        try: coded = self._encoder.encrypt(send_data, key)
+        except Exception as e:
+            self._fail(f'Can not encode data with \'{self._encoder.name}\' while sending packet: ', e.args)
+            return None
+        return coded, flags | _FLAG_CODED
+
+    def _unpack_v2(self, flags: int, pack_: bytes, key: bytes = None,
+                   expected: int = SM_JSON) -> _Any:
+        serialization_method = flags & _FLAG_SM_MASK
+        compressed = (flags & _FLAG_CM_MASK) >> _FLAG_CM_SHIFT
+        # the peer must not choose pickle for a caller expecting plain data
+        if (serialization_method == SM_PICKLE) != (expected == SM_PICKLE) or \
+                serialization_method not in (SM_JSON, SM_PICKLE, SM_RAW):
+            self._fail(f'Unexpected serialization method: {serialization_method}', ())
+            return None
+        if flags & _FLAG_CODED:
+            return self._decode(pack_, key, serialization_method, compressed)
+        if compressed != CM_NONE:
+            pack_ = self._decompress(pack_, compressed)
+            if pack_ is None: return None
+        return self._load(pack_, serialization_method)
+
+    def packFrame(self, obj: object, key: bytes = None, serialization_method: int = SM_JSON,
+                  compressed: int = CM_NONE) -> _Union[list[bytes], None]:
+        r'''
+        仅`FRAME_V2`可用: 把`obj`编码为完整的帧(`[帧头, 包体]`)而不发送,
+        供异步连接以`loop.sock_sendall`写出. 参数含义与`sendPacket`相同.
+        '''
+        encoded = self._encode_v2(obj, key, serialization_method, compressed)
+        if encoded is None: return None
+        coded, flags = encoded
+        if len(coded) > self._max_frame:
+            self._fail(f'Packet is too big: {len(coded)}Bytes', ())
+            return None
+        return [_V2_HEADER.pack(_V2_MAGIC | flags, len(coded)), coded]
+
+    async def recvPacketAsync(self, client: _socket, key: bytes = None,
+                              serialization_method: int = SM_JSON) -> _Any:
+        r'''
+        仅`FRAME_V2`可用: 从非阻塞socket`client`接收一帧并按标志位还原对象.
+        与`recvPacket`相同, `SM_RAW`包体仅在下一次接收前有效.
+        '''
+        try:
+            flags, pack_size = _V2_HEADER.unpack(
+                await self._buffer.recv_exact_async(client, _V2_HEADER.size)
+            )
+            if flags & _V2_MAGIC_MASK != _V2_MAGIC:
+                raise ValueError(f'Bad frame header: {flags:#x}')
+            if pack_size > self._max_frame:
+                raise ValueError(f'Packet is too big: {pack_size}Bytes')
+            pack_ = await self._buffer.recv_exact_async(client, pack_size)
+        except Exception as e:
+            self._fail('Error occurred during recv process: ', e.args)
+            return None
+        return self._unpack_v2(flags, pack_, key, serialization_method)
 
     def sendPacket(self, client: _socket, obj: object, key: bytes = None,
-                   serialization_method: int = SM_JSON) -> bool:
+                   serialization_method: int = SM_JSON, compressed: int = CM_NONE) -> bool:
         r'''
         将`obj`通过`client`发送.
         参数说明:
@@ -69,19 +269,17 @@ class Packer:
         - `obj`: 需要发送的对象
         - `key`: 加密时使用的密钥
         - `pickle`: 若为真，将`obj`序列化后发送，否则使用json转换对象
+        - `compressed`: 仅`FRAME_V2`可用, 说明`obj`(`SM_RAW`)已经以该`CM_*`方式压缩
         '''
-        if serialization_method == SM_RAW:
-            send_data = obj
-        elif serialization_method == SM_JSON:
-            try: send_data = _dumps(obj).encode('utf-8')
-            except Exception as e:
-                if self._error == 'strict': raise PacketError('Fail JSON', e.args)
-                else:
-                    err = PacketError('Fail JSON', e.args)
-                    if self._use_logger: self._logw.error(err)
-                    else: print(err)
-                return False
-        else: send_data = _pdumps(obj, fix_imports = False)
+        if compressed != CM_NONE and self._framing != FRAME_V2:
+            self._fail('Compressed packet needs FRAME_V2', ())
+            return False
+        if self._framing == FRAME_V2:
+            encoded = self._encode_v2(obj, key, serialization_method, compressed)
+            if encoded is None: return False
+            return self._send_v2(client, *encoded)
+        send_data = self._serialize(obj, serialization_method)
+        if send_data is None: return False
         try: coded = self._encoder.encrypt(send_data, key)
         except Exception as e:
             e_str = f'Can not encode data with \'{self._encoder.name}\' while sending packet: '
@@ -92,7 +290,7 @@ class Packer:
                 if self._use_logger: self._logw.error(err)
                 else: print(err)
             return False
-        
+
         if len(coded) >= 65536:
             e_str = f'Packet is too big: {len(coded)}Bytes'
             if self._error == 'strict': raise PacketError(e_str, ())
@@ -135,26 +333,18 @@ class Packer:
         - `client`: TCP链接的`socket`对象
         - `key`: 解密时使用的密钥
         - `pickle`: 若为真，将接收数据反序列化，否则使用json复原对象
+
+        未经加密器的`SM_RAW`包以指向内部缓冲区的`memoryview`返回, 在下一次接收前有效.
         '''
+        if self._framing == FRAME_V2:
+            try: flags, pack_ = self._recv_v2(client)
+            except Exception as e:
+                self._fail('Error occurred during recv process: ', e.args)
+                return None
+            return self._unpack_v2(flags, pack_, key, serialization_method)
         try:
-            size = 0
-            pack_header = b''
-            while size < 2:
-                data = client.recv(2 - size)
-                if not data: raise ConnectionError('peer closed.')
-                else: 
-                    pack_header += data
-                    size = len(pack_header)
-            
-            size = 0
-            pack_size = int.from_bytes(pack_header, 'big')
-            pack_ = b''
-            while size < pack_size:
-                recv_size = pack_size - size
-                if recv_size > 1024:
-                    recv_size = 1024
-                pack_ += client.recv(recv_size)
-                size = len(pack_)
+            pack_size = int.from_bytes(self._buffer.recv_exact(client, 2), 'big')
+            pack_ = self._buffer.recv_exact(client, pack_size)
         except Exception as e:
             e_str = 'Error occurred during recv process: '
             if self._error == 'strict': raise PacketError(e_str, e.args)
@@ -164,7 +354,22 @@ class Packer:
                 if self._use_logger: self._logw.error(err)
                 else: print(err)
             return None
-        
+        return self._decode(pack_, key, serialization_method)
+
+    def recvStream(self, client: _socket, file: _BinaryIO, size: int) -> None:
+        r'''
+        从`client`接收长度为`size`的无分帧字节流, 经缓冲区直接写入`file`.
+        '''
+        self._buffer.recv_to_file(client, file, size)
+
+    def _decompress(self, data: bytes, compressed: int) -> _Union[bytes, None]:
+        try: return _DECOMPRESS[compressed](data)
+        except Exception as e:
+            self._fail(f'Can not decompress packet with method {compressed}: ', e.args)
+            return None
+
+    def _decode(self, pack_: bytes, key: bytes, serialization_method: int,
+                compressed: int = CM_NONE) -> _Any:
         try: decoded = self._encoder.decrypt(pack_, key)
         except Exception as e:
             e_str = f'Can not decode packet with \'{self._encoder.name}\' while recving: '
@@ -175,18 +380,23 @@ class Packer:
                 if self._use_logger: self._logw.error(err)
                 else: print(err)
             return None
+        if compressed != CM_NONE:
+            decoded = self._decompress(decoded, compressed)
+            if decoded is None: return None
+        return self._load(decoded, serialization_method)
+
+    def _load(self, decoded: bytes, serialization_method: int) -> _Any:
+        if serialization_method == SM_JSON:
+            try: obj = _loads(str(decoded, 'utf-8'))
+            except Exception as e:
+                if self._error == 'strict': raise PacketError('Fail JSON', e.args)
+                else:
+                    err = PacketError('Fail JSON', e.args)
+                    if self._use_logger: self._logw.error(err)
+                    else: print(err)
+                return None
+        elif serialization_method == SM_PICKLE:
+            obj = _ploads(decoded, fix_imports = False)
         else:
-            if serialization_method == SM_JSON:
-                try: obj = _loads(decoded.decode('utf-8'))
-                except Exception as e:
-                    if self._error == 'strict': raise PacketError('Fail JSON', e.args)
-                    else:
-                        err = PacketError('Fail JSON', e.args)
-                        if self._use_logger: self._logw.error(err)
-                        else: print(err)
-                    return None
-            elif serialization_method == SM_PICKLE:
-                obj = _ploads(decoded, fix_imports = False)
-            else:
-                obj = decoded
-            return obj
+            obj = decoded
+        return obj
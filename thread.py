@@ -5,84 +5,460 @@ LastEditTime: 2024-07-23 23:08:10
 '''
 
 from config import LangFile
+from time import monotonic
 from queue import Queue
 from threading import Thread
+from hashlib import new as new_hash
 from logger import LoggerWrapper
-from task import Msg
+from task import Msg, BlockWriter, DigestBook
+from journal import Journal
+from scheduler import Scheduler
+from metrics import ConnStats
+from delta import *
+from dedup import *
+from os import path, remove, replace
+from codec import CompressPolicy, CompressStats
 from tcp import *
-from tool import make_short_log
+from tool import make_short_log, open_target
 from socket import *
-from typing import BinaryIO
+from typing import BinaryIO, Literal, Any
 
-__all__ = ['SendThread', 'RecvThread']
+__all__ = ['DATA_MODE', 'SendThread', 'RecvThread']
+
+DATA_MODE = Literal['packet', 'stream']
+
+ACK_INTERVAL = 0.2
+RETRY_LIMIT = 3
+
+def task_files(msg: Msg) -> float:
+    r'''任务包含的文件数, 用于进度统计; 分块文件的每一块计`1 / 块数`.'''
+    if msg('bundle'): return len(msg['entries'])
+    if msg('block'): return 1 / msg['cnt']
+    return 1.0
+
+def task_paths(msg: Msg) -> list[str]:
+    r'''任务涉及的文件相对路径.'''
+    if msg('bundle'): return [entry[1] for entry in msg['entries']]
+    return [msg['path']]
+
+class _HashWriter:
+    r'''写入时顺带更新摘要的类文件包装, 给出`stats`时分别记录接收、摘要与写入的耗时.'''
+    def __init__(self, file: BinaryIO, hasher: Any, stats: ConnStats = None) -> None:
+        self._file = file
+        self._hasher = hasher
+        self._stats = stats
+    def write(self, data: bytes) -> int:
+        if self._stats is None:
+            self._hasher.update(data)
+            return self._file.write(data)
+        self._stats.lap('recv')
+        if self._hasher is not None:
+            self._hasher.update(data)
+            self._stats.lap('hash')
+        written = self._file.write(data)
+        self._stats.lap('write')
+        return written
 
 class SendThread:
     _locale: LangFile
     _work_thread: Thread
-    _msg_queue: Queue
+    _msg_queue: Scheduler
     _logger: LoggerWrapper
     _uid: int
     _connection: socket
-    def __init__(self, msg_queue: Queue, client_addr: tuple[str, int], uid: int,
-                 logger: LoggerWrapper, lang: str) -> None:
+    _data_mode: DATA_MODE
+    _framing: int
+    _use_codec: bool
+    _plain_packer: Packer
+    _read_size: int
+    _ack_window: int
+    _seq: int
+    _acked: int
+    _compress: CompressPolicy
+    _compress_stats: CompressStats
+    _checksum: str
+    _digest_book: DigestBook
+    _in_flight: dict[int, Msg]
+    _retry: list[Msg]
+    _sent_chunks: SentChunks
+    _sent_at: dict[int, float]
+    _stats: ConnStats
+    retired: bool
+    sent_bytes: int
+    failed: list[str]
+    def __init__(self, msg_queue: Scheduler, client_addr: tuple[str, int], uid: int,
+                 logger: LoggerWrapper, lang: str, data_mode: DATA_MODE = 'packet',
+                 framing: int = FRAME_V1, use_codec: bool = True,
+                 ack_window: int = 0, compress: CompressPolicy = None,
+                 checksum: str = 'none', digest_book: DigestBook = None,
+                 sent_chunks: SentChunks = None, stats: ConnStats = None) -> None:
         self._locale = LangFile({})
         self._locale.load_from_file(lang)
         self._msg_queue = msg_queue
+        self._data_mode = data_mode
+        self._framing = framing
+        self._use_codec = use_codec
+        # compressed payloads skip the codec, base64 would undo the saving
+        self._plain_packer = Packer(Coder(), 'loose', logger, framing, False)
+        self._ack_window = ack_window
+        self._seq = 0
+        self._acked = 0
+        self._compress = compress if framing == FRAME_V2 else None
+        self._compress_stats = CompressStats()
+        # a failed digest is reported through the ack stream
+        self._checksum = checksum if ack_window > 0 else 'none'
+        self._digest_book = digest_book
+        self._in_flight = {}
+        self._retry = []
+        self._sent_chunks = sent_chunks
+        self._sent_at = {}
+        self._stats = stats if stats is not None else ConnStats()
+        self.retired = False
+        self.sent_bytes = 0
+        # files given up after RETRY_LIMIT, reported to the receiver with stop_fm
+        self.failed = []
+        self._read_size = 4096 if framing == FRAME_V1 else 1048576
         self._work_thread = Thread(target=self._work)
         self._uid = uid
         self._logger = logger
         self._logger.info(self._locale('send.thread.connect'))
         self._connection = socket(AF_INET, SOCK_STREAM)
         self._connection.connect(client_addr)
-    
-    def _read_and_send(self, file: BinaryIO, size: int, packer: Packer) -> None:
+
+    def _new_hash(self) -> Any:
+        return None if self._checksum == 'none' else new_hash(self._checksum)
+
+    def _read_and_send(self, file: BinaryIO, size: int, packer: Packer,
+                       hasher: Any = None) -> None:
         while size > 0:
-            read_size = min(4096, size)
+            read_size = min(self._read_size, size)
+            data = file.read(read_size)
+            self._stats.lap('read')
+            if hasher is not None:
+                hasher.update(data)
+                self._stats.lap('hash')
             packer.sendPacket(
-                self._connection, file.read(read_size),
+                self._connection, data,
                 serialization_method=SM_RAW
             )
+            self._stats.lap('send')
             size -= read_size
-        file.close()
+
+    def _read_and_stream(self, file: BinaryIO, size: int, hasher: Any) -> None:
+        buffer = memoryview(bytearray(min(size, 1048576)))
+        while size > 0:
+            read_size = file.readinto(buffer[:min(len(buffer), size)])
+            if read_size == 0: raise EOFError('file shrank while sending.')
+            self._stats.lap('read')
+            hasher.update(buffer[:read_size])
+            self._stats.lap('hash')
+            self._connection.sendall(buffer[:read_size])
+            self._stats.lap('send')
+            size -= read_size
+
+    def _stream_send(self, file: BinaryIO, front: int, size: int, hasher: Any) -> None:
+        if size <= 0: return
+        if hasher is None:
+            # read and send are one kernel call, counted as send
+            self._connection.sendfile(file, front, size)
+            self._stats.lap('send')
+        else:
+            # hashing needs the bytes in user space, so sendfile is skipped
+            file.seek(front)
+            self._read_and_stream(file, size, hasher)
+
+    def _send_data(self, file_path: str, front: int, size: int, packer: Packer,
+                   hasher: Any = None) -> None:
+        with open(file_path, 'rb') as file:
+            if self._data_mode == 'stream':
+                self._stream_send(file, front, size, hasher)
+            else:
+                file.seek(front)
+                self._read_and_send(file, size, packer, hasher)
+
+    def _send_compressed(self, file: BinaryIO, size: int, file_path: str,
+                         raw: int, sent: int, hasher: Any) -> None:
+        r'''发送已决定压缩的任务的其余部分, 放弃压缩后仍以不经加密器的帧发送.'''
+        compressing = True
+        packer = self._plain_packer
+        while size > 0:
+            data = file.read(min(self._read_size, size))
+            if not data: raise EOFError('file shrank while sending.')
+            size -= len(data)
+            self._stats.lap('read')
+            if hasher is not None:
+                hasher.update(data)
+                self._stats.lap('hash')
+            if not compressing:
+                packer.sendPacket(self._connection, data, None, SM_RAW)
+                self._stats.lap('send')
+                continue
+            payload, method = self._compress.compress(data, self._compress_stats)
+            self._stats.lap('encode')
+            raw += len(data)
+            sent += len(payload)
+            if not self._compress.worth(raw, sent):
+                compressing = False
+                self._compress.give_up(file_path)
+            packer.sendPacket(self._connection, payload, None, SM_RAW, method)
+            self._stats.lap('send')
+
+    def _send_file(self, packer: Packer, header: Msg, task: Msg,
+                   front: int, size: int) -> Any:
+        r'''
+        发送`single`或`block`任务. 启用压缩时先读取首个数据块试压缩,
+        压缩有益则本任务改用分帧发送, 否则仍按`data_mode`发送.
+        '''
+        file_path = task['file_path']
+        hasher = self._new_hash()
+        with open(file_path, 'rb') as file:
+            sample = None
+            if self._compress is not None and size > 0 \
+                and self._compress.should_try(file_path):
+                file.seek(front)
+                sample = file.read(min(self._read_size, size))
+                self._stats.lap('read')
+                payload, method = self._compress.compress(sample, self._compress_stats)
+                self._stats.lap('encode')
+                if method == CM_NONE:
+                    self._compress.give_up(file_path)
+                    sample = None
+            header.args['mode'] = self._data_mode if sample is None else 'packet'
+            self._send_header(packer, header, task)
+            if sample is not None:
+                if hasher is not None: hasher.update(sample)
+                self._plain_packer.sendPacket(self._connection, payload, None, SM_RAW, method)
+                self._send_compressed(
+                    file, size - len(sample), file_path,
+                    len(sample), len(payload), hasher
+                )
+            elif self._data_mode == 'stream':
+                self._stream_send(file, front, size, hasher)
+            else:
+                file.seek(front)
+                self._read_and_send(file, size, packer, hasher)
+        return hasher
+
+    def _send_digest(self, packer: Packer, hashers: list[Any],
+                     rel_paths: list[str], index: int) -> None:
+        if self._checksum == 'none': return
+        digests = [hasher.hexdigest() for hasher in hashers]
+        packer.sendPacket(self._connection, {"digest": digests})
+        self._stats.lap('send')
+        if self._digest_book is not None:
+            for rel_path, digest in zip(rel_paths, digests):
+                self._digest_book.record(rel_path, index, digest)
+
+    def _send_delta(self, packer: Packer, task: Msg) -> None:
+        r'''
+        以增量方式发送`delta`任务: 接收端返回已有文件的块签名,
+        本端只发送字面数据与`copy`指令, 最后以`{"done": true}`结束.
+        '''
+        # the signature reply shares the ack stream, so drain it first
+        self._send_header(packer, Msg('sync', {}))
+        self._wait_ack(packer, 0)
+        self._send_header(packer, Msg('delta', {
+            "path": task['path'],
+            "size": task['size']
+        }), task)
+        reply = packer.recvPacket(self._connection)
+        sigs = b''
+        if reply['count'] > 0:
+            sigs = bytes(packer.recvPacket(self._connection, None, SM_RAW))
+        # without a basis every block is literal, any block size will do
+        block_size = reply['block'] or block_size_for(task['size'])
+        index = SignatureIndex(sigs, block_size)
+        file_path = task['file_path']
+        compress = self._compress is not None and self._compress.should_try(file_path)
+        hasher = self._new_hash()
+        literal = 0
+        with open(file_path, 'rb') as file:
+            for kind, arg in delta_ops(file, index, block_size, hasher):
+                if kind == 'copy':
+                    packer.sendPacket(self._connection, {"copy": arg})
+                    continue
+                literal += len(arg)
+                payload, method = arg, CM_NONE
+                if compress:
+                    payload, method = self._compress.compress(arg, self._compress_stats)
+                (packer if method == CM_NONE else self._plain_packer).sendPacket(
+                    self._connection, payload, None, SM_RAW, method
+                )
+        packer.sendPacket(self._connection, {"done": True})
+        self._send_digest(packer, [hasher], [task['path']], 0)
+        self._logger.info(
+            self._locale('send.thread.delta').format(literal, task['size']),
+            make_short_log(task['path'])
+        )
+
+    def _send_dedup(self, packer: Packer, task: Msg) -> None:
+        r'''
+        按内容定义的块发送`dedup`任务: 本次任务中已由任意线程发送过的块只发送引用.
+        重传时接收端可能无法解析引用, 因此改为发送全部块的数据.
+        '''
+        self._send_header(packer, Msg('dedup', {
+            "path": task['path'],
+            "size": task['size']
+        }), task)
+        literal = bool(task['retry'])
+        file_path = task['file_path']
+        compress = self._compress is not None and self._compress.should_try(file_path)
+        hasher = self._new_hash()
+        refs, chunks = 0, 0
+        with open(file_path, 'rb') as file:
+            for chunk in cut_chunks(file):
+                chunks += 1
+                if hasher is not None: hasher.update(chunk)
+                cid = chunk_id(chunk)
+                if not literal and not self._sent_chunks.claim(cid, len(chunk)):
+                    packer.sendPacket(self._connection, {"ref": cid})
+                    refs += 1
+                    continue
+                packer.sendPacket(self._connection, {"chunk": cid})
+                payload, method = chunk, CM_NONE
+                if compress:
+                    payload, method = self._compress.compress(chunk, self._compress_stats)
+                (packer if method == CM_NONE else self._plain_packer).sendPacket(
+                    self._connection, payload, None, SM_RAW, method
+                )
+        packer.sendPacket(self._connection, {"done": True})
+        self._send_digest(packer, [hasher], [task['path']], 0)
+        self._logger.info(
+            self._locale('send.thread.dedup').format(refs, chunks),
+            make_short_log(task['path'])
+        )
+
+    def _send_header(self, packer: Packer, msg: Msg, task: Msg = None) -> None:
+        self._stats.lap('other')
+        if self._ack_window > 0:
+            self._seq += 1
+            msg.args['seq'] = self._seq
+            if task is not None: self._in_flight[self._seq] = task
+            self._sent_at[self._seq] = monotonic()
+        packer.sendPacket(self._connection, Msg.make_dict(msg))
+        self._stats.lap('send')
+
+    def _on_ack(self, ack: dict[str, Any]) -> None:
+        for seq in ack.get('nack', []):
+            task: Msg = self._in_flight.pop(seq, None)
+            if task is None: continue
+            retry = task['retry'] or 0
+            if retry >= RETRY_LIMIT:
+                self._logger.error(
+                    self._locale('send.thread.retry_limit'),
+                    make_short_log(task['path'] or task['entries'][0][1])
+                )
+                self.failed.extend(task_paths(task))
+                continue
+            task.args['retry'] = retry + 1
+            self._retry.append(task)
+            self._logger.warn(self._locale('send.thread.retransmit').format(seq))
+        self._acked = max(self._acked, ack.get('ack', 0))
+        # time from sending the newest acked message to its ack
+        sent_at = None
+        while self._sent_at:
+            seq = next(iter(self._sent_at))
+            if seq > self._acked: break
+            sent_at = self._sent_at.pop(seq)
+        if sent_at is not None: self._stats.sample_rtt(monotonic() - sent_at)
+        while self._in_flight:
+            seq = next(iter(self._in_flight))
+            if seq > self._acked: break
+            self._in_flight.pop(seq)
+
+    def _wait_ack(self, packer: Packer, in_flight: int) -> None:
+        r'''等待累计确认, 直到未确认的消息数不超过`in_flight`.'''
+        self._stats.lap('other')
+        if self._ack_window <= 0:
+            packer.recvPacket(self._connection, None, SM_RAW)
+            self._stats.lap('ack')
+            return
+        while self._seq - self._acked > in_flight:
+            ack = packer.recvPacket(self._connection)
+            if not isinstance(ack, dict): break
+            self._on_ack(ack)
+        self._stats.lap('ack')
 
     def _work(self) -> None:
-        packer = Packer(Coder(), 'loose', self._logger)
+        packer = Packer(Coder(), 'loose', self._logger,
+                        self._framing, self._use_codec)
         while True:
-            msg: Msg = self._msg_queue.get()
-            self._msg_queue.task_done()
+            if self._retry:
+                msg: Msg = self._retry.pop(0)
+            elif self.retired:
+                self._msg_queue.leave(self._uid)
+                msg: Msg = Msg('end', {"reason": self._locale('msg.conn_retired')})
+            else:
+                self._stats.lap('other')
+                msg: Msg = self._msg_queue.get(self._uid)
+                self._stats.lap('queue')
             if msg('end'):
-                packer.sendPacket(self._connection, Msg.make_dict(msg))
-                packer.recvPacket(self._connection, None, SM_RAW)
+                if self._checksum != 'none':
+                    # collect the last verdicts before leaving
+                    self._send_header(packer, Msg('sync', {}))
+                    self._wait_ack(packer, 0)
+                    if self._retry:
+                        self._retry.append(msg)
+                        continue
+                self._send_header(packer, Msg('end', dict(msg.args)))
+                self._wait_ack(packer, 0)
                 self._logger.info(
                     self._locale('send.thread.exit').format(self._uid),
                     msg['reason']
                 )
                 break
             elif msg('split'):
-                packer.sendPacket(self._connection, Msg.make_dict(msg))
+                self._send_header(packer, Msg('split', dict(msg.args)))
             elif msg('single'):
-                packer.sendPacket(self._connection, Msg.make_dict(
-                    Msg('single', {
-                        "path": msg['path'],
-                        "size": msg['size']
-                    })
-                ))
-                self._read_and_send(msg['file'], msg['size'], packer)
+                hasher = self._send_file(packer, Msg('single', {
+                    "path": msg['path'],
+                    "size": msg['size']
+                }), msg, 0, msg['size'])
+                self._send_digest(packer, [hasher], [msg['path']], 0)
+            elif msg('bundle'):
+                self._send_header(packer, Msg('bundle', {
+                    "entries": [entry[1:] for entry in msg['entries']],
+                    "size": msg['size'],
+                    "mode": self._data_mode
+                }), msg)
+                hashers = []
+                for file_path, _, size in msg['entries']:
+                    hashers.append(self._new_hash())
+                    self._send_data(file_path, 0, size, packer, hashers[-1])
+                self._send_digest(
+                    packer, hashers, [entry[1] for entry in msg['entries']], 0
+                )
+            elif msg('delta'):
+                self._send_delta(packer, msg)
+            elif msg('dedup'):
+                self._send_dedup(packer, msg)
             elif msg('block'):
-                packer.sendPacket(self._connection, Msg.make_dict(
-                    Msg('block', {
-                        "size": msg['size'],
-                        "index": msg['index'],
-                        "sid": msg['sid']
-                    })
-                ))
-                self._read_and_send(msg['file'], msg['size'], packer)
-            packer.recvPacket(self._connection, None, SM_RAW)
+                hasher = self._send_file(packer, Msg('block', {
+                    "size": msg['size'],
+                    "index": msg['index'],
+                    "sid": msg['sid'],
+                    "front": msg['front'],
+                    "path": msg['path'],
+                    "total": msg['total'],
+                    "cnt": msg['cnt']
+                }), msg, msg['front'], msg['size'])
+                self._send_digest(packer, [hasher], [msg['path']], msg['index'])
+            if not msg('split'):
+                self.sent_bytes += msg['size']
+                self._stats.done(msg['size'], task_files(msg))
+            self._wait_ack(packer, self._ack_window - 1)
         self._connection.close()
 
+    def retire(self) -> None:
+        r'''完成当前任务后结束本连接, 由`ConnTuner`撤回连接时调用.'''
+        self.retired = True
+
     def join(self) -> None:
         self._work_thread.join()
 
+    def get_compress_stats(self) -> CompressStats:
+        return self._compress_stats
+
     def run(self) -> None:
         self._logger.info(self._locale('send.thread.start').format(self._uid))
         self._work_thread.start()
@@ -96,8 +472,24 @@ class RecvThread:
     _uid: int
     _apex_path: str
     _cache: str
+    _framing: int
+    _ack_window: int
+    _ack_batch: int
+    _ack_seq: int
+    _ack_time: float
+    _nacks: list[int]
+    _block_writer: BlockWriter
+    _checksum: str
+    _digest_book: DigestBook
+    _journal: Journal
+    _chunk_store: ChunkStore
+    _stats: ConnStats
     def __init__(self, msg_queue: Queue, connection: socket, uid: int,
-                 logger: LoggerWrapper, lang: str, apex_path: str, cache: str) -> None:
+                 logger: LoggerWrapper, lang: str, apex_path: str, cache: str,
+                 framing: int = FRAME_V1, ack_window: int = 0,
+                 block_writer: BlockWriter = None, checksum: str = 'none',
+                 digest_book: DigestBook = None, journal: Journal = None,
+                 chunk_store: ChunkStore = None, stats: ConnStats = None) -> None:
         self._locale = LangFile({})
         self._locale.load_from_file(lang)
         self._connection = connection
@@ -107,67 +499,272 @@ class RecvThread:
         self._apex_path = apex_path
         self._uid = uid
         self._cache = cache.removesuffix('\\')
+        self._framing = framing
+        self._ack_window = ack_window
+        self._ack_batch = max(1, ack_window // 2)
+        self._ack_seq = 0
+        self._ack_time = monotonic()
+        self._nacks = []
+        self._block_writer = block_writer
+        self._checksum = checksum if ack_window > 0 else 'none'
+        self._digest_book = digest_book
+        self._journal = journal
+        self._chunk_store = chunk_store
+        self._stats = stats if stats is not None else ConnStats()
         self._thread = Thread(target=self._work)
 
+    def _new_hash(self) -> Any:
+        return None if self._checksum == 'none' else new_hash(self._checksum)
+
     def _recv_file(self, packer: Packer, file: BinaryIO, size: int) -> None:
         recv_size: int = 0
         while recv_size < size:
-            data: bytes = packer.recvPacket(
+            data: memoryview = packer.recvPacket(
                 self._connection, None,
                 serialization_method=SM_RAW
             )
             file.write(data)
             recv_size += len(data)
-        file.close()
+
+    def _recv_data(self, packer: Packer, file: BinaryIO, size: int,
+                   mode: DATA_MODE, hasher: Any = None) -> None:
+        file = _HashWriter(file, hasher, self._stats)
+        if mode == 'stream':
+            packer.recvStream(self._connection, file, size)
+        else:
+            self._recv_file(packer, file, size)
+
+    def _verify(self, packer: Packer, hashers: list[Any], rel_paths: list[str],
+                index: int, seq: int) -> bool:
+        r'''读取发送端附带的摘要并与本地计算的结果比对, 不一致时登记重传请求.'''
+        if self._checksum == 'none': return True
+        self._stats.lap('write')
+        trailer = packer.recvPacket(self._connection)
+        self._stats.lap('recv')
+        digests = [hasher.hexdigest() for hasher in hashers]
+        if not isinstance(trailer, dict) or trailer.get('digest') != digests:
+            self._nacks.append(seq)
+            self._logger.warn(
+                self._locale('recv.thread.bad_digest'),
+                make_short_log(rel_paths[0])
+            )
+            return False
+        if self._digest_book is not None:
+            for rel_path, digest in zip(rel_paths, digests):
+                self._digest_book.record(rel_path, index, digest)
+        return True
+
+    def _recv_delta(self, packer: Packer, msg: Msg) -> None:
+        r'''
+        接收`delta`任务: 先发送已有文件的块签名, 再按指令把新文件重建到临时文件,
+        校验通过后替换原文件.
+        '''
+        file_path = self._apex_path + msg['path']
+        basis = open(file_path, 'rb') if path.isfile(file_path) else None
+        block_size = 0
+        if basis is not None:
+            block_size = block_size_for(path.getsize(file_path))
+            sigs = make_signatures(basis, block_size)
+            packer.sendPacket(self._connection, {
+                "block": block_size,
+                "count": len(sigs) // 12
+            })
+            if sigs: packer.sendPacket(self._connection, sigs, None, SM_RAW)
+        else: packer.sendPacket(self._connection, {"block": 0, "count": 0})
+        temp_path = file_path + '.delta'
+        hasher = self._new_hash()
+        with open_target(temp_path, 'wb') as file:
+            target = file if hasher is None else _HashWriter(file, hasher)
+            while True:
+                op = packer.recvPacket(self._connection)
+                if isinstance(op, dict):
+                    if op.get('done'): break
+                    apply_copy(basis, target, op['copy'][0], op['copy'][1], block_size)
+                elif op is None: break
+                else: target.write(op)
+        if basis is not None: basis.close()
+        if self._verify(packer, [hasher], [msg['path']], 0, msg['seq']):
+            replace(temp_path, file_path)
+            if self._journal is not None:
+                self._journal.record_file(msg['path'], msg['size'], file_path)
+            self._logger.info(
+                self._locale('recv.thread.recv_delta'),
+                make_short_log(file_path)
+            )
+        else: remove(temp_path)
+
+    def _recv_dedup(self, packer: Packer, msg: Msg) -> None:
+        r'''
+        接收`dedup`任务: 新块写入后登记到`ChunkStore`, 引用从已写入的位置读取.
+        引用无法解析时请求重传, 发送端随后会发送全部块的数据.
+        '''
+        file_path = self._apex_path + msg['path']
+        hasher = self._new_hash()
+        resolved = True
+        offset = 0
+        with open_target(file_path, 'wb') as file:
+            while True:
+                op = packer.recvPacket(self._connection)
+                if not isinstance(op, dict) or op.get('done'): break
+                if 'ref' in op:
+                    data = self._chunk_store.read(op['ref'])
+                else:
+                    data = bytes(packer.recvPacket(self._connection, None, SM_RAW))
+                    if chunk_id(data) != op['chunk']: data = None
+                if data is None:
+                    resolved = False
+                    continue
+                file.write(data)
+                if hasher is not None: hasher.update(data)
+                if 'chunk' in op:
+                    file.flush()
+                    self._chunk_store.register(op['chunk'], file_path, offset, len(data))
+                offset += len(data)
+        if not self._verify(packer, [hasher], [msg['path']], 0, msg['seq']): return
+        if not resolved:
+            self._nacks.append(msg['seq'])
+            self._logger.warn(
+                self._locale('recv.thread.bad_ref'),
+                make_short_log(file_path)
+            )
+            return
+        if self._journal is not None:
+            self._journal.record_file(msg['path'], msg['size'], file_path)
+        self._logger.info(
+            self._locale('recv.thread.recv_dedup'),
+            make_short_log(file_path)
+        )
+
+    def _send_ack(self, packer: Packer, seq: int, force: bool = False) -> None:
+        r'''
+        按批次或超时发送累计确认; 发送端最多有`ack_window`条消息在途,
+        每满`ack_window // 2`条确认一次即可保证发送端不会停等.
+        校验失败的消息号随下一次确认以`nack`列表一并发送.
+        '''
+        if self._ack_window <= 0:
+            packer.sendPacket(self._connection, b'beat', None, SM_RAW)
+            return
+        if seq is None: return
+        now = monotonic()
+        if force or self._nacks or seq - self._ack_seq >= self._ack_batch \
+            or now - self._ack_time >= ACK_INTERVAL:
+            ack: dict[str, Any] = {"ack": seq}
+            if self._nacks:
+                ack['nack'] = self._nacks
+                self._nacks = []
+            self._stats.lap('other')
+            packer.sendPacket(self._connection, ack)
+            self._stats.lap('ack')
+            self._ack_seq = seq
+            self._ack_time = now
+
+    def _peer_closed(self) -> bool:
+        r'''对端已关闭或重置连接时为真, 不阻塞.'''
+        self._connection.setblocking(False)
+        try: return not self._connection.recv(1, MSG_PEEK)
+        except BlockingIOError: return False
+        except OSError: return True
+        finally: self._connection.setblocking(True)
 
     def _work(self) -> None:
-        packer = Packer(Coder(), 'loose', self._logger)
+        packer = Packer(Coder(), 'loose', self._logger, self._framing)
         while True:
+            self._stats.lap('other')
             msg: Msg = Msg.make_msg(packer.recvPacket(self._connection))
+            self._stats.lap('recv')
             if msg('bad_package'):
                 self._logger.warn(self._locale('recv.thread.bad_package'))
+                if self._peer_closed(): break
+                if self._ack_window > 0: continue
             elif msg('end'):
-                packer.sendPacket(self._connection, b'beat', None, SM_RAW)
+                self._send_ack(packer, msg['seq'], True)
                 self._logger.info(
                     self._locale('recv.thread.end').format(self._uid),
                     msg['reason']
                 )
                 break
+            elif msg('sync'):
+                self._send_ack(packer, msg['seq'], True)
+                continue
             elif msg('split'):
                 self._logger.info(
                     self._locale('recv.thread.recv_split'),
                     make_short_log(self._apex_path + msg['path'])
                 )
-                self._msg_queue.put(Msg('split', {
-                    "sid": msg['sid'],
-                    "path": self._apex_path + msg['path'],
-                    "cnt": msg['cnt']
-                }))
+                if self._block_writer is None:
+                    self._msg_queue.put(Msg('split', {
+                        "sid": msg['sid'],
+                        "path": self._apex_path + msg['path'],
+                        "rel": msg['path'],
+                        "size": msg['size'],
+                        "cnt": msg['cnt']
+                    }))
+            elif msg('block') and self._block_writer is not None:
+                region = self._block_writer.open_region(
+                    msg['sid'], self._apex_path + msg['path'],
+                    msg['total'], msg['cnt'], msg['front']
+                )
+                hasher = self._new_hash()
+                self._recv_data(packer, region, msg['size'], msg['mode'], hasher)
+                if self._verify(packer, [hasher], [msg['path']], msg['index'], msg['seq']):
+                    region.close()
+                    if self._journal is not None:
+                        self._journal.record_block(
+                            msg['path'], msg['front'], msg['size'],
+                            self._apex_path + msg['path']
+                        )
+                    self._logger.tally(self._locale('recv.thread.recv_blocks'))
             elif msg('block'):
                 sid = msg['sid']
                 idx = msg['index']
                 file_path = f'{self._cache}\\{sid}_{idx}.block'
                 file = open(file_path, 'wb')
-                self._recv_file(packer, file, msg['size'])
-                self._logger.info(
-                    self._locale('recv.thread.recv_block').format(
-                        sid, idx
-                    )
-                )
-                self._msg_queue.put(Msg('block_end', {
-                    "sid": sid,
-                    "index": idx,
-                    "path": file_path
-                }))
+                hasher = self._new_hash()
+                self._recv_data(packer, file, msg['size'], msg['mode'], hasher)
+                file.close()
+                if self._verify(packer, [hasher], [msg['path']], idx, msg['seq']):
+                    self._logger.tally(self._locale('recv.thread.recv_blocks'))
+                    self._msg_queue.put(Msg('block_end', {
+                        "sid": sid,
+                        "index": idx,
+                        "path": file_path
+                    }))
             elif msg('single'):
                 file_path = self._apex_path + msg['path']
-                file = open(file_path, 'wb')
-                self._recv_file(packer, file, msg['size'])
-                self._logger.info(
-                    self._locale('recv.thread.recv_single'),
-                    make_short_log(file_path)
-                )
-            packer.sendPacket(self._connection, b'beat', None, SM_RAW)
+                file = open_target(file_path, 'wb')
+                hasher = self._new_hash()
+                self._recv_data(packer, file, msg['size'], msg['mode'], hasher)
+                file.close()
+                if self._verify(packer, [hasher], [msg['path']], 0, msg['seq']):
+                    if self._journal is not None:
+                        self._journal.record_file(msg['path'], msg['size'], file_path)
+                    self._logger.info(
+                        self._locale('recv.thread.recv_single'),
+                        make_short_log(file_path)
+                    )
+            elif msg('delta'):
+                self._recv_delta(packer, msg)
+            elif msg('dedup'):
+                self._recv_dedup(packer, msg)
+            elif msg('bundle'):
+                hashers = []
+                for rel_path, size in msg['entries']:
+                    file = open_target(self._apex_path + rel_path, 'wb')
+                    hashers.append(self._new_hash())
+                    self._recv_data(packer, file, size, msg['mode'], hashers[-1])
+                    file.close()
+                rel_paths = [entry[0] for entry in msg['entries']]
+                if self._verify(packer, hashers, rel_paths, 0, msg['seq']):
+                    if self._journal is not None:
+                        for rel_path, size in msg['entries']:
+                            self._journal.record_file(rel_path, size, self._apex_path + rel_path)
+                    self._logger.info(
+                        self._locale('recv.thread.recv_bundle'),
+                        len(msg['entries'])
+                    )
+            if msg['size'] and not msg('split'):
+                self._stats.done(msg['size'], task_files(msg))
+            self._send_ack(packer, msg['seq'])
         self._connection.close()
 
     def join(self) -> None:
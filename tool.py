@@ -6,9 +6,9 @@ LastEditTime: 2024-07-23 12:57:49
 
 __all__ = ['bytes_to_size', 'size_to_byte', 'get_multi_paths',
            'SimplePacket', 'generate_connect_key', 'get_local_ip',
-           'make_short_log']
+           'make_short_log', 'open_target']
 
-from os import walk, path
+from os import walk, path, makedirs
 from typing import Any
 from base64 import b64encode, b64decode
 from json import dumps, loads
@@ -84,3 +84,13 @@ def get_multi_paths(folder_path: str) -> tuple[list[str], list[str]]:
         folder_list.append(filepath)
     return (file_path_list, folder_list)
 
+
+def open_target(file_path: str, mode: str, **kwargs) -> Any:
+    r"""
+    打开接收端的目标文件, 所在文件夹不存在时先创建.
+    边扫描边发送时文件可能先于文件夹列表到达.
+    """
+    try: return open(file_path, mode, **kwargs)
+    except FileNotFoundError:
+        makedirs(path.dirname(file_path), exist_ok=True)
+        return open(file_path, mode, **kwargs)
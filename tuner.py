@@ -0,0 +1,167 @@
+from thread import SendThread, RecvThread
+from config import LangFile
+from logger import LoggerWrapper
+from threading import Thread, Event
+from time import monotonic
+from os import path
+from socket import socket, timeout, create_connection
+from typing import Callable, Union
+import json
+
+__all__ = ['PeerMemory', 'ConnTuner', 'ConnAcceptor']
+
+# fallback only, stop wakes the accept with a local connection
+ACCEPT_POLL = 0.5
+
+class PeerMemory:
+    r'''按对端地址记录上次调优得到的连接数, 保存为JSON文件.'''
+    _file_path: str
+    _peers: dict[str, int]
+    def __init__(self, file_path: str) -> None:
+        self._file_path = file_path
+        self._peers = {}
+        if path.isfile(file_path):
+            try:
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    self._peers = json.load(file)
+            except ValueError: pass
+
+    def get(self, peer: str) -> Union[int, None]:
+        return self._peers.get(peer)
+
+    def set(self, peer: str, count: int) -> None:
+        self._peers[peer] = count
+
+    def save(self) -> None:
+        with open(self._file_path, 'w', encoding='utf-8') as file:
+            json.dump(self._peers, file, indent=4)
+
+class ConnTuner:
+    r'''
+    发送端连接数的自动调优.
+
+    以`start`条连接开始, 每`interval`秒统计一次全部发送线程的有效吞吐量(已发完任务的数据量),
+    吞吐量比上一档提升超过`gain`时再增加`step`条连接, 否则撤回最后一步增加的连接并停止调优.
+    每次调整后的第一个统计周期用于新连接爬升, 不参与比较.
+
+    `spawn(uid)`创建并启动一个`SendThread`. 调优线程在`finish`后停止, 此后`threads`不再变化.
+    '''
+    _spawn: Callable[[int], SendThread]
+    _logger: LoggerWrapper
+    _locale: LangFile
+    _start: int
+    _step: int
+    _max_count: int
+    _interval: float
+    _gain: float
+    _stop: Event
+    _thread: Thread
+    threads: list[SendThread]
+    def __init__(self, spawn: Callable[[int], SendThread], logger: LoggerWrapper,
+                 locale: LangFile, start: int, step: int, max_count: int,
+                 interval: float = 2.0, gain: float = 0.05) -> None:
+        self._spawn = spawn
+        self._logger = logger
+        self._locale = locale
+        self._start = max(1, min(start, max_count))
+        self._step = max(1, step)
+        self._max_count = max_count
+        self._interval = interval
+        self._gain = gain
+        self._stop = Event()
+        self._thread = Thread(target=self._work)
+        self.threads = []
+
+    def _live(self) -> list[SendThread]:
+        return [t for t in self.threads if not t.retired]
+
+    def _grow(self, count: int) -> None:
+        for _ in range(count):
+            self.threads.append(self._spawn(len(self.threads)))
+
+    def _goodput(self) -> int:
+        return sum(t.sent_bytes for t in self.threads)
+
+    def _work(self) -> None:
+        best_rate, best_count = 0.0, len(self.threads)
+        last_bytes, last_time = self._goodput(), monotonic()
+        warming = True
+        while not self._stop.wait(self._interval):
+            now_bytes, now_time = self._goodput(), monotonic()
+            # no task finished yet: widen the window instead of reading 0
+            if now_bytes == last_bytes: continue
+            rate = (now_bytes - last_bytes) / (now_time - last_time)
+            last_bytes, last_time = now_bytes, now_time
+            if warming:
+                warming = False
+                continue
+            live = len(self._live())
+            if rate > best_rate * (1 + self._gain) and live < self._max_count:
+                best_rate, best_count = rate, live
+                self._grow(min(self._step, self._max_count - live))
+                self._logger.info(self._locale('send.tune.grow').format(
+                    rate / 1048576, len(self._live())
+                ))
+                warming = True
+                continue
+            if rate <= best_rate * (1 + self._gain):
+                for t in self._live()[best_count:]: t.retire()
+            else: best_count = live
+            self._logger.info(self._locale('send.tune.settle').format(
+                max(rate, best_rate) / 1048576, best_count
+            ))
+            return
+
+    def launch(self) -> None:
+        self._logger.info(self._locale('send.tune.start').format(self._start))
+        self._grow(self._start)
+        self._thread.start()
+
+    def live_count(self) -> int:
+        r'''仍在工作(未被撤回)的连接数.'''
+        return len(self._live())
+
+    def finish(self) -> int:
+        r'''停止调优, 返回仍在工作的连接数.'''
+        self._stop.set()
+        self._thread.join()
+        return self.live_count()
+
+class ConnAcceptor:
+    r'''
+    接收端的动态连接接受器: 传输期间持续接受新连接, 并以`make_thread(connection, uid)`
+    为每条连接创建并启动`RecvThread`. 发送端的全部连接结束后调用`stop`.
+    '''
+    _accept_socket: socket
+    _make_thread: Callable[[socket, int], RecvThread]
+    _stop: Event
+    _thread: Thread
+    threads: list[RecvThread]
+    def __init__(self, accept_socket: socket,
+                 make_thread: Callable[[socket, int], RecvThread]) -> None:
+        self._accept_socket = accept_socket
+        self._make_thread = make_thread
+        self._stop = Event()
+        self._thread = Thread(target=self._work)
+        self.threads = []
+
+    def _work(self) -> None:
+        self._accept_socket.settimeout(ACCEPT_POLL)
+        while not self._stop.is_set():
+            try: connection, _ = self._accept_socket.accept()
+            except timeout: continue
+            if self._stop.is_set():
+                connection.close()
+                break
+            recv_thread = self._make_thread(connection, len(self.threads))
+            recv_thread.run()
+            self.threads.append(recv_thread)
+
+    def run(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        try: create_connection(self._accept_socket.getsockname()[:2], ACCEPT_POLL).close()
+        except OSError: pass
+        self._thread.join()